@@ -9,7 +9,10 @@ try:
 except ImportError:
     pass
 
-from .gdml_parsers import extract_tessellated_solids
+import numpy as np
+
+from .gdml_parsers import extract_tessellated_solids_from_file
+from .gdml_rotation import Rotation
 
 def get_physvols_from_subassembly(filename):
     """
@@ -26,20 +29,118 @@ def get_physvols_from_subassembly(filename):
 
 ##############################################################
 
-def get_tsolids_from_subassembly(filename, first_identifier=0):
+def get_tsolids_from_subassembly(filename, first_identifier=0, parser='bs4', cache=None):
     """
     Open a file and get the tessellated solids
+
+    Args:
+        filename (str)         : the gdml file with the subassembly
+
+    Keyword Args:
+        first_identifier (int) : identifier of the first solid, the
+                                 following solids will be numbered
+                                 continuously
+        parser (str)           : the parser backend, 'bs4' or 'lxml'
+                                 (streaming, for large files)
+        cache (SolidCache)     : if given, the solids are taken from
+                                 the cache and the file only gets parsed
+                                 if it is not in there yet
     """
     LOG.info(f"Will check {filename} for subassembly!")
-    gdml = bs4.BeautifulSoup(open(filename), features="lxml-xml")
-
-    # assume we have materials
-    cursor = gdml.gdml.find_next()
-    #cursor = gdml.gdml.materials
-    #if cursor is None:
-    #    LOG.warn(f"No material definitions in {filename}")
-   #     cursor = bs.gdml.define
-    all_tessell_solids = extract_tessellated_solids(cursor,\
-                                                    tessellsolid_identifier=first_identifier)
-    del gdml
+    if cache is not None:
+        return cache.get_tsolids(filename,\
+                                 first_identifier=first_identifier,\
+                                 parser=parser)
+    all_tessell_solids = extract_tessellated_solids_from_file(filename,\
+                                                              tessellsolid_identifier=first_identifier,\
+                                                              parser=parser)
     return all_tessell_solids
+
+##############################################################
+
+class Subassembly(object):
+    """
+    The tessellated solids of a subassembly file, read once, which
+    can be placed several times. The solids of all the instances
+    share the vertex and facet arrays, an instance only adds its
+    own identifiers, position and rotation. The memory grows with
+    the number of instances, not with the number of facets.
+    """
+
+    def __init__(self, filename, parser='bs4', cache=None, center=False):
+        """
+        Args:
+            filename (str)     : the gdml file with the subassembly
+
+        Keyword Args:
+            parser (str)       : the parser backend, 'bs4' or 'lxml'
+            cache (SolidCache) : see get_tsolids_from_subassembly
+            center (bool)      : move every solid to its center of mass
+                                 once, the instances are placed there
+        """
+        self.filename = filename
+        self.solids = get_tsolids_from_subassembly(filename, parser=parser, cache=cache)
+        if center:
+            for k in self.solids:
+                k.translate_to_center_mass()
+
+    def __len__(self):
+        return len(self.solids)
+
+    def instance(self, first_identifier=0, translation=(0, 0, 0), rotation=None):
+        """
+        Place the subassembly once
+
+        Keyword Args:
+            first_identifier (int) : identifier of the first solid, the
+                                     following solids will be numbered
+                                     continuously
+            translation (tuple)    : moves the whole subassembly
+            rotation               : rotates the whole subassembly around
+                                     its origin, anything Rotation.coerce
+                                     understands, see gdml_rotation
+
+        Returns:
+            list : GdmlTessellatedSolid, sharing the geometry
+                   with the solids of the subassembly
+        """
+        rotation = Rotation.coerce(rotation)
+        translation = np.asarray(translation, dtype=float)
+        instances = []
+        for k, solid in enumerate(self.solids):
+            position = np.zeros(3) if solid.position is None else np.asarray(solid.position, dtype=float)
+            position = tuple((rotation.apply(position) + translation).tolist())
+            solid_rotation = solid.rotation
+            if not rotation.is_identity:
+                solid_rotation = (rotation @ solid.rotation).euler
+            instances.append(solid.instance(first_identifier + k,\
+                                            position=position,\
+                                            rotation=solid_rotation))
+        return instances
+
+    def instances(self, translations, first_identifier=0, rotations=None):
+        """
+        Place the subassembly several times
+
+        Args:
+            translations (list)    : one translation per instance
+
+        Keyword Args:
+            first_identifier (int) : identifier of the first solid of the
+                                     first instance, all solids are
+                                     numbered continuously
+            rotations (list)       : one rotation per instance, see instance
+
+        Returns:
+            list : the solids of all instances, one instance after the other
+        """
+        if rotations is None:
+            rotations = [None]*len(translations)
+        if len(rotations) != len(translations):
+            raise ValueError(f'Got {len(translations)} translations, but {len(rotations)} rotations!')
+        solids = []
+        for k, (translation, rotation) in enumerate(zip(translations, rotations)):
+            solids += self.instance(first_identifier=first_identifier + k*len(self),\
+                                    translation=translation,\
+                                    rotation=rotation)
+        return solids
@@ -0,0 +1,236 @@
+"""
+A persistent cache for the tessellated solids of a gdml file.
+Parsing large files takes a long time, so the solids are
+stored as binary arrays, keyed by the content of the file.
+"""
+
+import os
+import os.path
+import json
+import hashlib
+
+import numpy as np
+
+import logging
+LOG = logging
+try:
+    import hepbasestack as hep
+    from . import __package_loglevel__
+    LOG = hep.logger.get_logger(__package_loglevel__)
+    del logging
+except ImportError:
+    pass
+
+from .gdml_solid import GdmlTessellatedSolid
+from .gdml_parsers import PARSER_VERSION, extract_tessellated_solids_from_file
+
+# default location of the cache, can be changed
+# with the PYGDML_CACHE_DIR environment variable
+DEFAULT_CACHE_DIR = os.path.join(os.path.expanduser('~'), '.cache', 'pygdml')
+
+##############################################################
+
+def file_hash(filename, chunksize=2**22):
+    """
+    The sha256 of the content of a file
+
+    Args:
+        filename (str) : the file to hash
+
+    Keyword Args:
+        chunksize (int) : read the file in chunks of this size
+    """
+    sha = hashlib.sha256()
+    with open(filename, 'rb') as f:
+        chunk = f.read(chunksize)
+        while chunk:
+            sha.update(chunk)
+            chunk = f.read(chunksize)
+    return sha.hexdigest()
+
+##############################################################
+
+class SolidCache(object):
+    """
+    Keeps the tessellated solids of already parsed files
+    as .npz files in a cache directory. The key is the hash of
+    the file content together with the parser version, so
+    a changed file or parser will always be parsed again.
+    Loaded solids are also kept in memory, so that repeated
+    loads of the same file only create new solid objects.
+    """
+
+    def __init__(self, cache_dir=None, max_size=2**32):
+        """
+        Keyword Args:
+            cache_dir (str) : directory for the cache files
+            max_size (int)  : maximum size of the cache directory in bytes.
+                              The least recently used files are removed
+                              when it grows larger.
+        """
+        if cache_dir is None:
+            cache_dir = os.environ.get('PYGDML_CACHE_DIR', DEFAULT_CACHE_DIR)
+        self.cache_dir = cache_dir
+        self.max_size = max_size
+        os.makedirs(self.cache_dir, exist_ok=True)
+        # (path, mtime, size) -> content hash
+        self._hashes = dict()
+        # cache key -> the stored arrays
+        self._loaded = dict()
+
+    ###############################################################
+
+    def key(self, filename):
+        """
+        The cache key for a file. The file is only hashed
+        again if it has been changed on disk.
+
+        Args:
+            filename (str) : the gdml file
+        """
+        stat = os.stat(filename)
+        statkey = (os.path.abspath(filename), stat.st_mtime_ns, stat.st_size)
+        if statkey not in self._hashes:
+            self._hashes[statkey] = file_hash(filename)
+        return f'{self._hashes[statkey]}_v{PARSER_VERSION}'
+
+    ###############################################################
+
+    def cache_file(self, key):
+        return os.path.join(self.cache_dir, key + '.npz')
+
+    ###############################################################
+
+    def get_tsolids(self, filename, first_identifier=0, parser='bs4'):
+        """
+        Get the tessellated solids of a file, either from
+        the cache or by parsing the file.
+
+        Args:
+            filename (str)         : the gdml file
+
+        Keyword Args:
+            first_identifier (int) : identifier of the first solid
+            parser (str)           : the parser backend in case the
+                                     file has to be parsed
+        """
+        key = self.key(filename)
+        if key not in self._loaded:
+            cfile = self.cache_file(key)
+            if os.path.exists(cfile):
+                LOG.info(f'Loading solids of {filename} from cache {cfile}')
+                self._loaded[key] = self._read(cfile)
+                # mark it as recently used
+                os.utime(cfile)
+            else:
+                solids = extract_tessellated_solids_from_file(filename, parser=parser)
+                self._loaded[key] = self._write(cfile, solids)
+                self.evict(keep=key)
+        return self._make_solids(self._loaded[key], first_identifier)
+
+    ###############################################################
+
+    @staticmethod
+    def _make_solids(stored, first_identifier):
+        """
+        Create new solids from the stored arrays. The arrays are
+        shared between all copies, they are read-only, and every
+        transformation of a solid creates new ones.
+        """
+        solids = []
+        meta = stored['meta']
+        voff = stored['vertex_offsets']
+        foff = stored['face_offsets']
+        for k, info in enumerate(meta):
+            solid = GdmlTessellatedSolid(identifier=first_identifier + k)
+            solid.name = info['name']
+            solid.unit = info['unit']
+            solid.tolerance = info['tolerance']
+            solid.tessell_attrs = dict(info['tessell_attrs'])
+            solid.triangular_attrs = dict(info['triangular_attrs'])
+            solid.vertices = stored['vertices'][voff[k]:voff[k + 1]]
+            solid.faces = stored['faces'][foff[k]:foff[k + 1]]
+            solids.append(solid)
+        return solids
+
+    ###############################################################
+
+    @staticmethod
+    def _read(cfile):
+        with np.load(cfile, allow_pickle=False) as data:
+            stored = {k: data[k] for k in data.files}
+        stored['meta'] = json.loads(str(stored['meta']))
+        for k in ('vertices', 'faces'):
+            stored[k].flags.writeable = False
+        return stored
+
+    ###############################################################
+
+    def _write(self, cfile, solids):
+        """
+        Store the solids in a single .npz file, all vertices and
+        faces are concatenated and split up by offsets.
+        """
+        meta = [{'name'             : s.name,\
+                 'unit'             : s.unit,\
+                 'tolerance'        : s.tolerance,\
+                 'tessell_attrs'    : dict(s.tessell_attrs),\
+                 'triangular_attrs' : dict(s.triangular_attrs)} for s in solids]
+        vertices = np.concatenate([s.vertices for s in solids] + [np.empty((0, 3))])
+        faces = np.concatenate([s.faces for s in solids] + [np.empty((0, 3), dtype=np.int32)])
+        vertex_offsets = np.cumsum([0] + [s.nvertices for s in solids])
+        face_offsets = np.cumsum([0] + [s.nfaces for s in solids])
+        tmpfile = cfile + f'.{os.getpid()}.tmp.npz'
+        np.savez(tmpfile,\
+                 vertices=vertices,\
+                 faces=faces,\
+                 vertex_offsets=vertex_offsets,\
+                 face_offsets=face_offsets,\
+                 meta=np.array(json.dumps(meta)))
+        os.replace(tmpfile, cfile)
+        LOG.info(f'Cached {len(solids)} solids in {cfile}')
+        stored = {'vertices'       : vertices,\
+                  'faces'          : faces,\
+                  'vertex_offsets' : vertex_offsets,\
+                  'face_offsets'   : face_offsets,\
+                  'meta'           : meta}
+        for k in ('vertices', 'faces'):
+            stored[k].flags.writeable = False
+        return stored
+
+    ###############################################################
+
+    def evict(self, keep=None):
+        """
+        Remove the least recently used cache files until the
+        cache directory is smaller than max_size. Files which
+        are still being written (.tmp.npz, possibly by another
+        process) are left alone.
+
+        Keyword Args:
+            keep (str) : the key of a cache file which is not removed,
+                         e.g. the one which has just been written
+        """
+        files = [os.path.join(self.cache_dir, k) for k in os.listdir(self.cache_dir)\
+                 if k.endswith('.npz') and (not k.endswith('.tmp.npz'))]
+        total = sum([os.path.getsize(k) for k in files])
+        # the kept file counts towards the size, but is never removed
+        if keep is not None:
+            files = [k for k in files if k != self.cache_file(keep)]
+        files = sorted(files, key=os.path.getmtime)
+        while files and (total > self.max_size):
+            oldest = files.pop(0)
+            total -= os.path.getsize(oldest)
+            LOG.info(f'Removing {oldest} from cache')
+            os.remove(oldest)
+
+    ###############################################################
+
+    def clear(self):
+        """
+        Remove everything from the cache
+        """
+        for k in os.listdir(self.cache_dir):
+            if k.endswith('.npz'):
+                os.remove(os.path.join(self.cache_dir, k))
+        self._loaded.clear()
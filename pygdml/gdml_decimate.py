@@ -0,0 +1,217 @@
+"""
+Reduce the number of facets of tessellated solids. The meshes
+are simplified by quadric edge collapse (fast_simplification,
+through trimesh), and every result is checked before it is
+accepted: it has to stay watertight, all facets have to be
+valid for Geant4 and the surface must not move more than a
+given distance.
+"""
+
+import numpy as np
+import trimesh
+from scipy.spatial import cKDTree
+
+import logging
+LOG = logging
+try:
+    import hepbasestack as hep
+    from . import __package_loglevel__
+    LOG = hep.logger.get_logger(__package_loglevel__)
+    del logging
+except ImportError:
+    pass
+
+# length units in mm
+LENGTH_UNITS = {'um' : 1e-3,\
+                'mm' : 1.,\
+                'cm' : 10.,\
+                'm'  : 1000.}
+
+##############################################################
+
+def distance_to_surface(points, vertices, faces, k=8):
+    """
+    Distance of points to a triangle mesh. Only the k facets with
+    the closest centers are considered for each point, so the distance
+    can be overestimated, but never underestimated.
+    """
+    triangles = vertices[faces]
+    k = min(k, len(faces))
+    _, candidates = cKDTree(triangles.mean(axis=1)).query(points, k=k)
+    candidates = candidates.reshape(len(points), k)
+    closest = trimesh.triangles.closest_point(triangles[candidates.ravel()],\
+                                              np.repeat(points, k, axis=0))
+    distance = np.linalg.norm(closest - np.repeat(points, k, axis=0), axis=1)
+    return distance.reshape(len(points), k).min(axis=1)
+
+##############################################################
+
+def sample_surface(vertices, faces, npoints, rng):
+    """
+    Random points on the surface of a mesh, uniform in area
+
+    Args:
+        vertices (np.ndarray)      : (N,3) vertices
+        faces (np.ndarray)         : (M,3) facets
+        npoints (int)              : number of points
+        rng (np.random.Generator)  : the random generator
+    """
+    triangles = vertices[faces]
+    areas = 0.5 * np.linalg.norm(np.cross(triangles[:, 1] - triangles[:, 0],\
+                                          triangles[:, 2] - triangles[:, 0]), axis=1)
+    index = rng.choice(len(faces), size=npoints, p=areas / areas.sum())
+    u, v = rng.random(npoints), rng.random(npoints)
+    flip = (u + v) > 1
+    u[flip], v[flip] = 1 - u[flip], 1 - v[flip]
+    t = triangles[index]
+    return t[:, 0] + u[:, None] * (t[:, 1] - t[:, 0]) + v[:, None] * (t[:, 2] - t[:, 0])
+
+##############################################################
+
+def surface_points(vertices, faces, nsamples, rng):
+    """
+    The points at which the deviation of a surface is measured:
+    the vertices, the edge midpoints, the facet centers and
+    random points on the facets.
+
+    Args:
+        vertices (np.ndarray)      : (N,3) vertices
+        faces (np.ndarray)         : (M,3) facets
+        nsamples (int)             : number of random points
+        rng (np.random.Generator)  : the random generator
+    """
+    triangles = vertices[faces]
+    edges = np.unique(np.sort(np.concatenate((faces[:, [0, 1]],\
+                                              faces[:, [1, 2]],\
+                                              faces[:, [2, 0]])), axis=1), axis=0)
+    points = [vertices,\
+              vertices[edges].mean(axis=1),\
+              triangles.mean(axis=1)]
+    area = np.linalg.norm(np.cross(triangles[:, 1] - triangles[:, 0],\
+                                   triangles[:, 2] - triangles[:, 0]), axis=1).sum()
+    # a surface without area has nothing to sample
+    if nsamples and (area > 0):
+        points.append(sample_surface(vertices, faces, nsamples, rng))
+    return np.concatenate(points)
+
+def surface_deviation(vertices, faces, other_vertices, other_faces, nsamples=None, seed=0):
+    """
+    The (symmetric) Hausdorff distance of two triangle meshes. It is
+    measured at the vertices, edge midpoints, facet centers and random
+    surface points of both (see surface_points), so it is an estimate:
+    the largest distance can be between the sampled points, and is then
+    underestimated a little. The more samples, the closer the estimate.
+
+    Args:
+        vertices (np.ndarray)       : (N,3) vertices of the first mesh
+        faces (np.ndarray)          : (M,3) facets of the first mesh
+        other_vertices (np.ndarray) : (N,3) vertices of the second mesh
+        other_faces (np.ndarray)    : (M,3) facets of the second mesh
+
+    Keyword Args:
+        nsamples (int)              : random points per mesh, by default
+                                      as many as the mesh has facets
+        seed (int)                  : seed for the random points, so that
+                                      the result is reproducible
+    """
+    rng = np.random.default_rng(seed)
+    points = surface_points(vertices, faces,\
+                            len(faces) if nsamples is None else nsamples, rng)
+    other_points = surface_points(other_vertices, other_faces,\
+                                  len(other_faces) if nsamples is None else nsamples, rng)
+    return max(distance_to_surface(points, other_vertices, other_faces).max(),\
+               distance_to_surface(other_points, vertices, faces).max())
+
+##############################################################
+
+def _simplify(vertices, faces, face_count):
+    try:
+        from fast_simplification import simplify
+    except ImportError:
+        raise ImportError('Decimation requires the fast_simplification package!')
+    return simplify(vertices, faces, target_count=int(face_count))
+
+##############################################################
+
+def decimate(vertices, faces, face_count=None, max_deviation=None, delta=0., precision=0.01):
+    """
+    Simplify a triangle mesh to the fewest facets which fulfill
+    all requirements. Starting from the target, the number of
+    facets is doubled until the result is acceptable, and then
+    refined by bisection.
+
+    Args:
+        vertices (np.ndarray) : (N,3) vertex array
+        faces (np.ndarray)    : (M,3) vertex indices of the facets
+
+    Keyword Args:
+        face_count (int)      : the target number of facets
+        max_deviation (float) : maximum distance of the simplified
+                                from the original surface, in the
+                                unit of the vertices
+        delta (float)         : the Geant4 tolerance for the facet checks
+        precision (float)     : stop the bisection if the number of facets
+                                is known to this fraction of the original
+
+    Returns:
+        tuple (np.ndarray, np.ndarray, float) : the new vertices and faces
+                                                and their deviation. If no
+                                                simplification is acceptable,
+                                                the original mesh is returned.
+    """
+    # avoid a circular import
+    from .gdml_solid import g4_facet_validity, weld_vertices
+
+    vertices = np.asarray(vertices, dtype=np.float64)
+    faces = np.asarray(faces, dtype=np.int64).reshape(-1, 3)
+    nfaces = len(faces)
+    if (face_count is None) and (max_deviation is None):
+        raise ValueError('Need either a face_count or a max_deviation!')
+    # a closed mesh needs at least 4 facets
+    lowest = 4 if face_count is None else max(4, int(face_count))
+    if lowest >= nfaces:
+        return vertices, faces, 0.
+    watertight = trimesh.Trimesh(vertices, faces, process=False).is_watertight
+
+    def attempt(count):
+        new_vertices, new_faces = _simplify(vertices, faces, count)
+        # collapsed edges can leave vertices at the same
+        # place, together with the facets between them
+        new_vertices, new_faces, _ = weld_vertices(new_vertices, new_faces, delta)
+        if not len(new_faces):
+            return None
+        if watertight and not trimesh.Trimesh(new_vertices, new_faces, process=False).is_watertight:
+            return None
+        valid, _ = g4_facet_validity(new_vertices, new_faces, delta)
+        if not valid.all():
+            return None
+        deviation = surface_deviation(vertices, faces, new_vertices, new_faces)
+        if (max_deviation is not None) and (deviation > max_deviation):
+            return None
+        return new_vertices, new_faces, deviation
+
+    best = attempt(lowest)
+    if best is not None:
+        return best
+    # the lowest count does not work. The result of the simplification
+    # does not always get better with more facets, so first double
+    # the count until it works, then bisect the last interval
+    low, high = lowest, 2 * lowest
+    while high < nfaces:
+        best = attempt(high)
+        if best is not None:
+            break
+        low, high = high, 2 * high
+    high = min(high, nfaces)
+    step = max(1, int(precision * nfaces))
+    while high - low > step:
+        middle = (low + high) // 2
+        result = attempt(middle)
+        if result is None:
+            low = middle
+        else:
+            high = middle
+            best = result
+    if best is None:
+        return vertices, faces, 0.
+    return best
@@ -0,0 +1,239 @@
+"""
+Find tessellated solids which are copies of each other, up to
+a rotation and a translation, and place the copies as physvols
+of a single shared solid instead of writing every copy.
+"""
+
+from collections import defaultdict
+from itertools import product
+
+import numpy as np
+from scipy.spatial import cKDTree
+
+import logging
+LOG = logging
+try:
+    import hepbasestack as hep
+    from . import __package_loglevel__
+    LOG = hep.logger.get_logger(__package_loglevel__)
+    del logging
+except ImportError:
+    pass
+
+from .gdml_similarity import SimilarityIndex
+from .gdml_rotation import euler_to_matrix, Rotation
+from .gdml_physvol import GdmlPhysVol
+
+##############################################################
+
+def _kabsch(p, q):
+    """
+    The rotation R which minimizes |p @ R.T - q| for
+    two centered (N,3) point sets
+    """
+    u, _, vt = np.linalg.svd(p.T @ q)
+    d = np.sign(np.linalg.det(vt.T @ u.T))
+    return vt.T @ np.diag((1., 1., d)) @ u.T
+
+##############################################################
+
+def _same_faces(faces, other_faces):
+    """
+    Check if two face arrays describe the same facets,
+    independent of their order
+    """
+    a = np.sort(faces, axis=1)
+    b = np.sort(other_faces, axis=1)
+    a = a[np.lexsort(a.T[::-1])]
+    b = b[np.lexsort(b.T[::-1])]
+    return np.array_equal(a, b)
+
+##############################################################
+
+def rigid_transform(reference, other, tolerance=1e-3):
+    """
+    Find the rotation and translation which move the reference
+    solid onto the other one. First, the vertices are assumed to
+    be in the same order. If that does not work, the principal
+    axes of both vertex clouds are aligned and the vertices are
+    matched by their nearest neighbors.
+    Solids with an (almost) rotational symmetry do not have
+    well defined principal axes, and might not be recognized.
+
+    Args:
+        reference (GdmlTessellatedSolid) : the solid to move
+        other (GdmlTessellatedSolid)     : the solid to move it onto
+
+    Keyword Args:
+        tolerance (float) : maximum distance of matched vertices,
+                            in the length unit of the solids
+
+    Returns:
+        tuple : (rotation matrix, translation) so that
+                other.vertices = reference.vertices @ R.T + t,
+                or None if the solids are not copies of each other
+    """
+    a, b = reference.vertices, other.vertices
+    if (a.shape != b.shape) or (reference.nfaces != other.nfaces) or (not len(a)):
+        return None
+    ca, cb = a.mean(axis=0), b.mean(axis=0)
+    a0, b0 = a - ca, b - cb
+
+    def accept(rot, perm):
+        if np.abs(a0 @ rot.T - b0[perm]).max() > tolerance:
+            return None
+        if not _same_faces(perm[reference.faces], other.faces):
+            return None
+        return rot, cb - rot @ ca
+
+    # the same vertex order, this is what typically
+    # happens if the same part has been exported twice
+    result = accept(_kabsch(a0, b0), np.arange(len(a)))
+    if result is not None:
+        return result
+
+    _, axes_a = np.linalg.eigh(a0.T @ a0)
+    _, axes_b = np.linalg.eigh(b0.T @ b0)
+    tree = cKDTree(b0)
+    for signs in product((1., -1.), repeat=3):
+        rot = axes_b @ np.diag(signs) @ axes_a.T
+        if np.linalg.det(rot) < 0:
+            continue
+        dist, perm = tree.query(a0 @ rot.T, distance_upper_bound=tolerance)
+        if np.isinf(dist).any() or (len(np.unique(perm)) != len(perm)):
+            continue
+        # refine the rotation with the matched vertices
+        result = accept(_kabsch(a0, b0[perm]), perm)
+        if result is not None:
+            return result
+    return None
+
+##############################################################
+
+def _uniform_scale(solid):
+    """
+    The scale factor of a solid, None if it is
+    scaled differently along the axes
+    """
+    if solid.scalefactors is None:
+        return 1.
+    scale = tuple(solid.scalefactors)
+    if scale.count(scale[0]) != len(scale):
+        return None
+    return float(scale[0])
+
+##############################################################
+
+def find_rigid_copies(solids, tolerance=1e-3, threshold=1e-9):
+    """
+    Sort solids into originals and copies. Only solids with a
+    similar shape (see SimilarityIndex) are registered against
+    each other, the same material and scale are required as well.
+
+    Args:
+        solids (list) : list of GdmlTessellatedSolid
+
+    Keyword Args:
+        tolerance (float) : see rigid_transform
+        threshold (float) : see SimilarityIndex
+
+    Returns:
+        list : tuples of (original, copies) in the order of the solids,
+               copies is a list of (solid, rotation matrix, translation)
+    """
+    index = SimilarityIndex(threshold=threshold).add_all([s for s in solids if s.nvertices])
+    copies = dict()
+    for group in index.groups():
+        candidates = defaultdict(list)
+        for solid in group:
+            scale = _uniform_scale(solid)
+            if scale is None:
+                continue
+            candidates[(solid.material, scale)].append(solid)
+        for members in candidates.values():
+            originals = []
+            for solid in members:
+                for original in originals:
+                    trafo = rigid_transform(original, solid, tolerance=tolerance)
+                    if trafo is not None:
+                        copies[solid] = (original,) + trafo
+                        break
+                else:
+                    originals.append(solid)
+
+    result = []
+    placed = dict()
+    for solid in solids:
+        if solid in copies:
+            original, rot, trans = copies[solid]
+            placed[original][1].append((solid, rot, trans))
+            continue
+        placed[solid] = (solid, [])
+        result.append(placed[solid])
+    ncopies = sum([len(k[1]) for k in result])
+    LOG.info(f'Found {ncopies} copies of {len([k for k in result if k[1]])} solids')
+    return result
+
+##############################################################
+
+def instance_physvols(solids,\
+                      material=None,\
+                      tolerance=1e-3,\
+                      threshold=1e-9,\
+                      counter=0):
+    """
+    Create the physvols for a list of solids, where copies of the
+    same solid share a single solid and volume. Each copy gets its
+    own physvol with the position and rotation recovered from
+    its vertices. This has to be the last step after all the
+    changes to the solids, since the original solids are written
+    for their copies as well.
+
+    Args:
+        solids (list)     : list of GdmlTessellatedSolid. Their position
+                            and rotation are the placement of the solid
+
+    Keyword Args:
+        material (str)    : material for solids which do not have one
+        tolerance (float) : see rigid_transform
+        threshold (float) : see SimilarityIndex
+        counter (int)     : the physvols get continuous counters,
+                            starting with this one
+
+    Returns:
+        list : list of GdmlPhysVol
+    """
+    physvols = []
+    for original, copies in find_rigid_copies(solids, tolerance=tolerance, threshold=threshold):
+        metadata = None
+        if copies:
+            metadata = {'generalized_name' : original.name,\
+                        'unique'           : False}
+        rotation = original.rotation
+        if rotation is not None:
+            rotation = dict(rotation)
+        physvols.append(GdmlPhysVol(original.name,\
+                                    original.position,\
+                                    solid=original,\
+                                    material=original.material or material,\
+                                    rotation=rotation,\
+                                    scale=original.scalefactors,\
+                                    metadata=metadata,\
+                                    counter=counter))
+        counter += 1
+        for solid, rot, trans in copies:
+            # the copy is placed by its own rotation and position, which
+            # are combined with the transformation of the original onto it
+            placement = euler_to_matrix(solid.rotation)
+            position = np.zeros(3) if solid.position is None else np.asarray(solid.position, dtype=float)
+            position = position + placement @ (_uniform_scale(solid) * trans)
+            physvols.append(GdmlPhysVol(solid.name,\
+                                        tuple(position.tolist()),\
+                                        solid=original,\
+                                        material=original.material or material,\
+                                        rotation=Rotation(placement @ rot),\
+                                        scale=solid.scalefactors,\
+                                        metadata=dict(metadata),\
+                                        counter=counter))
+            counter += 1
+    return physvols
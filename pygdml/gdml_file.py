@@ -6,7 +6,6 @@ import os
 import os.path
 import bs4
 import periodictable as pt
-import tqdm
 
 from collections import defaultdict
 
@@ -23,7 +22,13 @@ except ImportError:
     LOG.warn("Only rudimentary logging available!")
     pass
 
-from .gdml_tags import VolumeTag, RotationTag
+from .gdml_io import open_file
+from .gdml_instrument import span, count, progress
+from .gdml_tags import VolumeTag, RotationTag, OutputProfile, PROFILES, FULL_PROFILE
+from .gdml_parsers import PARSERS, extract_tessellated_solids,\
+                          extract_tessellated_solids_lxml
+from .gdml_index import SectionIndex, read_section
+from .gdml_registry import GeometryRegistry
 
 import dataclasses
 
@@ -38,9 +43,44 @@ def open_gdml(filepath):
     Open a file with Beautiful Soup
 
     args:
-        filename (str) :
+        filename (str) : the file, can be compressed (see gdml_io.CODECS)
     """
-    return bs4.BeautifulSoup(open(filepath), features="lxml-xml")
+    with open_file(filepath) as handle:
+        return bs4.BeautifulSoup(handle, features="lxml-xml")
+
+def _open_close_tags(tag):
+    """
+    The opening and closing tag (with attributes) of a tag
+    as strings
+
+    Args:
+        tag (bs4.element.Tag) : the tag, the children will be ignored
+    """
+    empty = bs4.element.Tag(name=tag.name, attrs=tag.attrs)
+    text = empty.decode()
+    split = text.rindex('</')
+    return text[:split], text[split:]
+
+def _indent(text, level, indent=True):
+    """
+    Indent every line of text by level spaces, the same
+    way BeautifulSoup.prettify does it
+    """
+    if not indent:
+        return text + '\n'
+    pad = ' ' * level
+    return ''.join([pad + line + '\n' for line in text.splitlines()])
+
+def _write_tags_to(handle, tags, indent=True):
+    """
+    Serialize tags which are children of a section
+    and write them to an open handle
+    """
+    for tag in tags:
+        if indent:
+            handle.write(_indent(tag.prettify(), 2))
+        else:
+            handle.write(tag.decode() + '\n')
 
 class GdmlFileMinimal(object):
     """
@@ -61,16 +101,45 @@ class GdmlFileMinimal(object):
                                         'version': '1.0'})
     }
 
-    def __init__(self, filename):
+    def __init__(self, filename, parser='bs4', profile=FULL_PROFILE, strict=False):
+        """
+        Args:
+            filename (str) : the gdml file. If it exists, it will be read in.
+
+        Keyword Args:
+            parser (str)   : the parser backend for reading, either 'bs4'
+                             (the whole tree is kept in self.bs) or 'lxml'
+                             (nothing is kept in memory, the file is streamed
+                             through when the solids are extracted)
+            profile (OutputProfile or str) : how the tessellated solids are written,
+                             either an OutputProfile or one of the names in
+                             gdml_tags.PROFILES ('full', 'compact'). The profile
+                             has to be set before any solid is added.
+            strict (bool)  : raise a ValueError instead of a warning, if there
+                             are references to solids, volumes or materials
+                             which do not exist when the file is written
+        """
+        if parser not in PARSERS:
+            raise ValueError(f'Do not understand parser {parser}. Has to be one of {PARSERS}')
+        if not isinstance(profile, OutputProfile):
+            if profile not in PROFILES:
+                raise ValueError(f'Do not understand output profile {profile}. Has to be one of {tuple(PROFILES)}')
+            profile = PROFILES[profile]
         self.filename = filename
+        self.parser = parser
+        self.profile = profile
+        self.strict = strict
         # this holds the actual tree
         # in case we read from a file
         self.bs = None
         # a lock, so we don't overwrite anything
         self.is_locked = False
+        # byte offsets into the file, see the index property
+        self._index = None
         if os.path.exists(filename):
             print(f'Will parse {filename}')
-            self.bs = open_gdml(filename)
+            if parser == 'bs4':
+                self.bs = open_gdml(filename)
             self.is_locked = True
         else:
             self.bs = bs4.BeautifulSoup('<?xml version="1.0" encoding="UTF-8" standalone="no" ?>', features='lxml-xml')
@@ -80,28 +149,28 @@ class GdmlFileMinimal(object):
         # this holds the tree split up by
         # the sections as defined in schema
         # in case we are creating a new file
-        self.schema = copy(GdmlFile.GDML_SCHEMA)
+        self.schema = {k: copy(v) for k, v in GdmlFile.GDML_SCHEMA.items()}
         # the extent of the world (if known)
         self.worldextent = (0, 0, 0)
 
-        # since volumes can share the same solid
-        # we keep track of "generalized names"
-        # to identify which solid goes with which
-        self.generalized_part_names   = []
-        self.generalized_volume_names = []
-        self.generalizcd_define_names = []
-
+        # everything which has been added, by name and by
+        # content. Since volumes can share the same solid
+        # we keep track of "generalized names" to identify
+        # which solid goes with which
+        self.registry = GeometryRegistry()
         # MATERIALS
         # keep track of every added [chemical] element
-        self.element_registry = []
+        self.element_registry = self.registry.elements
         # keep track of every added material
-        self.material_registry = []
+        self.material_registry = self.registry.materials
         # keep track of every added volume
-        self.volume_registry = []
+        self.volume_registry = self.registry.volumes
         # keep track of every added solid
-        self.solid_registry  = []
+        self.solid_registry  = self.registry.solids
         # and the physical volumes, these can be more than 1 per volume!
         self.physvol_registry = defaultdict(lambda: 0)
+        # the placed GdmlPhysVols, e.g. for the overlap check
+        self.physvols = []
         # split up the materials in isotopes, elements and
 
         # materials
@@ -116,62 +185,207 @@ class GdmlFileMinimal(object):
         self.define_tags = []
         self.physvol_tags = []
 
+    def extract_tessellated_solids(self,\
+                                   solid_tags_to_write=None,\
+                                   tags_to_write=None,\
+                                   tessellsolid_identifier=0):
+        """
+        Get the tessellated solids from the file which has been read in,
+        using the parser backend chosen at construction.
+
+        Keyword Args:
+            solid_tags_to_write (list, MUTABLE) : [it will be used to append tags]
+            tags_to_write (list, MUTABLE)       : [it will be used to append tags]
+            tessellsolid_identifier (int)       : the identifier of the first solid
+        """
+        if not self.is_locked:
+            raise ValueError(f'{self.filename} has not been read from disk, there are no solids to extract!')
+        if solid_tags_to_write is None:
+            solid_tags_to_write = []
+        if tags_to_write is None:
+            tags_to_write = []
+        if self.parser == 'lxml':
+            return extract_tessellated_solids_lxml(self.filename,\
+                                                   solid_tags_to_write=solid_tags_to_write,\
+                                                   tags_to_write=tags_to_write,\
+                                                   tessellsolid_identifier=tessellsolid_identifier)
+        return extract_tessellated_solids(self.bs.gdml.find_next(),\
+                                          solid_tags_to_write=solid_tags_to_write,\
+                                          tags_to_write=tags_to_write,\
+                                          tessellsolid_identifier=tessellsolid_identifier)
+
     def copy_materials_from_file(self, filename):
         """
-        Copy the whole material section from another file
+        Copy the whole material section from another file.
+        The file is only read up to the end of the materials,
+        or, if it has been indexed, only the materials are read.
+
         Args:
-            filename:
+            filename (str) : the gdml file, can be compressed
 
         Returns:
             None
         """
-        gdml = bs4.BeautifulSoup(open(filename), features="lxml-xml")
-        materials = gdml.find_all('materials')[0]
-        self.schema['materials'] = copy(materials)
+        self.schema['materials'] = read_section(filename, 'materials')
+        self.registry.register_materials(self.schema['materials'])
+
+    @property
+    def generalized_part_names(self):
+        """
+        The generalized names of the parts whose solid has been added
+        """
+        return self.registry.solids.contents
+
+    @property
+    def generalized_volume_names(self):
+        """
+        The generalized names of the parts whose volume has been added
+        """
+        return self.registry.volumes.contents
+
+    @property
+    def index(self):
+        """
+        The byte offsets of the sections and solids of the file
+        which has been read in, see gdml_index.SectionIndex.
+        The index is built on first use and stored next to the file.
+        """
+        if not self.is_locked:
+            raise ValueError(f'{self.filename} has not been read from disk, there is nothing to index!')
+        if self._index is None:
+            self._index = SectionIndex.for_file(self.filename)
+        return self._index
+
+    def read_section(self, section, number=0):
+        """
+        A single top level section (e.g. 'materials' or 'structure')
+        of the file which has been read in, without parsing the rest
+        of the file (with parser='lxml', the file is not parsed at all).
+
+        Args:
+            section (str) : the tag of the section
+
+        Keyword Args:
+            number (int)  : which of the sections with this tag
+        """
+        return self.index.section_tag(section, number)
+
+    def read_solid(self, name, identifier=0):
+        """
+        A single tessellated solid of the file which has been read in,
+        without parsing the rest of the file
+
+        Args:
+            name (str)       : the name of the <tessellated> tag
+
+        Keyword Args:
+            identifier (int) : the identifier of the solid
+        """
+        return self.index.tessellated_solid(name, identifier=identifier)
 
     def add_define_tag(self, tag, generalized_part_name=None):
-        if generalized_part_name in self.generalized_part_names:
+        """
+        Add a tag to the define section. The defines of a part are
+        only added until its solid has been added.
+
+        Args:
+            tag (bs4.element.Tag or TagChunk) : e.g. the positions of a solid
+
+        Keyword Args:
+            generalized_part_name (str) : the part the defines belong to
+        """
+        if generalized_part_name in self.registry.solids.contents:
             #print (f'WARN: <define name={tag.attrs["name"]} already registered!')
             return
         self.define_tags.append(tag)
         if generalized_part_name is not None:
-            self.generalizcd_define_names.append(generalized_part_name)
+            self.registry.defines.add(generalized_part_name, content=generalized_part_name)
 
     def add_solid_tag(self, tag, generalized_part_name=None):
         """
+        Add a tag to the solids section, once per part
 
         Args:
-            tag:
-            unique_part_name:
-
-        Returns:
+            tag (bs4.element.Tag or TagChunk) : e.g. a <tessellated> tag
 
+        Keyword Args:
+            generalized_part_name (str) : the part the solid belongs to
         """
-        if generalized_part_name in self.generalized_part_names:
+        if generalized_part_name in self.registry.solids.contents:
             print (f'WARN: Solid {tag.attrs["name"]} already registered!')
             return
-        if generalized_part_name is not None:
-            self.generalized_part_names.append(generalized_part_name)
+        name = tag.attrs.get('name')
+        if not self.registry.solids.add(name, tag, content=generalized_part_name):
+            LOG.warning(f'There is already a solid with the name {name}!')
         self.solid_tags.append(tag)
 
     def add_volume_tag(self, tag, generalized_part_name=None):
-        if generalized_part_name in self.generalized_volume_names:
+        """
+        Add a <volume> tag to the structure, once per part.
+        The referenced solid and material are checked.
+
+        Args:
+            tag (bs4.element.Tag) : the <volume> tag
+
+        Keyword Args:
+            generalized_part_name (str) : the part the volume belongs to,
+                                          the volume is renamed after it
+        """
+        if generalized_part_name in self.registry.volumes.contents:
             print (f'WARN: Solid {tag.attrs["name"]} already registered under {generalized_part_name}!')
             return
         if generalized_part_name is not None:
             tag.attrs['name'] = generalized_part_name + '_v'
 
-        #if tag.attrs['name'] in self.volume_registry:
-        #    # FIXME - this should not be a ValueError, just a warning
-        #   raise ValueError(f'The name {tag.attrs["name"]} already exists in the volume registry')
-
+        if not self.registry.volumes.add(tag.attrs['name'], tag, content=generalized_part_name):
+            # FIXME - this should not be a ValueError, just a warning
+            LOG.warning(f'The name {tag.attrs["name"]} already exists in the volume registry')
+        self.registry.check(tag)
         self.structure_tags.append(tag)
-        if generalized_part_name is not None:
-            self.generalized_volume_names.append(generalized_part_name)
 
     def add_physvol_tag(self, tag):
+        """
+        Add a <physvol> tag, which is placed in the world.
+        The referenced volume is checked.
+
+        Args:
+            tag (bs4.element.Tag) : the <physvol> tag
+        """
+        self.registry.check(tag)
         self.physvol_tags.append(tag)
 
+    def register_physvols(self, physvols, fast_tags=True):
+        """
+        Add many GdmlPhysVols at once
+
+        Args:
+            physvols (list) : list of GdmlPhysVol
+
+        Keyword Args:
+            fast_tags (bool) : see GdmlPhysVol.register_myself
+        """
+        with span('register_physvols', nphysvols=len(physvols)):
+            for physvol in progress(physvols, desc='registering physvols..'):
+                physvol.register_myself(self, fast_tags=fast_tags)
+
+    def check_references(self):
+        """
+        Make sure that all solids, volumes and materials which are
+        referenced by the volumes and physvols exist
+
+        Returns:
+            list : (referencing tag, reference tag, name) of the
+                   unresolved references
+        """
+        unresolved = self.registry.resolve()
+        if unresolved:
+            shown = ', '.join([f'{k[0]} -> {k[1]} {k[2]}' for k in unresolved[:5]])
+            message = f'{self.filename} : {len(unresolved)} unresolved references, e.g. {shown}'
+            if self.strict:
+                raise ValueError(message)
+            LOG.warning(message)
+        return unresolved
+
     def add_world(self, extent, center=(0, 0, 0)):
         """
         This means adding a world solid and a world volume
@@ -201,34 +415,16 @@ class GdmlFileMinimal(object):
                                     can_be_empty_element=True,\
                                     attrs=attrs_wb)
         self.schema['solids'].append(copy(world_box))
+        self.registry.solids.add('worldbox', world_box)
         world_volume = VolumeTag.create('World', 'ANTARCTICAIR', 'worldbox')
+        # the physvols have been checked already
+        self.registry.check(world_volume)
         for k in self.physvol_tags:
             world_volume.append(k)
         self.structure_tags.append(copy(world_volume))
+        self.registry.volumes.add('World', world_volume)
         #self.world = copy(world_volume)
 
-    def _create_gdml_tree(self):
-        """
-        Assemble the gdml tree
-        """
-        if self.is_locked:
-            print(
-                'Tree is locked. Propably you read in a gdml file. If you really want to overwrite the file, please release the lock with GdmlFile.release_lock()')
-            return
-        # self.bs.append(     copy(self.schema['gdml']))
-        # self.bs.gdml.append(copy(self.schema['define']))
-        # self.bs.gdml.append(copy(self.schema['materials']))
-        # self.bs.gdml.append(copy(self.schema['solids']))
-        # self.bs.gdml.append(copy(self.schema['structure']))
-        # self.bs.gdml.append(copy(self.schema['setup']))
-        self.bs.append(self.schema['gdml'])
-        self.bs.gdml.append(self.schema['define'])
-        self.bs.gdml.append(self.schema['materials'])
-        self.bs.gdml.append(self.schema['solids'])
-        self.bs.gdml.append(self.schema['structure'])
-        self.bs.gdml.append(self.schema['setup'])
-        # print (self.bs.prettify())
-
     def add_element(self, symbol):
         """
         Add an element to the materials list, look up by symbol
@@ -294,7 +490,7 @@ class GdmlFileMinimal(object):
         for f in fraction_tags:
             element_tag.append(copy(f))
         self.element_tags.append(element_tag)
-        self.element_registry.append(element.symbol)
+        self.element_registry.add(element.symbol, element)
 
     def add_elemental_material(self, symbol,
                                density=None,
@@ -349,7 +545,7 @@ class GdmlFileMinimal(object):
                                           'ref': element.symbol})
         material_t.append(comp_tag)
         self.material_tags.append(material_t)
-        self.material_registry.append(element.name)
+        self.material_registry.add(element.name, material_t)
 
     def add_material(self, name, formula, density, state='solid', temperature='293.15'):
         """
@@ -395,13 +591,15 @@ class GdmlFileMinimal(object):
                                               'ref': el.symbol})
             material_t.append(comp_tag)
         self.material_tags.append(material_t)
-        self.material_registry.append(name)
+        self.material_registry.add(name, material_t)
 
     def add_antarctic_air_material(self):
         """
         This adds a vacuum material, which is basically very thin
         air
         """
+        if 'ANTARCTICAIR' in self.material_registry:
+            return
         # make sure the necessary elements are added
         for el in ['O','N','Ar','He','H']:
             self.add_element(el)
@@ -452,76 +650,69 @@ class GdmlFileMinimal(object):
         for k in fractions:
             antarcticair.append(copy(fractions[k]))
         self.material_tags.append(copy(antarcticair))
+        self.material_registry.add('ANTARCTICAIR', antarcticair)
 
-    def _write_materials(self):
-        """
-        Add all isotope/element/material tags to
-        the <materials> tag and write it out
-        """
-        for k in self.isotope_tags:
-            self.schema['materials'].append(copy(k))
-        for k in self.element_tags:
-            self.schema['materials'].append(copy(k))
-        for k in self.material_tags:
-            self.schema['materials'].append(copy(k))
-
-    def _write_structure(self):
-        for k in self.structure_tags:
-            self.schema['structure'].append(k)
-
-    def _write_solids(self):
-        for k in tqdm.tqdm(self.solid_tags, desc='writing solids..'):
-            self.schema['solids'].append(k)
-
-    def _write_physvols(self):
-        for k in tqdm.tqdm(self.physvol_tags, desc='writing physvols..'):
-            self.schema['solids'].append(k)
-
-
-    def _write_defines(self):
-        for k in tqdm.tqdm(self.define_tags, desc='writing defines..'):
-            self.schema['define'].append(k)
-
-    def _write_setup(self, worldref='World'):
-        """
-        Adds the setup tag
-
-        Keywords:
-            worldref (str)   :  The name of the world volume
+    def write_to_file(self, indent=None, level=None):
         """
-        # FIXME - check if tag exists
-        world_setup = bs4.element.Tag(name='world',\
-                                      is_xml=True,\
-                                      can_be_empty_element=True,\
-                                      attrs={'ref' : worldref})
-        self.schema['setup'].append(copy(world_setup))
+        Write the gdml tree to the provided filename. The sections
+        are written one after another directly to the file, without
+        assembling the whole tree in memory first.
 
-    def write_to_file(self):
-        """
-        Write the gdml tree to the provided filename
+        Keyword Args:
+            indent (bool) : indent the output the same way as
+                            BeautifulSoup.prettify. Without indentation
+                            every tag is written on a single line,
+                            which is faster and gives smaller files.
+                            If not given, the output profile decides.
+            level (int)   : compression level, in case the filename
+                            ends with .gz, .xz or .zst
         """
         if self.is_locked:
             print ('Tree is locked. Propably you read in a gdml file. If you really want to overwrite the file, please release the lock with GdmlFile.release_lock()')
             return
-        self._write_tags()
-        self._create_gdml_tree()
-        f = open(self.filename, 'w')
-        f.write(self.bs.prettify())
-        f.close()
-
-
-    def _write_tags(self):
-        self._write_materials()
-        self._write_defines()
-        self._write_solids()
-        self._write_structure()
-        self._write_setup()
-
-
-
-
+        if indent is None:
+            indent = self.profile.indent
+        self.check_references()
+        with span('write_to_file', filename=self.filename):
+            with open_file(self.filename, 'wt', level=level) as f:
+                self.stream_to(f, indent=indent)
+        # the size on disk, after the compression
+        count('bytes_written', os.path.getsize(self.filename))
+
+    def stream_to(self, handle, indent=True):
+        """
+        Serialize the file section by section to an open handle
 
+        Args:
+            handle (file) : anything with a write method
 
+        Keyword Args:
+            indent (bool) : indent the output like BeautifulSoup.prettify
+        """
+        world_setup = bs4.element.Tag(name='world',\
+                                      is_xml=True,\
+                                      can_be_empty_element=True,\
+                                      attrs={'ref' : 'World'})
+        sections = [('define', [self.define_tags]),\
+                    ('materials', [self.isotope_tags, self.element_tags, self.material_tags]),\
+                    ('solids', [self.solid_tags]),\
+                    ('structure', [self.structure_tags]),\
+                    ('setup', [[world_setup]])]
+        handle.write('<?xml version="1.0" encoding="utf-8"?>\n')
+        gdml_open, gdml_close = _open_close_tags(self.schema['gdml'])
+        handle.write(gdml_open + '\n')
+        for name, tag_lists in sections:
+            section = self.schema[name]
+            section_open, section_close = _open_close_tags(section)
+            handle.write(_indent(section_open, 1, indent))
+            # first whatever is already in the schema, e.g. the world
+            _write_tags_to(handle, section.findChildren(recursive=False), indent)
+            for tags in tag_lists:
+                if len(tags) > 1000:
+                    tags = progress(tags, desc=f'writing {name}..')
+                _write_tags_to(handle, tags, indent)
+            handle.write(_indent(section_close, 1, indent))
+        handle.write(gdml_close + '\n')
 
 
 class GdmlFile(object):
@@ -553,7 +744,7 @@ class GdmlFile(object):
         self.is_locked = False
         if os.path.exists(filename):
             print (f'Will parse {filename}')
-            self.bs = bs4.BeautifulSoup(open(filename), features="lxml-xml")
+            self.bs = open_gdml(filename)
             self.is_locked = True
         else:
             self.bs = bs4.BeautifulSoup('<?xml version="1.0" encoding="UTF-8" standalone="no" ?>', features='lxml-xml') 
@@ -880,11 +1071,11 @@ class GdmlFile(object):
             self.schema['structure'].append(k)
 
     def write_solids(self):
-        for k in tqdm.tqdm(self.solid_tags, desc='writing solids..'):
+        for k in progress(self.solid_tags, desc='writing solids..'):
             self.schema['solids'].append(k)
     
     def write_defines(self):
-        for k in tqdm.tqdm(self.define_tags, desc='writing defines..'):
+        for k in progress(self.define_tags, desc='writing defines..'):
             self.schema['define'].append(k)
 
     def write_setup(self, worldref='World'):
@@ -989,7 +1180,7 @@ class GdmlFile(object):
         if self.is_locked:
             print ('Tree is locked. Propably you read in a gdml file. If you really want to overwrite the file, please release the lock with GdmlFile.release_lock()')
             return
-        f = open(self.filename, 'w')
+        f = open_file(self.filename, 'wt')
         f.write(self.bs.prettify())
         f.close()
 
@@ -0,0 +1,295 @@
+"""
+Incremental builds: the results of the processing of every
+tessellated solid are kept in a manifest directory, keyed by
+a hash of the raw solid as it has been read from the file. When
+a file is processed again, only the solids which have changed
+are processed, the others are restored from the manifest,
+including the formatted lines of their tags.
+"""
+
+import os
+import os.path
+import json
+import hashlib
+import dataclasses
+
+import numpy as np
+
+import logging
+LOG = logging
+try:
+    import hepbasestack as hep
+    from . import __package_loglevel__
+    LOG = hep.logger.get_logger(__package_loglevel__)
+    del logging
+except ImportError:
+    pass
+
+from .gdml_parsers import PARSER_VERSION
+from .gdml_pipeline import SOLID_STATE, _get_state, _set_state
+from .gdml_instrument import count
+
+# increase whenever the stored results change
+MANIFEST_VERSION = 2
+
+# the stages of the pipeline for which the state of the
+# solids is stored, e.g. before and after the centering
+STATES = ('cleaned', 'centered')
+
+##############################################################
+
+def solid_hash(solid):
+    """
+    The sha256 of everything which defines a solid as it
+    has been read from the file: the vertices, facets,
+    name, unit and attributes
+
+    Args:
+        solid (GdmlTessellatedSolid) : the solid
+    """
+    sha = hashlib.sha256()
+    sha.update(np.ascontiguousarray(solid.vertices, dtype=np.float64).tobytes())
+    sha.update(np.ascontiguousarray(solid.faces, dtype=np.int64).tobytes())
+    sha.update(json.dumps([solid.name,\
+                           solid.unit,\
+                           solid.tolerance,\
+                           solid.tessell_attrs,\
+                           solid.triangular_attrs], sort_keys=True, default=str).encode())
+    return sha.hexdigest()
+
+##############################################################
+
+def _encode(value):
+    """
+    Make the attributes of a solid json compatible, arrays
+    and tuples are marked so that they can be restored
+    """
+    if isinstance(value, np.ndarray):
+        return {'__array__' : value.tolist()}
+    if isinstance(value, tuple):
+        return {'__tuple__' : [_encode(k) for k in value]}
+    if isinstance(value, list):
+        return [_encode(k) for k in value]
+    if isinstance(value, dict):
+        return {k: _encode(v) for k, v in value.items()}
+    if isinstance(value, np.generic):
+        return value.item()
+    return value
+
+def _decode(value):
+    if isinstance(value, dict):
+        if '__array__' in value:
+            return np.array(value['__array__'])
+        if '__tuple__' in value:
+            return tuple([_decode(k) for k in value['__tuple__']])
+        return {k: _decode(v) for k, v in value.items()}
+    if isinstance(value, list):
+        return [_decode(k) for k in value]
+    return value
+
+##############################################################
+
+def _profile_key(profile):
+    return json.dumps(dataclasses.asdict(profile), sort_keys=True)
+
+##############################################################
+
+class Manifest(object):
+    """
+    The processed solids of the last run. Every solid gets
+    a json file (attributes and formatted lines) and a .npz
+    file (vertices and facets for each of the STATES).
+    Entries which are not used by a run are removed when
+    the manifest is saved.
+    """
+
+    def __init__(self, directory, settings=None):
+        """
+        Args:
+            directory (str)  : the manifest directory
+
+        Keyword Args:
+            settings (dict)  : everything else which changes the result
+                               of the processing, e.g. the options of
+                               the pipeline stages. A change invalidates
+                               all entries.
+        """
+        self.directory = directory
+        os.makedirs(self.directory, exist_ok=True)
+        settings = dict() if settings is None else dict(settings)
+        settings['parser_version'] = PARSER_VERSION
+        settings['manifest_version'] = MANIFEST_VERSION
+        self.settings_hash = hashlib.sha256(json.dumps(settings, sort_keys=True, default=str).encode())\
+                                    .hexdigest()
+        # key -> name of the solid, of the last run
+        self.entries = dict()
+        index = os.path.join(self.directory, 'manifest.json')
+        if os.path.exists(index):
+            with open(index) as f:
+                self.entries = json.load(f)['entries']
+        # solid -> key, for the solids of this run
+        self.keys = dict()
+        # key -> the stored (or to be stored) results
+        self.results = dict()
+        self.hits = 0
+        self.misses = 0
+
+    ###############################################################
+
+    def _file(self, key, extension):
+        return os.path.join(self.directory, key + extension)
+
+    ###############################################################
+
+    def key(self, solid):
+        """
+        The key of a solid, computed once per solid
+        before it is processed
+
+        Args:
+            solid (GdmlTessellatedSolid) : the solid
+        """
+        if solid not in self.keys:
+            sha = hashlib.sha256((solid_hash(solid) + self.settings_hash).encode())
+            self.keys[solid] = sha.hexdigest()
+        return self.keys[solid]
+
+    ###############################################################
+
+    def _load(self, key):
+        if key in self.results:
+            return self.results[key]
+        if (key not in self.entries) or (not os.path.exists(self._file(key, '.npz'))):
+            return None
+        with open(self._file(key, '.json')) as f:
+            result = json.load(f)
+        with np.load(self._file(key, '.npz'), allow_pickle=False) as data:
+            for state in STATES:
+                if f'{state}_vertices' in data.files:
+                    result['states'][state]['vertices'] = data[f'{state}_vertices']
+                    result['states'][state]['faces'] = data[f'{state}_faces']
+        self.results[key] = result
+        return result
+
+    ###############################################################
+
+    def restore(self, solids, state):
+        """
+        Set the solids to a stored state
+
+        Args:
+            solids (list) : list of GdmlTessellatedSolid
+            state (str)   : one of STATES
+
+        Returns:
+            list : the solids which have not been restored
+                   and need to be processed
+        """
+        todo = []
+        for solid in solids:
+            key = self.key(solid)
+            result = self._load(key)
+            if (result is None) or ('vertices' not in result['states'].get(state, {})):
+                todo.append(solid)
+                continue
+            stored = result['states'][state]
+            attrs = _decode(stored['attrs'])
+            _set_state(solid, dict(attrs,\
+                                   vertices=stored['vertices'],\
+                                   faces=stored['faces']))
+        nrestored = len(solids) - len(todo)
+        if state == STATES[0]:
+            self.hits += nrestored
+            self.misses += len(todo)
+            count('solids_restored', nrestored)
+        LOG.info(f'Restored {nrestored} of {len(solids)} solids ({state})')
+        return todo
+
+    ###############################################################
+
+    def keep(self, solids, state):
+        """
+        Remember the current state of the solids, to be
+        written with save.
+
+        Args:
+            solids (list) : list of GdmlTessellatedSolid
+            state (str)   : one of STATES
+        """
+        for solid in solids:
+            key = self.key(solid)
+            result = self._load(key)
+            if result is None:
+                result = {'name' : solid.name, 'states' : dict(), 'lines' : dict()}
+                self.results[key] = result
+            state_dict = _get_state(solid)
+            attrs = {k: state_dict[k] for k in SOLID_STATE}
+            attrs['derived'] = state_dict['derived']
+            attrs['transform'] = state_dict['transform']
+            result['states'][state] = {'attrs'    : _encode(attrs),\
+                                       'vertices' : state_dict['vertices'].copy(),\
+                                       'faces'    : solid.faces.copy()}
+            result['dirty'] = True
+
+    ###############################################################
+
+    def lines(self, solids, profile):
+        """
+        Restore the formatted lines of the tags of the solids, and
+        format and keep the ones which are missing or have been made
+        for another unit, transform or attributes (see
+        GdmlTessellatedSolid.render_lines). Call it once the solids are
+        final, i.e. after the transforms went to the physvols.
+
+        Args:
+            solids (list)           : list of GdmlTessellatedSolid, kept
+                                      or restored before
+            profile (OutputProfile) : the output profile
+        """
+        nrestored = 0
+        for solid in solids:
+            result = self._load(self.key(solid))
+            if result is None:
+                continue
+            stored = result['lines'].get(_profile_key(profile))
+            if (stored is not None) and (stored.get('attrs') == solid._render_key()):
+                solid.rendered_lines[profile] = stored
+                nrestored += 1
+                continue
+            result['lines'][_profile_key(profile)] = solid.render_lines(profile)
+            result['dirty'] = True
+        LOG.info(f'Restored the lines of {nrestored} of {len(solids)} solids')
+
+    ###############################################################
+
+    def save(self):
+        """
+        Write all new results and remove the entries
+        which have not been used by this run
+        """
+        used = dict()
+        for solid, key in self.keys.items():
+            used[key] = solid.name
+            result = self.results.get(key)
+            if (result is None) or (not result.pop('dirty', False)):
+                continue
+            arrays = dict()
+            meta = {'name' : result['name'], 'states' : dict(), 'lines' : result['lines']}
+            for state, stored in result['states'].items():
+                arrays[f'{state}_vertices'] = stored['vertices']
+                arrays[f'{state}_faces'] = stored['faces']
+                meta['states'][state] = {'attrs' : stored['attrs']}
+            with open(self._file(key, '.json'), 'w') as f:
+                json.dump(meta, f)
+            np.savez(self._file(key, '.tmp.npz'), **arrays)
+            os.replace(self._file(key, '.tmp.npz'), self._file(key, '.npz'))
+        for key in self.entries:
+            if key in used:
+                continue
+            for extension in ('.json', '.npz'):
+                if os.path.exists(self._file(key, extension)):
+                    os.remove(self._file(key, extension))
+        self.entries = used
+        with open(os.path.join(self.directory, 'manifest.json'), 'w') as f:
+            json.dump({'version' : MANIFEST_VERSION,\
+                       'entries' : self.entries}, f, indent=1)
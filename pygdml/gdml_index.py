@@ -0,0 +1,374 @@
+"""
+Random access into large gdml files. The byte offsets of the
+top level sections (<materials>, <define>, <solids>, <structure>)
+and of every <tessellated> solid are found in a single pass over
+the raw bytes, and stored next to the file. With the index, a
+single section or solid can be read without parsing (or even
+reading) the rest of the file.
+Random access needs an uncompressed file.
+"""
+
+import os
+import os.path
+import re
+import json
+import mmap
+from collections import defaultdict
+
+from lxml import etree
+
+import logging
+LOG = logging
+try:
+    import hepbasestack as hep
+    from . import __package_loglevel__
+    LOG = hep.logger.get_logger(__package_loglevel__)
+    del logging
+except ImportError:
+    pass
+
+from .gdml_io import get_codec
+from .gdml_solid import GdmlTessellatedSolid
+from .gdml_parsers import _to_bs4_tag, read_section_tag
+from .gdml_instrument import timed
+from .gdml_tags import GDML_DEFAULTS, with_defaults
+
+# increase whenever the content of the index changes
+INDEX_VERSION = 1
+
+# the top level sections which are indexed
+SECTIONS = ('materials', 'define', 'solids', 'structure')
+
+# comments are skipped, a commented out section is not indexed
+_TAG_PATTERN = re.compile(rb'<!--.*?-->|<(/?)(materials|define|solids|structure|tessellated)(?=[\s/>])',\
+                          re.DOTALL)
+_NAME_PATTERN = re.compile(rb'''\sname\s*=\s*(?:"([^"]*)"|'([^']*)')''')
+
+##############################################################
+
+def index_filename(filename):
+    """
+    Where the index of a file is stored
+
+    Args:
+        filename (str) : the gdml file
+    """
+    return filename + '.idx'
+
+##############################################################
+
+def _localname(tag):
+    if tag[0] == '{':
+        return tag.split('}', 1)[1]
+    return tag
+
+##############################################################
+
+class SectionIndex(object):
+    """
+    The byte offsets of the sections and tessellated solids of a
+    gdml file. Every entry has a start and end offset, so that
+    data[start:end] is the complete element. If there are
+    several solids with the same name, the first one is indexed.
+    """
+
+    def __init__(self, filename, sections=None, solids=None, stat=None):
+        """
+        Args:
+            filename (str)  : the (uncompressed) gdml file
+
+        Keyword Args:
+            sections (list) : (tag, start, end) of the top level sections, in file order
+            solids (dict)   : name -> (start, end, number of the <solids> section,
+                              number of the <define> section before it or None)
+            stat (tuple)    : (size, mtime_ns) of the indexed file
+        """
+        self.filename = filename
+        self.sections = [] if sections is None else [tuple(k) for k in sections]
+        self.solids = dict() if solids is None else {k: tuple(v) for k, v in solids.items()}
+        self.stat = tuple(stat) if stat is not None else None
+
+    ###############################################################
+
+    @staticmethod
+    def _stat(filename):
+        stat = os.stat(filename)
+        return (stat.st_size, stat.st_mtime_ns)
+
+    ###############################################################
+
+    @classmethod
+    @timed('build_index')
+    def build(cls, filename):
+        """
+        Scan a file once and find the offsets of all sections
+        and tessellated solids
+
+        Args:
+            filename (str) : the gdml file, has to be uncompressed
+        """
+        if get_codec(filename) is not None:
+            raise ValueError(f'Can not index {filename}, random access needs an uncompressed file!')
+        index = cls(filename, stat=cls._stat(filename))
+        if not index.stat[0]:
+            return index
+        # tag, start and name of the open elements
+        stack = []
+        counts = defaultdict(int)
+        last_define = None
+        with open(filename, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            for match in _TAG_PATTERN.finditer(data):
+                tag = match.group(2)
+                if tag is None:
+                    # a comment
+                    continue
+                tag = tag.decode()
+                closing = bool(match.group(1))
+                start = match.start()
+                if closing:
+                    end = data.find(b'>', match.end()) + 1
+                    if (not stack) or (stack[-1][0] != tag):
+                        raise ValueError(f'Unexpected </{tag}> at byte {start} of {filename}')
+                    _, open_start, name = stack.pop()
+                    if (tag == 'tessellated') and (name not in index.solids):
+                        index.solids[name] = (open_start, end, counts['solids'], last_define)
+                    elif not stack:
+                        index.sections.append((tag, open_start, end))
+                        if tag == 'define':
+                            last_define = counts['define']
+                        counts[tag] += 1
+                    continue
+                end = data.find(b'>', match.end()) + 1
+                head = data[start:end]
+                name = None
+                if tag == 'tessellated':
+                    found = _NAME_PATTERN.search(head)
+                    if found is not None:
+                        name = (found.group(1) if found.group(1) is not None else found.group(2)).decode()
+                if head.endswith(b'/>'):
+                    # an empty element, e.g. <structure/>
+                    if (tag != 'tessellated') and not stack:
+                        index.sections.append((tag, start, end))
+                        counts[tag] += 1
+                    continue
+                stack.append((tag, start, name))
+        LOG.info(f'Indexed {len(index.sections)} sections and {len(index.solids)} solids of {filename}')
+        return index
+
+    ###############################################################
+
+    def count(self, tag):
+        """
+        Number of top level sections with this tag
+        """
+        return len([k for k in self.sections if k[0] == tag])
+
+    ###############################################################
+
+    def is_valid(self):
+        """
+        Check that the file has not been changed since it has been indexed
+        """
+        if not os.path.exists(self.filename):
+            return False
+        return self.stat == self._stat(self.filename)
+
+    ###############################################################
+
+    def save(self, filename=None):
+        """
+        Store the index, by default next to the gdml file
+
+        Keyword Args:
+            filename (str) : where to store the index
+        """
+        if filename is None:
+            filename = index_filename(self.filename)
+        with open(filename, 'w') as f:
+            json.dump({'version'  : INDEX_VERSION,\
+                       'stat'     : self.stat,\
+                       'sections' : self.sections,\
+                       'solids'   : self.solids}, f)
+
+    ###############################################################
+
+    @classmethod
+    def load(cls, filename):
+        """
+        Load the stored index of a file
+
+        Args:
+            filename (str) : the gdml file (not the index)
+
+        Returns:
+            SectionIndex : None if there is no index, or it
+                           is outdated
+        """
+        try:
+            with open(index_filename(filename)) as f:
+                stored = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if stored.get('version') != INDEX_VERSION:
+            return None
+        index = cls(filename,\
+                    sections=stored['sections'],\
+                    solids=stored['solids'],\
+                    stat=stored['stat'])
+        if not index.is_valid():
+            LOG.info(f'The index of {filename} is outdated')
+            return None
+        return index
+
+    ###############################################################
+
+    @classmethod
+    def for_file(cls, filename, save=True):
+        """
+        Load the index of a file, or build it if it does
+        not exist (or is outdated)
+
+        Args:
+            filename (str) : the gdml file
+
+        Keyword Args:
+            save (bool)    : store a newly built index next to the file
+        """
+        index = cls.load(filename)
+        if index is None:
+            index = cls.build(filename)
+            if save:
+                try:
+                    index.save()
+                except OSError as e:
+                    LOG.warning(f'Can not store the index of {filename}: {e}')
+        return index
+
+    ###############################################################
+
+    def read_bytes(self, start, end):
+        """
+        The raw content of the file between two offsets
+        """
+        with open(self.filename, 'rb') as f:
+            f.seek(start)
+            return f.read(end - start)
+
+    ###############################################################
+
+    def element(self, tag, number=0):
+        """
+        A top level section as lxml element
+
+        Args:
+            tag (str)     : one of SECTIONS
+
+        Keyword Args:
+            number (int)  : which of the sections with this tag
+        """
+        sections = [k for k in self.sections if k[0] == tag]
+        if number >= len(sections):
+            raise IndexError(f'There is no <{tag}> section number {number} in {self.filename}')
+        _, start, end = sections[number]
+        return etree.fromstring(self.read_bytes(start, end), parser=etree.XMLParser(remove_comments=True))
+
+    ###############################################################
+
+    def section_tag(self, tag, number=0):
+        """
+        A top level section as bs4.element.Tag, the same as
+        gdml_parsers.read_section_tag gives
+
+        Args:
+            tag (str)     : one of SECTIONS
+
+        Keyword Args:
+            number (int)  : which of the sections with this tag
+        """
+        return _to_bs4_tag(self.element(tag, number))
+
+    ###############################################################
+
+    def tessellated_solid(self, name, identifier=0):
+        """
+        Read a single tessellated solid. Its vertices are taken
+        from the define section right before its solids section,
+        like the parsers do. The other define sections are only
+        read if vertices are missing there.
+
+        Args:
+            name (str)       : the name of the <tessellated> tag
+
+        Keyword Args:
+            identifier (int) : the identifier of the solid
+
+        Returns:
+            GdmlTessellatedSolid
+        """
+        if name not in self.solids:
+            raise KeyError(f'There is no tessellated solid {name} in {self.filename}')
+        start, end, _, define = self.solids[name]
+        tessellated = etree.fromstring(self.read_bytes(start, end),\
+                                       parser=etree.XMLParser(remove_comments=True))
+        facets = [k for k in tessellated if _localname(k.tag) == 'triangular']
+        needed = set()
+        for k in facets:
+            needed.update((k.get('vertex1'), k.get('vertex2'), k.get('vertex3')))
+
+        solid = GdmlTessellatedSolid(identifier=identifier)
+        solid.tolerance = 1e-9
+        ndefines = self.count('define')
+        order = list(range(ndefines))
+        if define is not None:
+            order = [define] + [k for k in order if k != define]
+        for number in order:
+            if not needed:
+                break
+            paired = (number == define)
+            for position in self.element('define', number):
+                vname = position.get('name')
+                if paired and (vname != 'center'):
+                    # all vertices, so that they are in the
+                    # same order as from the parsers
+                    needed.add(vname)
+                if (vname in needed) and (vname not in solid.indizes):
+                    solid.add_vertex(vname,\
+                                     float(position.get('x')),\
+                                     float(position.get('y')),\
+                                     float(position.get('z')),\
+                                     unit=position.get('unit', GDML_DEFAULTS['position']['unit']))
+                    needed.discard(vname)
+        if needed:
+            raise KeyError(f'{name} : vertices {sorted(needed)[:5]} are not defined in {self.filename}')
+
+        solid.tessell_attrs = with_defaults('tessellated', tessellated.attrib)
+        solid.name = name
+        for k in facets:
+            attrs = None
+            if not solid.triangular_attrs:
+                attrs = with_defaults('triangular', k.attrib)
+            solid.add_triangular(k.get('vertex1'),\
+                                 k.get('vertex2'),\
+                                 k.get('vertex3'),\
+                                 attrs=attrs)
+        solid.indizes.clear()
+        return solid
+
+##############################################################
+
+def read_section(filename, section):
+    """
+    Get the first top level section of a file. If there is a
+    (valid) stored index, only the section itself is read,
+    otherwise the file is streamed up to the section.
+
+    Args:
+        filename (str) : the gdml file
+        section (str)  : e.g. 'materials'
+    """
+    index = None
+    if get_codec(filename) is None:
+        index = SectionIndex.load(filename)
+    if index is None:
+        return read_section_tag(filename, section)
+    return index.section_tag(section)
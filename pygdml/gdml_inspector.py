@@ -8,9 +8,10 @@ number of facets
 import bs4
 #import re
 
-from tessellatedsolid import extract_tessellated_solids, get_unique_names
-
-from collections import defaultdict
+from pygdml.gdml_parsers import extract_tessellated_solids, get_unique_names
+from pygdml.gdml_similarity import SimilarityIndex
+from pygdml.gdml_file import open_gdml
+from pygdml.gdml_index import SectionIndex
 
 if __name__ == '__main__':
     
@@ -25,14 +26,31 @@ if __name__ == '__main__':
     parser.add_argument('--show-unique-names', dest='show_unique_names', action='store_true',
                         default=False,
                         help='Go through all the volumes and show identify which names are (sort of) unique. Do this by comparing the names without the nubmers')
+    parser.add_argument('--index', dest='index', action='store_true',
+                        default=False,
+                        help='Index the byte offsets of the sections and solids (stored next to the file as .idx), show the sections and exit')
+    parser.add_argument('--solid', dest='solid', type=str,
+                        default=None,
+                        help='Show only this tessellated solid, it is read with the index without parsing the rest of the file')
     args = parser.parse_args()
 
-    gdml = bs4.BeautifulSoup(open(args.infile), features="lxml-xml")
+    if args.index or (args.solid is not None):
+        index = SectionIndex.for_file(args.infile)
+        if args.solid is not None:
+            solid = index.tessellated_solid(args.solid)
+            print (f'-- SOLID: {solid.name} - vertices : {solid.nvertices} - facets : {solid.nfaces} - unit : {solid.unit}')
+        else:
+            for tag, start, end in index.sections:
+                print (f'-- {tag:>10} : bytes {start} - {end}')
+            print (f'-- {len(index.solids)} tessellated solids')
+        raise SystemExit
+
+    gdml = open_gdml(args.infile)
     
     # assume we have materials
     cursor = gdml.gdml.materials
     if cursor is None:
-        cursor = bs.gdml.define
+        cursor = gdml.gdml.define
     all_tessell_solids = extract_tessellated_solids(cursor) 
 
     allchildren = gdml.gdml.findChildren(recursive=False)
@@ -65,23 +83,16 @@ if __name__ == '__main__':
 
     if args.show_relations:
         print ('Checking for similarities...')
-        threshold = 1e-9
-        stop = False
-        sisters = defaultdict(list)
-        for k in all_tessell_solids:
-            for j in all_tessell_solids:
-                if k.name == j.name:
-                    continue
-                result = k.is_similar(j)
-                if result < threshold:
-                    j.result = result
-                    sisters[k].append(j)
+        index = SimilarityIndex(threshold=1e-9).add_all(all_tessell_solids)
+        sisters = index.relations()
 
         print ("Related parts")
         for k in sisters:
             print (f'-- {k.name}:') 
-            for j in sisters[k]:
-                print (f'-- -- {j.name}/{j.result}')
+            for j, result in sisters[k]:
+                if k.name == j.name:
+                    continue
+                print (f'-- -- {j.name}/{result}')
             print ('====================\n\n')
     if args.show_unique_names:
         get_unique_names(all_tessell_solids)
@@ -0,0 +1,288 @@
+"""
+Record where the time goes while a file is processed. Named
+spans measure the duration and the memory high water mark of
+a stage, counters keep track of the amount of work (facets read,
+facets dropped, tags emitted, bytes written). Recording is off
+by default, and the results can be exported as json or in the
+Chrome trace format (chrome://tracing, ui.perfetto.dev).
+
+The quiet mode switches off the progress bars, which is what
+is left of the console output in the hot paths.
+
+Only the current process is recorded, stages which run in the
+worker processes of gdml_pipeline.run_stage show up as a single
+span for the whole stage.
+"""
+
+import os
+import json
+import time
+import resource
+import threading
+import tracemalloc
+from collections import defaultdict
+from functools import wraps
+
+import tqdm
+
+##############################################################
+
+class _Span(object):
+    """
+    Context manager for a single span, see Instrumentation.span
+    """
+
+    __slots__ = ('recorder', 'name', 'args', 'start')
+
+    def __init__(self, recorder, name, args):
+        self.recorder = recorder
+        self.name = name
+        self.args = args
+        self.start = None
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.recorder._close_span(self)
+        return False
+
+##############################################################
+
+class _NoSpan(object):
+    """
+    Does nothing, in case the recording is off
+    """
+
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+_NO_SPAN = _NoSpan()
+
+##############################################################
+
+def max_rss():
+    """
+    The memory high water mark of this process in bytes
+    """
+    # linux gives kB, macos bytes
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if os.uname().sysname == 'Darwin':
+        return rss
+    return rss * 1024
+
+##############################################################
+
+class Instrumentation(object):
+    """
+    Collects spans and counters
+    """
+
+    def __init__(self):
+        self.enabled = False
+        self.quiet = False
+        self.spans = []
+        self.counters = defaultdict(int)
+        self.origin = time.perf_counter()
+
+    def reset(self):
+        """
+        Throw away everything which has been recorded so far
+        """
+        self.spans = []
+        self.counters = defaultdict(int)
+        self.origin = time.perf_counter()
+
+    def span(self, name, **args):
+        """
+        Measure a stage, use it as a context manager:
+
+        with INSTRUMENTATION.span('write_to_file', filename=filename):
+            ...
+
+        Args:
+            name (str) : the name of the stage
+
+        Keyword Args:
+            **args     : additional information, which is stored
+                         with the span
+        """
+        if not self.enabled:
+            return _NO_SPAN
+        return _Span(self, name, args)
+
+    def _close_span(self, span):
+        end = time.perf_counter()
+        record = {'name'     : span.name,\
+                  'start'    : span.start - self.origin,\
+                  'duration' : end - span.start,\
+                  'pid'      : os.getpid(),\
+                  'tid'      : threading.get_ident(),\
+                  'max_rss'  : max_rss()}
+        if tracemalloc.is_tracing():
+            record['traced_peak'] = tracemalloc.get_traced_memory()[1]
+        if span.args:
+            record['args'] = span.args
+        self.spans.append(record)
+
+    def count(self, name, value=1):
+        """
+        Add to a counter
+
+        Args:
+            name (str)  : the name of the counter
+
+        Keyword Args:
+            value (int) : the amount to add
+        """
+        if self.enabled:
+            self.counters[name] += value
+
+    def add_counters(self, counters):
+        """
+        Add counters which have been recorded elsewhere,
+        e.g. in a worker process
+
+        Args:
+            counters (dict) : name -> amount
+        """
+        if self.enabled:
+            for name, value in counters.items():
+                self.counters[name] += value
+
+    def progress(self, iterable=None, **kwargs):
+        """
+        A tqdm progress bar, which is switched off in quiet mode
+
+        Keyword Args:
+            iterable   : the iterable to wrap
+            **kwargs   : passed on to tqdm
+        """
+        return tqdm.tqdm(iterable, disable=self.quiet, **kwargs)
+
+    def summary(self):
+        """
+        The total time, number of calls and the memory
+        high water mark per span name
+
+        Returns:
+            dict : name -> {'calls', 'time', 'max_rss'}
+        """
+        result = dict()
+        for span in self.spans:
+            if span['name'] not in result:
+                result[span['name']] = {'calls' : 0, 'time' : 0., 'max_rss' : 0}
+            entry = result[span['name']]
+            entry['calls'] += 1
+            entry['time'] += span['duration']
+            entry['max_rss'] = max(entry['max_rss'], span['max_rss'])
+        return result
+
+    def to_dict(self):
+        return {'spans'    : self.spans,\
+                'counters' : dict(self.counters),\
+                'summary'  : self.summary()}
+
+    def to_json(self, filename):
+        """
+        Write spans, counters and the summary to a json file
+
+        Args:
+            filename (str) : the file to write
+        """
+        with open(filename, 'w') as f:
+            json.dump(self.to_dict(), f, indent=2)
+
+    def to_chrome_trace(self, filename):
+        """
+        Write the spans in the Chrome trace event format. The memory
+        high water mark and the counters show up as counter tracks.
+
+        Args:
+            filename (str) : the file to write
+        """
+        events = []
+        for span in self.spans:
+            start = span['start'] * 1e6
+            end = start + span['duration'] * 1e6
+            events.append({'name' : span['name'],\
+                           'cat'  : 'pygdml',\
+                           'ph'   : 'X',\
+                           'ts'   : start,\
+                           'dur'  : span['duration'] * 1e6,\
+                           'pid'  : span['pid'],\
+                           'tid'  : span['tid'],\
+                           'args' : span.get('args', {})})
+            events.append({'name' : 'memory',\
+                           'ph'   : 'C',\
+                           'ts'   : end,\
+                           'pid'  : span['pid'],\
+                           'args' : {'max_rss [MB]' : span['max_rss'] / 1e6}})
+        if self.spans and self.counters:
+            last = max([k['start'] + k['duration'] for k in self.spans]) * 1e6
+            events.append({'name' : 'counters',\
+                           'ph'   : 'C',\
+                           'ts'   : last,\
+                           'pid'  : os.getpid(),\
+                           'args' : dict(self.counters)})
+        with open(filename, 'w') as f:
+            json.dump({'traceEvents'     : events,\
+                       'displayTimeUnit' : 'ms'}, f)
+
+##############################################################
+
+# the instrumentation of this process
+INSTRUMENTATION = Instrumentation()
+
+def enable(on=True):
+    INSTRUMENTATION.enabled = on
+
+def is_enabled():
+    return INSTRUMENTATION.enabled
+
+def set_quiet(quiet=True):
+    INSTRUMENTATION.quiet = quiet
+
+def is_quiet():
+    return INSTRUMENTATION.quiet
+
+def span(name, **args):
+    return INSTRUMENTATION.span(name, **args)
+
+def count(name, value=1):
+    INSTRUMENTATION.count(name, value)
+
+def counters():
+    """
+    A snapshot of the counters of this process
+    """
+    return dict(INSTRUMENTATION.counters)
+
+def add_counters(counters):
+    INSTRUMENTATION.add_counters(counters)
+
+def progress(iterable=None, **kwargs):
+    return INSTRUMENTATION.progress(iterable, **kwargs)
+
+def timed(name=None):
+    """
+    Decorator, which puts every call of a function into a span
+
+    Keyword Args:
+        name (str) : the name of the span, the name of the
+                     function if not given
+    """
+    def decorator(func):
+        span_name = name or func.__name__
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            with INSTRUMENTATION.span(span_name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
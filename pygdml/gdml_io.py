@@ -0,0 +1,81 @@
+"""
+Open gdml files which are compressed with gzip, xz or zstd.
+The codec is chosen by the file extension, and the data is
+(de)compressed while it is read or written.
+"""
+
+import os.path
+import gzip
+import lzma
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# file extension -> codec
+CODECS = {'.gz'  : 'gzip',\
+          '.xz'  : 'xz',\
+          '.zst' : 'zstd'}
+
+##############################################################
+
+def get_codec(filename):
+    """
+    The compression codec of a file, None for plain text
+
+    Args:
+        filename (str) : e.g. 'foo.gdml.gz'
+    """
+    return CODECS.get(os.path.splitext(filename)[1], None)
+
+##############################################################
+
+def strip_codec(filename):
+    """
+    The filename without the extension of the compression
+    codec, e.g. 'foo.gdml.gz' -> 'foo.gdml'
+
+    Args:
+        filename (str) : the filename
+    """
+    if get_codec(filename) is None:
+        return filename
+    return os.path.splitext(filename)[0]
+
+##############################################################
+
+def open_file(filename, mode='rt', level=None):
+    """
+    Open a (possibly compressed) file, like the builtin open.
+
+    Args:
+        filename (str) : the file. If it ends with one of the
+                         extensions in CODECS, it is (de)compressed
+                         on the fly
+
+    Keyword Args:
+        mode (str)     : 'rt', 'rb', 'wt' or 'wb'
+        level (int)    : compression level when writing, if not given
+                         the default of the codec is used
+    """
+    codec = get_codec(filename)
+    if codec is None:
+        return open(filename, mode)
+    if 't' not in mode and 'b' not in mode:
+        mode += 't'
+    writing = ('w' in mode) or ('a' in mode)
+    if codec == 'gzip':
+        if writing and level is not None:
+            return gzip.open(filename, mode, compresslevel=level)
+        return gzip.open(filename, mode)
+    if codec == 'xz':
+        if writing and level is not None:
+            return lzma.open(filename, mode, preset=level)
+        return lzma.open(filename, mode)
+    if zstandard is None:
+        raise ImportError(f'Reading or writing {filename} requires the zstandard package!')
+    if writing:
+        cctx = zstandard.ZstdCompressor(level=3 if level is None else level)
+        return zstandard.open(filename, mode, cctx=cctx)
+    return zstandard.open(filename, mode)
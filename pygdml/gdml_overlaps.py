@@ -0,0 +1,272 @@
+"""
+Check placed solids for overlaps, without Geant4. This follows
+what G4PVPlacement::CheckOverlaps does: points are sampled on the
+surface of each volume, and every point which lies inside one of
+the other volumes is an overlap. Candidate pairs are found with a
+bounding volume hierarchy over the world space bounding boxes.
+"""
+
+import dataclasses
+import multiprocessing
+
+import numpy as np
+
+from .gdml_instrument import progress
+from .gdml_decimate import distance_to_surface, sample_surface, LENGTH_UNITS
+
+##############################################################
+
+@dataclasses.dataclass
+class Overlap:
+    """
+    A volume, which reaches into another one
+    """
+    volume      : str
+    other       : str
+    # the maximum depth of the sampled points
+    depth       : float
+    # the deepest point in the frame of the volume
+    local_point : tuple
+    # the same point in the world frame
+    world_point : tuple
+    # how many of the sampled points are inside the other volume
+    npoints     : int = 1
+
+    def __str__(self):
+        x, y, z = self.local_point
+        return f'Overlap is detected for volume {self.volume} with {self.other} volume\'s\n'\
+               f'          local point ({x:.6g},{y:.6g},{z:.6g}), overlapping by at least: {self.depth:.6g} mm'
+
+##############################################################
+
+def world_mesh(physvol):
+    """
+    The vertices of the solid of a physvol in the world frame
+    (in mm), and its facets.
+
+    Args:
+        physvol (GdmlPhysVol) : a physvol with a tessellated solid
+
+    Returns:
+        tuple (np.ndarray, np.ndarray, np.ndarray, np.ndarray) :
+            vertices, faces, the 3x3 matrix (rotation and scale) and the translation
+    """
+    scale = np.ones(3) if physvol.scale is None else np.asarray(physvol.scale, dtype=float)
+    matrix = physvol.orientation.matrix @ np.diag(scale)
+    translation = np.asarray(physvol.position, dtype=float)
+    vertices = LENGTH_UNITS[physvol.solid.unit or 'mm'] * physvol.solid.vertices
+    vertices = vertices @ matrix.T + translation
+    return vertices, np.asarray(physvol.solid.faces, dtype=np.int64), matrix, translation
+
+##############################################################
+
+class AABBTree(object):
+    """
+    A bounding volume hierarchy over axis aligned boxes. Every
+    node splits its boxes at the median of their centers along
+    the longest axis.
+    """
+
+    def __init__(self, lower, upper, leafsize=4):
+        """
+        Args:
+            lower (np.ndarray) : (N,3) lower corners of the boxes
+            upper (np.ndarray) : (N,3) upper corners of the boxes
+
+        Keyword Args:
+            leafsize (int)     : maximum number of boxes in a leaf
+        """
+        self.lower = np.asarray(lower, dtype=float)
+        self.upper = np.asarray(upper, dtype=float)
+        self.leafsize = leafsize
+        # per node: lower and upper corner, children and the boxes in the leaves
+        self.node_lower = []
+        self.node_upper = []
+        self.children = []
+        self.boxes = []
+        if len(self.lower):
+            self._build(np.arange(len(self.lower)))
+
+    def _build(self, index):
+        node = len(self.node_lower)
+        self.node_lower.append(self.lower[index].min(axis=0))
+        self.node_upper.append(self.upper[index].max(axis=0))
+        self.children.append(None)
+        self.boxes.append(index)
+        if len(index) > self.leafsize:
+            centers = 0.5 * (self.lower[index] + self.upper[index])
+            axis = np.argmax(self.node_upper[node] - self.node_lower[node])
+            order = index[np.argsort(centers[:, axis], kind='stable')]
+            half = len(order) // 2
+            self.children[node] = (self._build(order[:half]), self._build(order[half:]))
+        return node
+
+    def _touch(self, a, b):
+        return (self.node_lower[a] <= self.node_upper[b]).all() and\
+               (self.node_lower[b] <= self.node_upper[a]).all()
+
+    def pairs(self):
+        """
+        All pairs of boxes which touch each other
+
+        Returns:
+            list : sorted tuples of box indices (i, j) with i < j
+        """
+        if not self.node_lower:
+            return []
+        result = set()
+        stack = [(0, 0)]
+        while stack:
+            a, b = stack.pop()
+            if not self._touch(a, b):
+                continue
+            leaf_a, leaf_b = self.children[a] is None, self.children[b] is None
+            if leaf_a and leaf_b:
+                for i in self.boxes[a]:
+                    for j in self.boxes[b]:
+                        if (a == b) and (i >= j):
+                            continue
+                        if (self.lower[i] <= self.upper[j]).all() and\
+                           (self.lower[j] <= self.upper[i]).all():
+                            result.add((int(min(i, j)), int(max(i, j))))
+            elif a == b:
+                left, right = self.children[a]
+                stack.extend([(left, left), (right, right), (left, right)])
+            elif leaf_b or ((not leaf_a) and len(self.boxes[a]) >= len(self.boxes[b])):
+                left, right = self.children[a]
+                stack.extend([(left, b), (right, b)])
+            else:
+                left, right = self.children[b]
+                stack.extend([(a, left), (a, right)])
+        return sorted(result)
+
+##############################################################
+
+def winding_number(points, vertices, faces, chunksize=2**22):
+    """
+    The generalized winding number of a closed triangle mesh
+    for each point, it is 1 inside and 0 outside.
+
+    Args:
+        points (np.ndarray)   : (N,3) points to check
+        vertices (np.ndarray) : (M,3) vertices of the mesh
+        faces (np.ndarray)    : (K,3) facets of the mesh
+
+    Keyword Args:
+        chunksize (int)       : number of point/facet combinations
+                                which are computed at once
+    """
+    triangles = vertices[faces]
+    result = np.zeros(len(points))
+    step = max(1, chunksize // max(1, len(faces)))
+    for start in range(0, len(points), step):
+        p = points[start:start + step, None, :]
+        a = triangles[None, :, 0] - p
+        b = triangles[None, :, 1] - p
+        c = triangles[None, :, 2] - p
+        la = np.linalg.norm(a, axis=2)
+        lb = np.linalg.norm(b, axis=2)
+        lc = np.linalg.norm(c, axis=2)
+        det = np.einsum('ijk,ijk->ij', a, np.cross(b, c))
+        div = la * lb * lc + np.einsum('ijk,ijk->ij', a, b) * lc\
+                           + np.einsum('ijk,ijk->ij', b, c) * la\
+                           + np.einsum('ijk,ijk->ij', c, a) * lb
+        result[start:start + step] = np.arctan2(det, div).sum(axis=1) / (2 * np.pi)
+    return result
+
+##############################################################
+
+# the placed meshes, set in each worker process
+_MESHES = None
+
+def _init_worker(meshes):
+    global _MESHES
+    _MESHES = meshes
+
+def _check_pair(args):
+    """
+    Check if the volume with index i reaches into the one with index j
+    """
+    i, j, resolution, tolerance, seed = args
+    names, vertices, faces, matrices, translations = zip(*[_MESHES[k] for k in (i, j)])
+    rng = np.random.default_rng(seed)
+    points = sample_surface(vertices[0], faces[0], resolution, rng)
+    lower, upper = vertices[1].min(axis=0), vertices[1].max(axis=0)
+    in_box = ((points >= lower - tolerance) & (points <= upper + tolerance)).all(axis=1)
+    points = points[in_box]
+    if not len(points):
+        return None
+    points = points[winding_number(points, vertices[1], faces[1]) > 0.5]
+    if not len(points):
+        return None
+    depth = distance_to_surface(points, vertices[1], faces[1])
+    deep = depth > tolerance
+    if not deep.any():
+        return None
+    k = np.argmax(depth)
+    world_point = points[k]
+    local_point = np.linalg.solve(matrices[0], world_point - translations[0])
+    return Overlap(names[0], names[1], float(depth[k]),\
+                   tuple(local_point.tolist()),\
+                   tuple(world_point.tolist()),\
+                   int(deep.sum()))
+
+##############################################################
+
+def check_overlaps(physvols, resolution=1000, tolerance=0., jobs=1, seed=42, verbose=True):
+    """
+    Check placed solids for overlaps, similar to Geant4's
+    CheckOverlaps(resolution, tolerance, verbose). Every volume
+    is checked against all the volumes which its bounding box
+    touches, in both directions. Only tessellated solids are
+    checked, and the mother volume (the world) is not.
+
+    Args:
+        physvols (list or GdmlFileMinimal) : list of GdmlPhysVol, or a file,
+                                             then all of its physvols are checked
+
+    Keyword Args:
+        resolution (int)  : number of points sampled on each surface
+        tolerance (float) : overlaps which are not deeper than this are ignored
+        jobs (int)        : number of worker processes
+        seed (int)        : seed for the random points, the result
+                            is the same for every number of jobs
+        verbose (bool)    : print the report like Geant4 does
+
+    Returns:
+        list : list of Overlap
+    """
+    if hasattr(physvols, 'physvols'):
+        physvols = physvols.physvols
+    physvols = [k for k in physvols if getattr(k.solid, 'nfaces', 0)]
+    meshes = []
+    for pv in physvols:
+        vertices, faces, matrix, translation = world_mesh(pv)
+        meshes.append((pv.physvol_name, vertices, faces, matrix, translation))
+    lower = np.array([k[1].min(axis=0) for k in meshes]).reshape(-1, 3)
+    upper = np.array([k[1].max(axis=0) for k in meshes]).reshape(-1, 3)
+    pairs = AABBTree(lower - tolerance, upper + tolerance).pairs()
+    tasks = [(i, j, resolution, tolerance, seed + i) for i, j in pairs] +\
+            [(j, i, resolution, tolerance, seed + j) for i, j in pairs]
+    tasks = sorted(tasks)
+
+    if jobs <= 1:
+        _init_worker(meshes)
+        results = [_check_pair(k) for k in progress(tasks, desc='Checking overlaps..')]
+    else:
+        with multiprocessing.Pool(jobs, initializer=_init_worker, initargs=(meshes,)) as pool:
+            results = list(progress(pool.imap(_check_pair, tasks, chunksize=max(1, len(tasks) // (4 * jobs))),\
+                                     total=len(tasks), desc='Checking overlaps..'))
+    overlaps = [k for k in results if k is not None]
+
+    if verbose:
+        overlapping = {k.volume for k in overlaps}
+        for name, *_ in meshes:
+            if name in overlapping:
+                print(f'Checking overlaps for volume {name} ... OVERLAP!')
+                for k in overlaps:
+                    if k.volume == name:
+                        print(k)
+            else:
+                print(f'Checking overlaps for volume {name} ... OK!')
+    return overlaps
@@ -4,12 +4,14 @@ Extract and parser certain entities from a gdml file
 
 
 import bs4
+import dataclasses
 import vectormath as vm
-import tqdm
 import numpy as np
 import rich
 import hjson
 
+from lxml import etree
+
 import logging
 LOG = logging
 try:
@@ -21,89 +23,178 @@ except ImportError:
     pass
 
 from .gdml_solid import GdmlTessellatedSolid
+from .gdml_similarity import compare_mesh
+from .gdml_io import open_file
+from .gdml_instrument import timed, count, progress
+from .gdml_tags import GDML_DEFAULTS, with_defaults
 
 from copy import copy, deepcopy
 
 ################################################################
 
+class PrefixTrie(object):
+    """
+    A character trie of names, to find all names which are
+    a prefix of a given string in O(len(string))
+    """
+
+    # marks the end of a name in a node
+    _END = '\x00'
+
+    def __init__(self, names=()):
+        self.root = dict()
+        for k in names:
+            self.add(k)
+
+    def add(self, name):
+        node = self.root
+        for char in name:
+            node = node.setdefault(char, dict())
+        node[self._END] = name
+
+    def prefixes(self, string):
+        """
+        All names which are a prefix of string, shortest first.
+        The string itself is included if it is one of the names.
+        """
+        found = []
+        node = self.root
+        if self._END in node:
+            found.append(node[self._END])
+        for char in string:
+            node = node.get(char)
+            if node is None:
+                break
+            if self._END in node:
+                found.append(node[self._END])
+        return found
+
+################################################################
+
+@dataclasses.dataclass
+class PartGroup:
+    """
+    The solids whose names start with the same (generalized) name
+    """
+    name      : str
+    # the first of the solids
+    leader    : str
+    # the names of the other solids
+    followers : list
+    # the solids, with return_solids
+    solids    : list = None
+
+    def __len__(self):
+        return 1 + len(self.followers)
+
+@dataclasses.dataclass
+class UniqueNames:
+    """
+    The result of get_unique_names
+    """
+    # the unique (generalized) names, sorted
+    names  : list
+    # leader -> PartGroup
+    groups : dict
+
+    def print(self):
+        """
+        Show the names and the groups on the console
+        """
+        print(f'We found {len(self.names)} unique names!')
+        print('[')
+        for k in self.names:
+            print(k)
+        print(']')
+        console = rich.get_console()
+        for k, group in self.groups.items():
+            console.print(f'{k} x {len(group)}:', style='bold underline')
+            print(f'--{k} [leader]')
+            for j in group.followers:
+                print(f'-- --{j} [follower]')
+
+################################################################
+
 def get_unique_names(tessell_list,
                      metainfo=None,
-                     return_solids=False):
+                     return_solids=False,
+                     verbose=True):
     """
+    Group the solids by their generalized names (the part of the name
+    before __uid, or the functional parts of the meta info). Every
+    solid whose name starts with one of the names, is a member of the
+    group of the first (shortest) of these names. The first solid of
+    a group is its leader, the others are its followers. Names which
+    are themselves the name of a solid in another group don't get
+    a group.
+
+    Args:
+        tessell_list (list)  : list of GdmlTessellatedSolid
 
     Keyword Args:
         metainfo (str)       : filename for .json file with
                                meta info
-        return_solids (bool) : return the actual solids as well
-
+        return_solids (bool) : return the actual solids as well. With meta
+                               info, the material and position of the
+                               functional part are applied to them.
+        verbose (bool)       : print the names and the groups
 
+    Returns:
+        UniqueNames
     """
+    parts = None
     if metainfo is not None:
-        metainfo = hjson.load(open(metainfo))
-
-    names = [k.name for k in tessell_list if k.name != 'NONE']
-    names = [k.split('__uid')[0] for k in names]
-    # names = [''.join([i for i in s if not i.isdigit()]) for s in names]
-    names = set(names)
-    names = [k for k in set(names)]
-    if metainfo is not None:
-        names = metainfo['functional_parts'].keys()
+        with open(metainfo) as f:
+            metainfo = hjson.load(f)
         parts = metainfo['functional_parts']
-    print(f'We found {len(names)} unique names!')
-    print('[')
-    for k in sorted(names):
-        print(k)
-    print(']')
-
-    all_followers = []
-    group = dict()
+        names = sorted(parts.keys())
+    else:
+        names = sorted(set([k.name.split('__uid')[0] for k in tessell_list if k.name != 'NONE']))
+
+    trie = PrefixTrie(names)
+    solid_names = set([k.name for k in tessell_list])
+    # names sort before the names they are a prefix of, so
+    # the prefixes of a name are always checked before it.
+    # A name is skipped, if it is the name of a solid which
+    # is taken by a shorter name already
+    skipped = set()
     for k in names:
-        if k in all_followers:
+        if (k in solid_names) and\
+           any([(j != k) and (j not in skipped) for j in trie.prefixes(k)]):
+            skipped.add(k)
+
+    # name -> solids which start with the name (the shortest
+    # one which is not skipped), and solids with exactly the name
+    members = {k: [] for k in names}
+    namesakes = {k: [] for k in names}
+    for solid in tessell_list:
+        for k in trie.prefixes(solid.name):
+            if k == solid.name:
+                namesakes[k].append(solid)
+            elif k not in skipped:
+                members[k].append(solid)
+                break
+
+    groups = dict()
+    for k in names:
+        if (k in skipped) or (not members[k]):
             continue
-        print(f'Checking {k}')
-        followers = [j.name for j in tessell_list if ((j.name.startswith(k) and (j.name != k)))]
-        followers = [j for j in followers if (not j in all_followers)]
+        followers = [j.name for j in members[k]]
+        group = PartGroup(k, followers[0], followers[1:])
         if return_solids:
-            followers_solids = [t for t in tessell_list if ((t.name in followers) or (t.name == k))]
-            if 'position_sequence' in parts[k]:
-                position_sequence = parts[k]['position_sequence']
-                print(position_sequence)
-                for pos in position_sequence:
+            group.solids = namesakes[k] + members[k]
+            if parts is not None:
+                if parts[k].get('position_sequence'):
+                    pos = parts[k]['position_sequence'][-1]
                     pos = (float(pos[0]), float(pos[1]), float(pos[2]))
-                [t.translate(*pos) for t in followers_solids]
-                # materials
-            [t.set_material(parts[k]['material']) for t in followers_solids]
-        all_followers.extend(followers)
-        print(f'-- found {len(followers)} followers...')
-        if return_solids:
-            if len(followers) > 1:
-                group[followers[0]] = (followers[1:], followers_solids)
-            elif len(followers) == 1:
-                group[followers[0]] = (followers, followers_solids)
-            else:
-                continue
-        else:
-            if len(followers) > 1:
-                group[followers[0]] = followers[1:]
-            elif len(followers) == 1:
-                group[followers[0]] = followers
-            else:
-                continue
+                    [t.translate(*pos) for t in group.solids]
+                [t.set_material(parts[k]['material']) for t in group.solids]
+        groups[group.leader] = group
 
-    console = rich.get_console()
-    for k in group:
-        if return_solids:
-            console.print(f'{k} x {len(group[k][0]) + 1}:', style='bold underline')
-            print(f'--{k} [leader]')
-            for j in group[k][0]:
-                print(f'-- --{j} [follower]')
-        else:
-            console.print(f'{k} x {len(group[k]) + 1}:', style='bold underline')
-            print(f'--{k} [leader]')
-            for j in group[k]:
-                print(f'-- --{j} [follower]')
-
-    return group
+    result = UniqueNames(names, groups)
+    if verbose:
+        result.print()
+    return result
 
 ################################################################
 
@@ -115,17 +206,7 @@ def is_world(name):
 ################################################################
 
 
-def compare_mesh(a, b):
-    """
-    Quadratic array comparator
-    """
-    assert (len(a) == len(b))
-    vals = [np.sqrt((a[k] - b[k]) ** 2) for k in range(len(a))]
-    return sum(vals)
-
-##################################
-
-
+@timed()
 def extract_tessellated_solids(cursor, \
                                solid_tags_to_write=[], \
                                tags_to_write=[],
@@ -147,9 +228,8 @@ def extract_tessellated_solids(cursor, \
     nkids = len(cursor.findAll())
     ntess = 0  # how many tesseleated solids
     all_tessell_solids = []
-    pbar = tqdm.tqdm(total=nkids)
+    pbar = progress(total=nkids)
     while cursor is not None:
-        print(cursor.name)
         if cursor.name == 'define':
             # cursor = cursor.findNextSibling()
             # continue
@@ -168,7 +248,7 @@ def extract_tessellated_solids(cursor, \
             # so for now let's try this
             # gt_solid.set_tolerance(1e-09)
             gt_solid.tolerance = 1e-9
-            for j, vertex in enumerate(cursor.findChildren()):
+            for vertex in cursor.findChildren():
                 if 'name' in vertex.attrs:
                     if vertex.attrs['name'] == 'center':
                         deftag = bs4.element.Tag(name='define')
@@ -177,14 +257,11 @@ def extract_tessellated_solids(cursor, \
                         continue
 
                 # print (vertex)
-                vtuple = (float(vertex.attrs['x']), \
-                          float(vertex.attrs['y']), \
-                          float(vertex.attrs['z']))
-                gt_solid.unit = vertex.attrs['unit']
-                vtuple_vec = vm.Vector3(*vtuple)
-                gt_solid.vertices.append(vtuple)
-                gt_solid.named_vertices[vertex.attrs['name']] = vtuple_vec
-                gt_solid.indizes[vertex.attrs['name']] = j
+                gt_solid.add_vertex(vertex.attrs['name'],\
+                                    float(vertex.attrs['x']),\
+                                    float(vertex.attrs['y']),\
+                                    float(vertex.attrs['z']),\
+                                    unit=vertex.attrs.get('unit', GDML_DEFAULTS['position']['unit']))
             cursor = cursor.findNextSibling()
             continue
 
@@ -207,27 +284,26 @@ def extract_tessellated_solids(cursor, \
                         continue
 
                 if kiddo.name == 'tessellated':
-                    gt_solid.tessell_attrs = kiddo.attrs
+                    gt_solid.tessell_attrs = with_defaults('tessellated', kiddo.attrs)
                     gt_solid.name = kiddo.attrs['name']
                     ntess += 1
                     continue
                 if kiddo.name == 'triangular':
-                    gt_solid.triangular_attrs = kiddo.attrs
-                    v1 = kiddo.attrs['vertex1']
-                    v2 = kiddo.attrs['vertex2']
-                    v3 = kiddo.attrs['vertex3']
-                    gt_solid.vertex_names.append((v1, v2, v3))
-                    gt_solid.triangles.append((gt_solid.named_vertices[v1], \
-                                               gt_solid.named_vertices[v2], \
-                                               gt_solid.named_vertices[v3]))
-                    gt_solid.faces.append([gt_solid.indizes[v1], gt_solid.indizes[v2], gt_solid.indizes[v3]])
+                    gt_solid.add_triangular(kiddo.attrs['vertex1'],\
+                                            kiddo.attrs['vertex2'],\
+                                            kiddo.attrs['vertex3'],\
+                                            attrs=with_defaults('triangular', kiddo.attrs))
 
             # don't extract corrupt solids
             if not gt_solid.nvertices:
-                print(f'WARNING {gt_solid.name} has 0 vertices!')
+                LOG.warning(f'{gt_solid.name} has 0 vertices!')
                 cursor = cursor.findNextSibling()
                 continue
+            count('solids_read')
+            count('facets_read', gt_solid.nfaces)
             all_tessell_solids.append(deepcopy(gt_solid))
+            # the vertex names are not needed anymore
+            all_tessell_solids[-1].indizes.clear()
             del gt_solid
             cursor = cursor.findNextSibling()
             # break
@@ -246,3 +322,256 @@ def extract_tessellated_solids(cursor, \
     return all_tessell_solids
 
 
+
+##################################
+
+# the available backends to read tessellated solids
+# from a file
+PARSERS = ('bs4', 'lxml')
+
+# increase whenever the parsers produce different solids
+# for the same file, e.g. for cached results
+PARSER_VERSION = 1
+
+def _to_bs4_tag(element, keep_namespaces=False):
+    """
+    Convert an lxml element into a (detached) bs4.element.Tag,
+    so that it can be handled like the tags from the bs4 parser.
+
+    Args:
+        element (lxml.etree._Element) : the element to convert
+
+    Keyword Args:
+        keep_namespaces (bool) : keep the xmlns declarations
+    """
+    soup = bs4.BeautifulSoup(etree.tostring(element), features="lxml-xml")
+    tag = copy(soup.find(etree.QName(element).localname))
+    if keep_namespaces:
+        return tag
+    # tostring repeats the namespace declarations of
+    # the parents, we don't want them in the copy
+    for key in [k for k in tag.attrs if k.startswith('xmlns')]:
+        del tag.attrs[key]
+    return tag
+
+##################################
+
+
+def _iterparse(filename, **kwargs):
+    """
+    lxml.etree.iterparse for plain and compressed files,
+    the file is decompressed while it is parsed
+    """
+    with open_file(filename, 'rb') as handle:
+        for item in etree.iterparse(handle, **kwargs):
+            yield item
+
+##################################
+
+
+def read_root_tag(filename):
+    """
+    Get the (empty) <gdml> root tag of a file together with its
+    attributes, without reading the rest of the file.
+
+    Args:
+        filename (str) : The gdml file to read
+    """
+    for _, root in _iterparse(filename, events=('start',)):
+        empty_root = etree.Element(root.tag, attrib=root.attrib, nsmap=root.nsmap)
+        return _to_bs4_tag(empty_root, keep_namespaces=True)
+
+##################################
+
+
+@timed()
+def read_section_tag(filename, section):
+    """
+    Get the first top level section of a file, e.g. the
+    <materials>, as bs4 tag. The file is only read up to
+    the end of that section.
+
+    Args:
+        filename (str) : The gdml file to read
+        section (str)  : the name of the section
+
+    Raises:
+        IndexError : if there is no such section
+    """
+    depth = 0
+    for event, element in _iterparse(filename, events=('start', 'end'), remove_comments=True):
+        if event == 'start':
+            depth += 1
+            continue
+        depth -= 1
+        if depth != 1:
+            continue
+        tag = element.tag
+        if tag[0] == '{':
+            tag = tag.split('}', 1)[1]
+        if tag == section:
+            return _to_bs4_tag(element)
+        element.clear()
+    raise IndexError(f'There is no <{section}> section in {filename}')
+
+##################################
+
+
+@timed()
+def extract_tessellated_solids_lxml(filename, \
+                                    solid_tags_to_write=None, \
+                                    tags_to_write=None,
+                                    tessellsolid_identifier=0):
+    """
+    Streaming version of extract_tessellated_solids. The file is read
+    with lxml.etree.iterparse, and every element is cleared as soon as
+    it has been consumed, so the memory footprint does not grow with
+    the size of the file. The resulting list of tessellated solids is
+    the same as the one from extract_tessellated_solids.
+
+    Args:
+        filename (str) : The gdml file to read, can be compressed
+                         (see gdml_io.CODECS)
+    Keyword Args:
+        solid_tags_to_write (list, MUTABLE) : [it will be used to append tags]
+        tags_to_write (list, MUTABLE)       : [it will be used to append tags]
+        tessellsolid_identifier (int)       : the identifier of the first solid
+    """
+    if solid_tags_to_write is None:
+        solid_tags_to_write = []
+    if tags_to_write is None:
+        tags_to_write = []
+
+    ntess = 0  # how many tesseleated solids
+    all_tessell_solids = []
+    gt_solid = None
+    section = None
+    depth = 0
+    for event, element in _iterparse(filename,\
+                                     events=('start', 'end'),\
+                                     remove_comments=True):
+        tag = element.tag
+        if tag[0] == '{':
+            tag = tag.split('}', 1)[1]
+        if event == 'start':
+            depth += 1
+            if depth == 2:
+                section = tag
+                if tag == 'define':
+                    # if we saw more than one tesselated solid
+                    # per define section, the whole shebang
+                    # blows up.
+                    if ntess > 1:
+                        raise ValueError(f'Too many tessellated solids per define section! {ntess}')
+                    ntess = 0
+                    gt_solid = GdmlTessellatedSolid(identifier=tessellsolid_identifier)
+                    tessellsolid_identifier += 1
+                    gt_solid.tolerance = 1e-9
+                elif (tag == 'solids') and (gt_solid is None):
+                    gt_solid = GdmlTessellatedSolid(identifier=tessellsolid_identifier)
+                    tessellsolid_identifier += 1
+                    gt_solid.tolerance = 1e-9
+            elif (depth == 3) and (section == 'solids') and (tag == 'tessellated'):
+                # the attributes are complete at the start
+                # event, the facets follow as children
+                gt_solid.tessell_attrs = with_defaults('tessellated', element.attrib)
+                gt_solid.name = element.attrib['name']
+                ntess += 1
+            continue
+
+        depth -= 1
+        if depth == 1:
+            if section == 'solids':
+                # don't extract corrupt solids
+                if not gt_solid.nvertices:
+                    LOG.warning(f'{gt_solid.name} has 0 vertices!')
+                else:
+                    count('solids_read')
+                    count('facets_read', gt_solid.nfaces)
+                    # the vertex names are not needed anymore
+                    gt_solid.indizes.clear()
+                    all_tessell_solids.append(gt_solid)
+                gt_solid = None
+            elif section != 'define':
+                # we need to keep the other tags
+                # e.g. setup and so on
+                LOG.debug(f'Register {tag} for copy...')
+                tags_to_write.append(_to_bs4_tag(element))
+            section = None
+        elif section == 'define' and depth == 2:
+            if element.get('name') == 'center':
+                deftag = bs4.element.Tag(name='define')
+                deftag.append(_to_bs4_tag(element))
+                solid_tags_to_write.append(deftag)
+            else:
+                gt_solid.add_vertex(element.get('name'),\
+                                    float(element.get('x')),\
+                                    float(element.get('y')),\
+                                    float(element.get('z')),\
+                                    unit=element.get('unit', GDML_DEFAULTS['position']['unit']))
+        elif section == 'solids' and depth == 2:
+            if element.get('name') == 'worldbox':
+                soltag = bs4.element.Tag(name='solids')
+                soltag.append(_to_bs4_tag(element))
+                solid_tags_to_write.append(soltag)
+        elif section == 'solids' and depth == 3 and tag == 'triangular':
+            attrs = None
+            if not gt_solid.triangular_attrs:
+                attrs = with_defaults('triangular', element.attrib)
+            gt_solid.add_triangular(element.get('vertex1'),\
+                                    element.get('vertex2'),\
+                                    element.get('vertex3'),\
+                                    attrs=attrs)
+        else:
+            # keep the whole subtree until the section is done
+            continue
+
+        # we are done with this element, so throw it
+        # away together with everything we have seen before
+        element.clear()
+        while element.getprevious() is not None:
+            del element.getparent()[0]
+    return all_tessell_solids
+
+##################################
+
+
+def extract_tessellated_solids_from_file(filename,\
+                                         solid_tags_to_write=None,\
+                                         tags_to_write=None,\
+                                         tessellsolid_identifier=0,\
+                                         parser='bs4'):
+    """
+    Open a gdml file and extract all tessellated solids with
+    the chosen parser backend.
+
+    Args:
+        filename (str) : The gdml file to read
+    Keyword Args:
+        solid_tags_to_write (list, MUTABLE) : [it will be used to append tags]
+        tags_to_write (list, MUTABLE)       : [it will be used to append tags]
+        tessellsolid_identifier (int)       : the identifier of the first solid
+        parser (str)                        : either 'bs4' (builds the whole tree)
+                                              or 'lxml' (streaming, for large files)
+    """
+    if solid_tags_to_write is None:
+        solid_tags_to_write = []
+    if tags_to_write is None:
+        tags_to_write = []
+    if parser == 'lxml':
+        return extract_tessellated_solids_lxml(filename,\
+                                               solid_tags_to_write=solid_tags_to_write,\
+                                               tags_to_write=tags_to_write,\
+                                               tessellsolid_identifier=tessellsolid_identifier)
+    if parser != 'bs4':
+        raise ValueError(f'Do not understand parser {parser}. Has to be one of {PARSERS}')
+
+    with open_file(filename) as handle:
+        gdml = bs4.BeautifulSoup(handle, features="lxml-xml")
+    cursor = gdml.gdml.find_next()
+    all_tessell_solids = extract_tessellated_solids(cursor,\
+                                                    solid_tags_to_write=solid_tags_to_write,\
+                                                    tags_to_write=tags_to_write,\
+                                                    tessellsolid_identifier=tessellsolid_identifier)
+    del gdml
+    return all_tessell_solids
@@ -3,9 +3,13 @@ Gdml representation of geant4's physical volume
 """
 
 import bs4
+import types
+import numpy as np
 
 from .gdml_tags import PositionTag, ScaleTag, RotationTag
 from .gdml_file import GdmlFileMinimal
+from .gdml_rotation import Rotation, as_matrices, matrices_to_euler
+from .gdml_instrument import timed, count
 
 #class Rotation(object):
 
@@ -23,12 +27,25 @@ class GdmlPhysVol(object):
                  position,\
                  solid=None,\
                  material=None,\
-                 rotation={'x': 0,'y': 0, 'z' : 0},\
+                 rotation=None,\
                  scale=[1,1,1],
                  metadata=None,
                  counter=None):
         """
-
+        Args:
+            name (str)        : the name of the part
+            position (tuple)  : the position in the mother volume
+
+        Keyword Args:
+            solid             : the solid, e.g. GdmlTessellatedSolid
+            material (str)    : the name of the material
+            rotation          : the orientation, anything Rotation.coerce
+                                understands (gdml angles as dict, matrix,
+                                quaternion or Rotation). None is the identity.
+            scale (list)      : the scale factors
+            metadata (dict)   : 'generalized_name' and 'unique', parts which
+                                are not unique share a single solid
+            counter (int)     : makes the name of the physvol unique
         """
         self.name             = name
         self.volume_ref       = None
@@ -49,9 +66,79 @@ class GdmlPhysVol(object):
 
     ###############################################################
 
+    @property
+    def rotation(self):
+        """
+        The gdml angles of the orientation, see gdml_rotation.
+        They are computed from the orientation, so they can not be
+        changed in place: assign a new rotation or use add_rotation.
+
+        Returns:
+            types.MappingProxyType : read-only 'x', 'y', 'z' -> degree
+        """
+        return types.MappingProxyType(self.orientation.euler)
+
+    @rotation.setter
+    def rotation(self, rotation):
+        self.orientation = Rotation.coerce(rotation)
+
+    ###############################################################
+
+    @classmethod
+    def place_many(cls,\
+                   name,\
+                   positions,\
+                   rotations=None,\
+                   solid=None,\
+                   material=None,\
+                   scale=[1,1,1],\
+                   first_counter=0):
+        """
+        Place the same solid many times. The solid is written
+        only once, and the rotations are converted to gdml
+        angles all at once.
+
+        Args:
+            name (str)          : the name of the part
+            positions (list)    : (N,3) positions
+
+        Keyword Args:
+            rotations           : (N,3,3) matrices, (N,4) quaternions,
+                                  (N,3) gdml angles or a list of anything
+                                  Rotation.coerce understands
+            solid               : the solid which is placed
+            material (str)      : the name of the material
+            scale (list)        : the scale factors of all placements
+            first_counter (int) : the placements get continuous counters
+
+        Returns:
+            list : list of GdmlPhysVol
+        """
+        positions = np.asarray(positions, dtype=np.float64).reshape(-1, 3)
+        if rotations is None:
+            orientations = [Rotation() for _ in range(len(positions))]
+        else:
+            matrices = as_matrices(rotations)
+            if len(matrices) != len(positions):
+                raise ValueError(f'Got {len(positions)} positions, but {len(matrices)} rotations!')
+            angles = matrices_to_euler(matrices).tolist()
+            orientations = [Rotation(m, euler=dict(zip('xyz', a))) for m, a in zip(matrices, angles)]
+        physvols = []
+        for k, (position, orientation) in enumerate(zip(positions.tolist(), orientations)):
+            physvols.append(cls(name,\
+                                tuple(position),\
+                                solid=solid,\
+                                material=material,\
+                                rotation=orientation,\
+                                scale=scale,\
+                                metadata={'generalized_name' : name, 'unique' : False},\
+                                counter=first_counter + k))
+        return physvols
+
+    ###############################################################
+
     @property
     def is_unique_part(self):
-        print (self.metadata)
         return bool(self.metadata['unique'])
 
     ###############################################################
@@ -104,35 +191,100 @@ class GdmlPhysVol(object):
         physvol_t.append(vol_ref)
         pos_tag = PositionTag.create(self.position, name=self.physvol_name + '_pos')
         physvol_t.append(pos_tag)
+        # a physvol can only have a single rotation,
+        # which comes before the scale
+        angles = {axis : value for axis, value in self.rotation.items() if value != 0}
+        if angles:
+            rotation_tag = RotationTag.create(self.physvol_name + '_rot',\
+                                              angles=angles)
+            physvol_t.append(rotation_tag)
         if (self.scale != [1,1,1]) and (self.scale is not None):
             #print(self.scale)
             scale_tag = ScaleTag.create(self.scale, name=self.physvol_name + '_sca')
             physvol_t.append(scale_tag)
-        if self.rotation is not None:
-            for axis in self.rotation:
-                if self.rotation[axis] != 0:
-                    rotation_tag = RotationTag.create(self.physvol_name + '_rot',\
-                                                      axis=axis,\
-                                                      value=self.rotation[axis])
-
-                    physvol_t.append(rotation_tag)
         return physvol_t
 
     ###############################################################
 
+    def absorb_solid_transform(self):
+        """
+        Write the pending transform of the solid (see
+        GdmlTessellatedSolid.apply_transform) as position and scale
+        of this physvol, instead of moving all of its vertices.
+        The placement in the world does not change.
+
+        If the solid is placed by other physvols as well, use
+        absorb_solid_transforms instead: the transform is taken off
+        the solid here, so the other physvols would not get it.
+
+        Returns:
+            bool : False if the transform of the solid can not be
+                   expressed by a physvol (e.g. there is none)
+        """
+        if getattr(self.solid, '_transform', None) is None:
+            return False
+        translation, factors = self.solid.detach_transform()
+        if translation is None:
+            return False
+        self._absorb(translation, factors)
+        return True
+
+    def _absorb(self, translation, factors):
+        """
+        Put a translation and scaling of the solid
+        in front of the placement
+        """
+        scale = np.ones(3) if self.scale is None else np.asarray(self.scale, dtype=float)
+        # world = position + R @ (scale * (factors * v + translation))
+        offset = self.orientation.apply(scale * np.asarray(translation))
+        self.position = tuple((np.asarray(self.position, dtype=float) + offset).tolist())
+        self.scale = (scale * np.asarray(factors)).tolist()
+
+    ###############################################################
+
     def add_rotation(self, axis, value):
-        # rotation in degree
-        self.rotation[axis] += float(value)
+        """
+        Rotate around one of the axes of the mother volume,
+        on top of the current orientation
+
+        Args:
+            axis (str)    : 'x', 'y' or 'z'
+            value (float) : the gdml angle in degree
+        """
+        self.orientation = Rotation.from_euler({axis : float(value)}) @ self.orientation
 
     ###############################################################
 
-    def register_myself(self, gdml_file):
+    def place_in(self, rotation=None, position=(0, 0, 0)):
+        """
+        Move the placement into a parent frame, e.g. the placement
+        of a whole subassembly. Nested placements are composed exactly.
+
+        Keyword Args:
+            rotation        : the orientation of the parent frame
+            position (tuple): the position of the parent frame
+        """
+        parent = Rotation.coerce(rotation)
+        self.position = tuple((parent.apply(self.position) + np.asarray(position, dtype=np.float64)).tolist())
+        self.orientation = parent @ self.orientation
+
+    ###############################################################
+
+    @timed()
+    def register_myself(self, gdml_file, fast_tags=True):
         """
         Write the necessary tags to the gdml file
 
         Args:
             gdml_file:
 
+        Keyword Args:
+            fast_tags (bool) : emit the define and solid tags as
+                               preformatted text chunks instead of
+                               bs4 tags. The written file is the same,
+                               but only the chunks follow the output
+                               profile of the file.
+
         Returns:
             None
         """
@@ -142,22 +294,70 @@ class GdmlPhysVol(object):
         # we rename the solid, in case this part is not unique
         # the registry will take care that it gets registered
         # at least once
+        gdml_file.physvols.append(self)
         use_name = None
         if not self.is_unique_part:
             self.solid.name = self.generalized_name
             self.volume_ref = self.generalized_name + '_v'
             use_name        = self.generalized_name + '_s'
+            if self.generalized_name in gdml_file.generalized_part_names:
+                # the solid has been written already,
+                # only the placement is missing
+                gdml_file.add_physvol_tag(self.physvol_tag)
+                count('tags_emitted')
+                return
 
         # the solid might need additional infomartion
         # to be written to the file
         if self.solid.has_define_section:
-            for tag in self.solid.define_tags():
+            if fast_tags:
+                define_tags = self.solid.define_chunks(profile=gdml_file.profile)
+            else:
+                define_tags = self.solid.define_tags()
+            for tag in define_tags:
                 gdml_file.add_define_tag(tag,\
                                          generalized_part_name=self.generalized_name)
 
-        gdml_file.add_solid_tag(self.solid.solid_tag(use_name=use_name),\
+        if fast_tags:
+            solid_tag = self.solid.solid_chunk(use_name=use_name, profile=gdml_file.profile)
+        else:
+            solid_tag = self.solid.solid_tag(use_name=use_name)
+        gdml_file.add_solid_tag(solid_tag,\
                                 generalized_part_name=self.generalized_name)
-        gdml_file.add_physvol_tag(self.physvol_tag)
+        # the volume first, so that the physvol can refer to it
         gdml_file.add_volume_tag(self.solid.volume_tag(self.material),\
                                  generalized_part_name=self.generalized_name)
+        gdml_file.add_physvol_tag(self.physvol_tag)
+        # the physvol and the volume, the chunks count their own tags
+        count('tags_emitted', 2)
+
+##############################################################
+
+def absorb_solid_transforms(physvols):
+    """
+    Write the pending transforms of the solids as position and scale
+    of the physvols (see GdmlPhysVol.absorb_solid_transform), instead
+    of moving their vertices. A solid which is placed by several
+    physvols (e.g. the copies found by gdml_dedup) has its transform
+    taken off once, and it is added to all of its placements.
+
+    Args:
+        physvols (list) : list of GdmlPhysVol
 
+    Returns:
+        int : the number of solids whose transform has been absorbed
+    """
+    placements = dict()
+    for physvol in physvols:
+        if getattr(physvol.solid, '_transform', None) is not None:
+            placements.setdefault(id(physvol.solid), []).append(physvol)
+    nabsorbed = 0
+    for placed in placements.values():
+        translation, factors = placed[0].solid.detach_transform()
+        if translation is None:
+            continue
+        for physvol in placed:
+            physvol._absorb(translation, factors)
+        nabsorbed += 1
+    count('transforms_absorbed', nabsorbed)
+    return nabsorbed
@@ -0,0 +1,186 @@
+"""
+Run the per-solid processing steps of the compression
+pipeline, optionally spread over multiple processes.
+"""
+
+import multiprocessing
+
+import logging
+LOG = logging
+try:
+    import hepbasestack as hep
+    from . import __package_loglevel__
+    LOG = hep.logger.get_logger(__package_loglevel__)
+    del logging
+except ImportError:
+    pass
+
+from .gdml_solid import GdmlTessellatedSolid
+from .gdml_instrument import span, progress, count, counters, add_counters, enable, is_enabled
+
+# the attributes of a tessellated solid which are shipped
+# to the worker processes and back, next to the vertex
+# and face arrays and the derived properties which are
+# known already (see GdmlTessellatedSolid.derived_state).
+# No bs4 objects are involved.
+SOLID_STATE = ('name',\
+               '_identifier',\
+               'unit',\
+               'tolerance',\
+               'trafo_to_write',\
+               'position',\
+               'scalefactors',\
+               'ntriangles',\
+               'ninvalidtri',\
+               'nmerged',\
+               'nunreferenced',\
+               'decimation_report')
+
+##############################################################
+
+def clean_facets(solid):
+    """
+    Pipeline stage: remove the facets which are invalid for Geant4
+
+    Args:
+        solid (GdmlTessellatedSolid) : the solid to work on
+    """
+    if not solid.nvertices:
+        return
+    # in some cases, it can be that the world solid
+    # appears in the list of tessell solids as well.
+    # in that case it has a single vertice
+    if solid.nvertices == 1:
+        LOG.debug(f'Not fixing triangles for single vertex solid {solid.name}')
+        count('solids_skipped')
+        return
+    solid.remove_invalid_triangles()
+
+##############################################################
+
+def center_and_clean(solid):
+    """
+    Pipeline stage: move the solid to its center of mass, so that
+    it can be placed by a physvol, and remove invalid facets
+
+    Args:
+        solid (GdmlTessellatedSolid) : the solid to work on
+    """
+    solid.translate_to_center_mass()
+    solid.remove_invalid_triangles()
+
+##############################################################
+
+def weld(solid, tolerance=None):
+    """
+    Pipeline stage: merge vertices which are closer than the
+    tolerance and remove the ones which are not used.
+    Use functools.partial to set the tolerance for run_stage.
+
+    Args:
+        solid (GdmlTessellatedSolid) : the solid to work on
+
+    Keyword Args:
+        tolerance (float)            : see GdmlTessellatedSolid.weld
+    """
+    if not solid.nvertices:
+        return
+    solid.weld(tolerance=tolerance)
+
+##############################################################
+
+def decimate(solid, face_count=None, max_deviation=None):
+    """
+    Pipeline stage: reduce the number of facets, see
+    GdmlTessellatedSolid.decimate. Use functools.partial
+    to set the targets for run_stage.
+
+    Args:
+        solid (GdmlTessellatedSolid) : the solid to work on
+
+    Keyword Args:
+        face_count (int)             : target number of facets
+        max_deviation (float)        : maximum deviation in mm
+    """
+    if solid.nfaces < 4:
+        return
+    solid.decimate(face_count=face_count, max_deviation=max_deviation)
+
+##############################################################
+
+def _get_state(solid):
+    state = {k: getattr(solid, k) for k in SOLID_STATE}
+    # the transform stays pending, see GdmlTessellatedSolid.apply_transform
+    state['vertices'] = solid.local_vertices
+    state['transform'] = solid._transform
+    state['faces'] = solid.faces
+    # asking for anything which is not known yet
+    # would build the mesh
+    state['derived'] = solid.derived_state()
+    return state
+
+def _set_state(solid, state):
+    for k in SOLID_STATE:
+        setattr(solid, k, state[k])
+    solid.vertices = state['vertices']
+    solid.faces = state['faces']
+    if state.get('transform') is not None:
+        solid.apply_transform(state['transform'])
+    # the geometry has to be set first, it resets them
+    solid.set_derived_state(state.get('derived', dict()))
+
+def _init_worker(instrumented):
+    # count in the workers if the parent does
+    enable(instrumented)
+
+def _run_stage(args):
+    """
+    Executed in the worker processes. The counters raised by
+    the stage are sent back with the state, since the
+    instrumentation of the worker is not seen by the parent.
+    """
+    stage, state = args
+    solid = GdmlTessellatedSolid()
+    _set_state(solid, state)
+    before = counters()
+    stage(solid)
+    delta = {k: v - before.get(k, 0) for k, v in counters().items()\
+             if (k not in before) or (v != before[k])}
+    return _get_state(solid), delta
+
+##############################################################
+
+def run_stage(solids, stage, jobs=1, desc=None):
+    """
+    Apply a pipeline stage to every solid. With more than one
+    job, the solids are processed by a pool of worker processes.
+    Only the vertex/face arrays and a few scalar attributes are
+    sent to the workers, and the results are applied to the solids
+    in the original order, so the outcome is the same as for
+    a serial run.
+
+    Args:
+        solids (list)    : list of GdmlTessellatedSolid, will be changed in place
+        stage (callable) : a function taking a single solid. For jobs > 1 it has
+                           to be picklable, so a module level function
+
+    Keyword Args:
+        jobs (int)       : number of worker processes
+        desc (str)       : description for the progress bar
+    """
+    # functools.partial has no name
+    name = getattr(stage, '__name__', None) or stage.func.__name__
+    with span(f'run_stage:{name}', jobs=jobs, nsolids=len(solids)):
+        if jobs <= 1:
+            for solid in progress(solids, desc=desc):
+                stage(solid)
+            return solids
+
+        tasks = ((stage, _get_state(solid)) for solid in solids)
+        chunksize = max(1, len(solids) // (4 * jobs))
+        with multiprocessing.Pool(jobs, initializer=_init_worker, initargs=(is_enabled(),)) as pool:
+            results = pool.imap(_run_stage, tasks, chunksize=chunksize)
+            for solid, (state, delta) in zip(solids, progress(results, total=len(solids), desc=desc)):
+                _set_state(solid, state)
+                add_counters(delta)
+    return solids
@@ -0,0 +1,194 @@
+"""
+Book keeping of everything which has been added to a gdml file.
+Every kind of entry (elements, materials, solids, volumes) has
+its own registry, which is indexed by name and by a content key
+(e.g. the generalized name of a part, so that a solid which is
+placed several times is only written once). References between
+the entries (solidref, volumeref, materialref) are checked when
+a tag is added.
+"""
+
+import logging
+LOG = logging
+try:
+    import hepbasestack as hep
+    from . import __package_loglevel__
+    LOG = hep.logger.get_logger(__package_loglevel__)
+    del logging
+except ImportError:
+    pass
+
+# reference tag -> the kind of entry it refers to
+REFERENCES = {'solidref'    : 'solids',\
+              'volumeref'   : 'volumes',\
+              'materialref' : 'materials'}
+
+# tags of the materials section -> the kind of entry
+MATERIAL_TAGS = {'isotope'  : 'isotopes',\
+                 'element'  : 'elements',\
+                 'material' : 'materials'}
+
+##############################################################
+
+class Registry(object):
+    """
+    The entries of one kind, in the order they have been
+    added. Lookups by name and by content are O(1).
+    """
+
+    def __init__(self, kind):
+        """
+        Args:
+            kind (str) : e.g. 'solids', for the messages
+        """
+        self.kind = kind
+        # name -> item
+        self._names = dict()
+        # content key -> name
+        self._contents = dict()
+
+    def __contains__(self, name):
+        return name in self._names
+
+    def __len__(self):
+        return len(self._names)
+
+    def __iter__(self):
+        return iter(self._names)
+
+    def __repr__(self):
+        return f'<Registry {self.kind}: {len(self)} entries>'
+
+    def add(self, name, item=None, content=None):
+        """
+        Register an entry. A name which is already registered
+        is not registered again.
+
+        Args:
+            name (str)     : the name of the entry
+
+        Keyword Args:
+            item           : anything to keep with the name, e.g. the tag
+            content        : a (hashable) key of the content, e.g. the
+                             generalized name of a part
+
+        Returns:
+            bool : False if the name has been registered before
+        """
+        if content is not None and content not in self._contents:
+            self._contents[content] = name
+        if name in self._names:
+            return False
+        self._names[name] = item
+        return True
+
+    # the registries used to be lists
+    append = add
+
+    def update(self, names):
+        """
+        Register many entries at once
+
+        Args:
+            names (iterable) : names, or (name, item, content) tuples
+        """
+        for k in names:
+            if isinstance(k, tuple):
+                self.add(*k)
+            else:
+                self.add(k)
+
+    def get(self, name, default=None):
+        """
+        The item which has been registered with a name
+        """
+        return self._names.get(name, default)
+
+    def find(self, content):
+        """
+        The name of the first entry with this content key,
+        None if there is none
+        """
+        return self._contents.get(content)
+
+    @property
+    def contents(self):
+        """
+        All content keys, supports fast membership tests
+        """
+        return self._contents.keys()
+
+##############################################################
+
+class GeometryRegistry(object):
+    """
+    The registries of a gdml file. References which can not be
+    resolved when a tag is added are kept, since materials are
+    often added after the volumes which use them. They have to be
+    resolved before the file is written.
+    """
+
+    def __init__(self):
+        self.isotopes  = Registry('isotopes')
+        self.elements  = Registry('elements')
+        self.materials = Registry('materials')
+        # the defines are only registered by the part they belong to
+        self.defines   = Registry('defines')
+        self.solids    = Registry('solids')
+        self.volumes   = Registry('volumes')
+        # (referencing tag, reference tag, name) which could not be
+        # resolved when they were added
+        self.pending = []
+
+    def __getitem__(self, kind):
+        return getattr(self, kind)
+
+    def check(self, tag):
+        """
+        Look up all references of a tag and its children.
+        Unresolved references are kept, see resolve.
+
+        Args:
+            tag (bs4.element.Tag) : e.g. a <volume> or <physvol>
+
+        Returns:
+            bool : True if all references could be resolved
+        """
+        # TagChunks only refer to vertices
+        if not hasattr(tag, 'find_all'):
+            return True
+        refs = tag.find_all(list(REFERENCES))
+        if tag.name in REFERENCES:
+            refs.insert(0, tag)
+        resolved = True
+        for ref in refs:
+            name = ref.attrs.get('ref')
+            if name not in self[REFERENCES[ref.name]]:
+                self.pending.append((tag.attrs.get('name'), ref.name, name))
+                resolved = False
+        return resolved
+
+    def resolve(self):
+        """
+        Check the references which could not be resolved
+        when they were added once more
+
+        Returns:
+            list : (referencing tag, reference tag, name) of the
+                   references which are still unresolved
+        """
+        self.pending = [k for k in self.pending if k[2] not in self[REFERENCES[k[1]]]]
+        return self.pending
+
+    def register_materials(self, section):
+        """
+        Register the isotopes, elements and materials
+        of a <materials> section
+
+        Args:
+            section (bs4.element.Tag) : the <materials> tag
+        """
+        for tag in section.find_all(list(MATERIAL_TAGS), recursive=False):
+            name = tag.attrs.get('name')
+            if name is not None:
+                self[MATERIAL_TAGS[tag.name]].add(name, tag)
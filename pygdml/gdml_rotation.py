@@ -0,0 +1,359 @@
+"""
+Conversion between rotation matrices and the euler
+angles used in the gdml <rotation> tag.
+
+Geant4 builds the rotation of a physvol from the angles as
+    rot = Rz(z) * Ry(y) * Rx(x)
+and places the daughter with the inverse of that matrix.
+Here, all matrices are the (active) rotation of the daughter,
+so a vertex v of a solid ends up at R @ v + position.
+"""
+
+from collections.abc import Mapping
+
+import numpy as np
+
+##############################################################
+
+def _rx(angle):
+    c, s = np.cos(angle), np.sin(angle)
+    return np.array([[1, 0, 0], [0, c, -s], [0, s, c]])
+
+def _ry(angle):
+    c, s = np.cos(angle), np.sin(angle)
+    return np.array([[c, 0, s], [0, 1, 0], [-s, 0, c]])
+
+def _rz(angle):
+    c, s = np.cos(angle), np.sin(angle)
+    return np.array([[c, -s, 0], [s, c, 0], [0, 0, 1]])
+
+##############################################################
+
+def euler_to_matrix(rotation):
+    """
+    The rotation matrix of a gdml rotation
+
+    Args:
+        rotation (dict) : angles in degree for the axes 'x', 'y', 'z',
+                          missing axes are 0. None is the identity.
+
+    Returns:
+        np.ndarray : (3,3) rotation matrix
+    """
+    if rotation is None:
+        return np.eye(3)
+    x, y, z = [np.radians(float(rotation.get(axis, 0))) for axis in 'xyz']
+    return (_rz(z) @ _ry(y) @ _rx(x)).T
+
+##############################################################
+
+def matrix_to_euler(matrix, digits=10):
+    """
+    The gdml angles for a rotation matrix
+
+    Args:
+        matrix (np.ndarray) : (3,3) rotation matrix
+
+    Keyword Args:
+        digits (int)        : round the angles to this many digits,
+                              so that an identity gives exactly 0
+
+    Returns:
+        dict : angles in degree for the axes 'x', 'y', 'z'
+    """
+    n = np.asarray(matrix).T
+    if abs(n[2, 0]) < 1 - 1e-12:
+        y = -np.arcsin(n[2, 0])
+        x = np.arctan2(n[2, 1], n[2, 2])
+        z = np.arctan2(n[1, 0], n[0, 0])
+    else:
+        # gimbal lock, only x + z or x - z is defined
+        y = -np.sign(n[2, 0]) * np.pi / 2
+        x = np.arctan2(-n[1, 2], n[1, 1])
+        z = 0.
+    angles = [round(float(np.degrees(k)), digits) + 0. for k in (x, y, z)]
+    return dict(zip('xyz', angles))
+
+##############################################################
+
+def euler_to_matrices(angles):
+    """
+    The rotation matrices for many gdml rotations at once,
+    the same as euler_to_matrix
+
+    Args:
+        angles (np.ndarray) : (N,3) angles in degree for x, y, z
+
+    Returns:
+        np.ndarray : (N,3,3) rotation matrices
+    """
+    x, y, z = np.radians(np.asarray(angles, dtype=np.float64).reshape(-1, 3)).T
+    cx, sx = np.cos(x), np.sin(x)
+    cy, sy = np.cos(y), np.sin(y)
+    cz, sz = np.cos(z), np.sin(z)
+    # Rz @ Ry @ Rx
+    m = np.empty((len(x), 3, 3))
+    m[:, 0, 0] = cz*cy
+    m[:, 0, 1] = cz*sy*sx - sz*cx
+    m[:, 0, 2] = cz*sy*cx + sz*sx
+    m[:, 1, 0] = sz*cy
+    m[:, 1, 1] = sz*sy*sx + cz*cx
+    m[:, 1, 2] = sz*sy*cx - cz*sx
+    m[:, 2, 0] = -sy
+    m[:, 2, 1] = cy*sx
+    m[:, 2, 2] = cy*cx
+    return m.transpose(0, 2, 1)
+
+def matrices_to_euler(matrices, digits=10):
+    """
+    The gdml angles for many rotation matrices at once,
+    the same as matrix_to_euler
+
+    Args:
+        matrices (np.ndarray) : (N,3,3) rotation matrices
+
+    Keyword Args:
+        digits (int)          : round the angles to this many digits
+
+    Returns:
+        np.ndarray : (N,3) angles in degree for x, y, z
+    """
+    n = np.asarray(matrices, dtype=np.float64).reshape(-1, 3, 3).transpose(0, 2, 1)
+    regular = np.abs(n[:, 2, 0]) < 1 - 1e-12
+    y = np.where(regular,\
+                 -np.arcsin(np.clip(n[:, 2, 0], -1, 1)),\
+                 -np.sign(n[:, 2, 0]) * np.pi / 2)
+    # gimbal lock, only x + z or x - z is defined
+    x = np.where(regular,\
+                 np.arctan2(n[:, 2, 1], n[:, 2, 2]),\
+                 np.arctan2(-n[:, 1, 2], n[:, 1, 1]))
+    z = np.where(regular,\
+                 np.arctan2(n[:, 1, 0], n[:, 0, 0]),\
+                 0.)
+    return np.round(np.degrees(np.stack((x, y, z), axis=-1)), digits) + 0.
+
+##############################################################
+
+def quaternions_to_matrices(quaternions):
+    """
+    Rotation matrices from unit quaternions
+
+    Args:
+        quaternions (np.ndarray) : (N,4) quaternions as (w, x, y, z),
+                                   they get normalized
+
+    Returns:
+        np.ndarray : (N,3,3) rotation matrices
+    """
+    q = np.asarray(quaternions, dtype=np.float64).reshape(-1, 4)
+    w, x, y, z = (q / np.linalg.norm(q, axis=1)[:, None]).T
+    m = np.empty((len(w), 3, 3))
+    m[:, 0, 0] = 1 - 2*(y*y + z*z)
+    m[:, 0, 1] = 2*(x*y - z*w)
+    m[:, 0, 2] = 2*(x*z + y*w)
+    m[:, 1, 0] = 2*(x*y + z*w)
+    m[:, 1, 1] = 1 - 2*(x*x + z*z)
+    m[:, 1, 2] = 2*(y*z - x*w)
+    m[:, 2, 0] = 2*(x*z - y*w)
+    m[:, 2, 1] = 2*(y*z + x*w)
+    m[:, 2, 2] = 1 - 2*(x*x + y*y)
+    return m
+
+def matrices_to_quaternions(matrices):
+    """
+    Unit quaternions (w, x, y, z) with w >= 0 from rotation matrices
+
+    Args:
+        matrices (np.ndarray) : (N,3,3) rotation matrices
+
+    Returns:
+        np.ndarray : (N,4) quaternions
+    """
+    m = np.asarray(matrices, dtype=np.float64).reshape(-1, 3, 3)
+    # the largest of the four candidates is numerically stable
+    diag = np.stack((m[:, 0, 0] + m[:, 1, 1] + m[:, 2, 2],\
+                     m[:, 0, 0] - m[:, 1, 1] - m[:, 2, 2],\
+                     m[:, 1, 1] - m[:, 0, 0] - m[:, 2, 2],\
+                     m[:, 2, 2] - m[:, 0, 0] - m[:, 1, 1]), axis=-1)
+    best = np.argmax(diag, axis=1)
+    q = np.empty((len(m), 4))
+    for k in range(4):
+        sel = best == k
+        if not sel.any():
+            continue
+        s = m[sel]
+        r = np.sqrt(np.maximum(1 + diag[sel, k], 0.))
+        if k == 0:
+            q[sel] = np.stack((r/2,\
+                               (s[:, 2, 1] - s[:, 1, 2])/(2*r),\
+                               (s[:, 0, 2] - s[:, 2, 0])/(2*r),\
+                               (s[:, 1, 0] - s[:, 0, 1])/(2*r)), axis=-1)
+        elif k == 1:
+            q[sel] = np.stack(((s[:, 2, 1] - s[:, 1, 2])/(2*r),\
+                               r/2,\
+                               (s[:, 0, 1] + s[:, 1, 0])/(2*r),\
+                               (s[:, 0, 2] + s[:, 2, 0])/(2*r)), axis=-1)
+        elif k == 2:
+            q[sel] = np.stack(((s[:, 0, 2] - s[:, 2, 0])/(2*r),\
+                               (s[:, 0, 1] + s[:, 1, 0])/(2*r),\
+                               r/2,\
+                               (s[:, 1, 2] + s[:, 2, 1])/(2*r)), axis=-1)
+        else:
+            q[sel] = np.stack(((s[:, 1, 0] - s[:, 0, 1])/(2*r),\
+                               (s[:, 0, 2] + s[:, 2, 0])/(2*r),\
+                               (s[:, 1, 2] + s[:, 2, 1])/(2*r),\
+                               r/2), axis=-1)
+    q[q[:, 0] < 0] *= -1
+    return q
+
+##############################################################
+
+def as_matrices(rotations):
+    """
+    Rotation matrices from many rotations, given in one of
+    the supported forms
+
+    Args:
+        rotations : (N,3,3) matrices, (N,4) quaternions (w, x, y, z),
+                    (N,3) gdml angles in degree, or a list of
+                    anything Rotation.coerce understands
+
+    Returns:
+        np.ndarray : (N,3,3) rotation matrices
+    """
+    if isinstance(rotations, np.ndarray) and rotations.dtype != object:
+        if rotations.ndim == 3 and rotations.shape[1:] == (3, 3):
+            return rotations.astype(np.float64)
+        if rotations.ndim == 2 and rotations.shape[1] == 4:
+            return quaternions_to_matrices(rotations)
+        if rotations.ndim == 2 and rotations.shape[1] == 3:
+            return euler_to_matrices(rotations)
+        raise ValueError(f'Do not understand rotations of shape {rotations.shape}')
+    return np.array([Rotation.coerce(k).matrix for k in rotations]).reshape(-1, 3, 3)
+
+##############################################################
+
+class Rotation(object):
+    """
+    An orientation, stored as (active) rotation matrix, so that
+    rotations compose exactly (up to floating point) by matrix
+    multiplication, instead of adding up euler angles. The gdml
+    angles are only computed for the output. If the rotation has
+    been created from gdml angles, these are kept as they are.
+    """
+
+    __slots__ = ('matrix', '_euler')
+
+    def __init__(self, matrix=None, euler=None):
+        """
+        Keyword Args:
+            matrix (np.ndarray) : (3,3) rotation matrix, the identity if not given
+            euler (dict)        : the gdml angles of the matrix, if known
+        """
+        self.matrix = np.eye(3) if matrix is None else np.asarray(matrix, dtype=np.float64).reshape(3, 3)
+        self._euler = euler
+
+    @classmethod
+    def identity(cls):
+        return cls()
+
+    @classmethod
+    def from_euler(cls, angles):
+        """
+        Args:
+            angles (dict) : angles in degree for the axes 'x', 'y', 'z',
+                            missing axes are 0
+        """
+        return cls(euler_to_matrix(angles), euler=dict(angles))
+
+    @classmethod
+    def from_matrix(cls, matrix):
+        return cls(matrix)
+
+    @classmethod
+    def from_quaternion(cls, quaternion):
+        """
+        Args:
+            quaternion (tuple) : (w, x, y, z)
+        """
+        return cls(quaternions_to_matrices(quaternion)[0])
+
+    @classmethod
+    def from_axis_angle(cls, axis, angle):
+        """
+        Args:
+            axis (tuple)  : the rotation axis
+            angle (float) : the angle in degree (right hand rule)
+        """
+        axis = np.asarray(axis, dtype=np.float64)
+        half = np.radians(float(angle)) / 2.
+        axis = axis / np.linalg.norm(axis)
+        return cls.from_quaternion(np.append(np.cos(half), np.sin(half) * axis))
+
+    @classmethod
+    def coerce(cls, rotation):
+        """
+        Make a Rotation from whatever is given
+
+        Args:
+            rotation : None (identity), Rotation, dict (or any mapping)
+                       with gdml angles, (3,3) matrix or quaternion (w, x, y, z)
+        """
+        if rotation is None:
+            return cls()
+        if isinstance(rotation, cls):
+            return rotation
+        if isinstance(rotation, Mapping):
+            return cls.from_euler(rotation)
+        rotation = np.asarray(rotation, dtype=np.float64)
+        if rotation.shape == (3, 3):
+            return cls(rotation)
+        if rotation.shape == (4,):
+            return cls.from_quaternion(rotation)
+        raise ValueError(f'Do not understand rotation {rotation}')
+
+    def __matmul__(self, other):
+        """
+        self @ other rotates with other first, then with self
+        """
+        return Rotation(self.matrix @ Rotation.coerce(other).matrix)
+
+    def __eq__(self, other):
+        if not isinstance(other, Rotation):
+            return NotImplemented
+        return np.allclose(self.matrix, other.matrix, rtol=0, atol=1e-12)
+
+    def __repr__(self):
+        return f'<Rotation {self.euler}>'
+
+    @property
+    def is_identity(self):
+        return np.allclose(self.matrix, np.eye(3), rtol=0, atol=1e-12)
+
+    def inverse(self):
+        return Rotation(self.matrix.T)
+
+    def apply(self, points):
+        """
+        Rotate points
+
+        Args:
+            points (np.ndarray) : (N,3) or (3,) points
+        """
+        return np.asarray(points, dtype=np.float64) @ self.matrix.T
+
+    @property
+    def quaternion(self):
+        """
+        The rotation as unit quaternion (w, x, y, z)
+        """
+        return matrices_to_quaternions(self.matrix)[0]
+
+    @property
+    def euler(self):
+        """
+        The gdml angles in degree, as dict with the axes 'x', 'y', 'z'
+        """
+        if self._euler is None:
+            self._euler = matrix_to_euler(self.matrix)
+        return dict(self._euler)
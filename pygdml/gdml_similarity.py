@@ -0,0 +1,217 @@
+"""
+Find tessellated solids which are (nearly) the same shape,
+independent of their position and orientation.
+"""
+
+from collections import defaultdict
+
+import numpy as np
+import trimesh
+
+import logging
+LOG = logging
+try:
+    import hepbasestack as hep
+    from . import __package_loglevel__
+    LOG = hep.logger.get_logger(__package_loglevel__)
+    del logging
+except ImportError:
+    pass
+
+from .gdml_instrument import count
+
+##################################
+
+
+def compare_mesh(a, b):
+    """
+    Quadratic array comparator
+    """
+    assert (len(a) == len(b))
+    vals = [np.sqrt((a[k] - b[k]) ** 2) for k in range(len(a))]
+    return sum(vals)
+
+##################################
+
+
+def mesh_identifier(mesh):
+    """
+    A pose invariant descriptor of the shape of a mesh,
+    see trimesh.comparison.identifier_simple. The first entry
+    is the surface area, the second the euler number.
+
+    Args:
+        mesh (trimesh.Trimesh) : the mesh to describe
+    """
+    return trimesh.comparison.identifier_simple(mesh)
+
+def shape_identifier(solid):
+    """
+    The descriptor of the shape of a solid, see mesh_identifier.
+    Tessellated solids keep it until their geometry changes.
+
+    Args:
+        solid (GdmlTessellatedSolid) : the solid to describe
+    """
+    if hasattr(solid, 'shape_identifier'):
+        return solid.shape_identifier
+    return mesh_identifier(trimesh.Trimesh(solid.vertices, solid.faces))
+
+##################################
+
+
+class SimilarityIndex(object):
+    """
+    Group solids by their shape identifier. Each solid is described
+    once, and the descriptors are bucketed by euler number and
+    surface area. Solids are only compared with the ones in the same
+    or a neighboring bucket, which gives the same result as
+    comparing every solid with every other one (GdmlTessellatedSolid.is_similar),
+    but in about linear time.
+    """
+
+    def __init__(self, threshold=1e-9, resolution=1e-6):
+        """
+        Keyword Args:
+            threshold (float)  : solids are similar if the distance
+                                 of their identifiers (see compare_mesh)
+                                 is smaller than this
+            resolution (float) : width of the buckets in surface area,
+                                 has to be at least the threshold
+        """
+        if resolution < threshold:
+            raise ValueError(f'The resolution {resolution} has to be larger than the threshold {threshold}!')
+        self.threshold = threshold
+        self.resolution = resolution
+        self.solids = []
+        self.identifiers = []
+        self.buckets = defaultdict(list)
+        # solids which could not be described
+        self.failed = []
+
+    ###############################################################
+
+    def __len__(self):
+        return len(self.solids)
+
+    ###############################################################
+
+    def _bucket(self, identifier):
+        return (int(round(identifier[1])), int(identifier[0] // self.resolution))
+
+    ###############################################################
+
+    def add(self, solid):
+        """
+        Describe a solid and add it to the index
+
+        Args:
+            solid (GdmlTessellatedSolid) : the solid to add
+        """
+        try:
+            identifier = shape_identifier(solid)
+        except Exception as e:
+            LOG.debug(f'Can not describe {solid.name}, exception {e}')
+            count('solids_undescribed')
+            self.failed.append(solid)
+            return
+        self.buckets[self._bucket(identifier)].append(len(self.solids))
+        self.solids.append(solid)
+        self.identifiers.append(identifier)
+
+    ###############################################################
+
+    def add_all(self, solids):
+        for solid in solids:
+            self.add(solid)
+        return self
+
+    ###############################################################
+
+    def _candidates(self, identifier):
+        euler, cell = self._bucket(identifier)
+        for k in (cell - 1, cell, cell + 1):
+            for index in self.buckets.get((euler, k), []):
+                yield index
+
+    ###############################################################
+
+    def similar(self, solid):
+        """
+        All solids in the index which are similar to the given one
+
+        Args:
+            solid (GdmlTessellatedSolid) : the solid to look for, does
+                                           not need to be in the index
+
+        Returns:
+            list : tuples of (solid, distance)
+        """
+        try:
+            identifier = shape_identifier(solid)
+        except Exception as e:
+            LOG.debug(f'Can not describe {solid.name}, exception {e}')
+            count('solids_undescribed')
+            return []
+        result = []
+        for index in self._candidates(identifier):
+            other = self.solids[index]
+            if other is solid:
+                continue
+            distance = compare_mesh(identifier, self.identifiers[index])
+            if distance < self.threshold:
+                result.append((other, distance))
+        return result
+
+    ###############################################################
+
+    def relations(self):
+        """
+        For every solid in the index, the similar solids
+
+        Returns:
+            dict : solid -> list of (solid, distance), only solids with
+                   at least one similar solid are included
+        """
+        related = defaultdict(list)
+        for bucket, members in self.buckets.items():
+            euler, cell = bucket
+            # compare each pair only once, so only look
+            # at the same and the next bucket
+            neighbors = self.buckets.get((euler, cell + 1), [])
+            for pos, k in enumerate(members):
+                for j in members[pos + 1:] + neighbors:
+                    distance = compare_mesh(self.identifiers[k], self.identifiers[j])
+                    if distance < self.threshold:
+                        related[self.solids[k]].append((self.solids[j], distance))
+                        related[self.solids[j]].append((self.solids[k], distance))
+        return dict(related)
+
+    ###############################################################
+
+    def groups(self):
+        """
+        Groups of solids which are similar, directly or through
+        other solids of the same group.
+
+        Returns:
+            list : lists of solids, every group has at least 2 members
+        """
+        index = {id(s): k for k, s in enumerate(self.solids)}
+        parent = list(range(len(self.solids)))
+
+        def find(k):
+            while parent[k] != k:
+                parent[k] = parent[parent[k]]
+                k = parent[k]
+            return k
+
+        for solid, others in self.relations().items():
+            for other, _ in others:
+                a, b = find(index[id(solid)]), find(index[id(other)])
+                if a != b:
+                    parent[max(a, b)] = min(a, b)
+        groups = defaultdict(list)
+        for k, solid in enumerate(self.solids):
+            groups[find(k)].append(solid)
+        return [groups[k] for k in sorted(groups) if len(groups[k]) > 1]
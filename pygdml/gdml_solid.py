@@ -4,13 +4,146 @@ Base class for gdml solid parsing
 """
 
 from copy import copy
+import dataclasses
 import bs4
+import numpy as np
 import trimesh
-import vectormath as vm
+from scipy.spatial import cKDTree
+from scipy.sparse import coo_matrix
+from scipy.sparse.csgraph import connected_components
 
-from .gdml_tags import PositionTag, ScaleTag, VolumeTag, TessellatedTag
+import logging
+LOG = logging
+try:
+    import hepbasestack as hep
+    from . import __package_loglevel__
+    LOG = hep.logger.get_logger(__package_loglevel__)
+    del logging
+except ImportError:
+    pass
+
+from .gdml_tags import PositionTag, ScaleTag, VolumeTag, TessellatedTag, TagChunk,\
+                       FULL_PROFILE, round_significant
 from .renormalize_names import normalize_name
+from .gdml_similarity import compare_mesh, mesh_identifier, shape_identifier
+from .gdml_decimate import decimate, LENGTH_UNITS
+from .gdml_instrument import span, count
+
+
+# stands for the vertex name prefix in rendered chunk lines,
+# it can not appear in xml
+PREFIX_PLACEHOLDER = '\x00'
+
+# the checks G4TriangularFacet does on
+# each facet, in the order they are done
+G4_FACET_CHECKS = ('edge_length', 'min_height')
+
+# derived properties of a tessellated solid which do not
+# change when the solid is translated, and the ones which
+# move with it
+TRANSLATION_INVARIANT = ('surface_area', 'facet_geometry',\
+                         'shape_identifier', 'is_volume')
+TRANSLATION_COVARIANT = ('bounds',)
+# the same, but only for closed meshes. The volume and center
+# of mass trimesh gives for open meshes depend on the origin
+VOLUME_INVARIANT = ('volume',)
+VOLUME_COVARIANT = ('center_mass',)
+
+# derived properties which are cheap to ship to
+# other processes or to keep in the incremental cache
+PORTABLE_DERIVED = ('center_mass', 'volume', 'surface_area', 'bounds', 'is_volume')
+
+def g4_facet_validity(vertices, faces, delta):
+    """
+    Check which facets Geant4 would accept. This is
+    ported from the constructor of geant4's G4TriangularFacet
+    and checks all facets in one go.
+
+    Args:
+        vertices (np.ndarray) : (N,3) vertex array
+        faces (np.ndarray)    : (M,3) vertex indices of the facets
+        delta (float)         : the tolerance (kCarTolerance)
+
+    Returns:
+        tuple (np.ndarray, dict) : boolean mask, True for valid facets,
+                                   and the number of invalid facets
+                                   per failed check (see G4_FACET_CHECKS)
+    """
+    faces = np.asarray(faces, dtype=np.int64).reshape(-1, 3)
+    v0 = vertices[faces[:, 0]]
+    e1 = vertices[faces[:, 1]] - v0
+    e2 = vertices[faces[:, 2]] - v0
+    area = 0.5 * np.linalg.norm(np.cross(e1, e2), axis=1)
+    leng1 = np.linalg.norm(e1, axis=1)
+    leng2 = np.linalg.norm(e2 - e1, axis=1)
+    leng3 = np.linalg.norm(e2, axis=1)
+    bad_edge = (leng1 <= delta) | (leng2 <= delta) | (leng3 <= delta)
+    # the height is only checked if the edges are fine
+    with np.errstate(divide='ignore', invalid='ignore'):
+        height = 2. * area / np.maximum(np.maximum(leng1, leng2), leng3)
+    bad_height = (~bad_edge) & (height <= delta)
+    reasons = {'edge_length' : int(bad_edge.sum()),\
+               'min_height'  : int(bad_height.sum())}
+    return ~(bad_edge | bad_height), reasons
+
+def weld_vertices(vertices, faces, tolerance=0.):
+    """
+    Merge vertices which are closer than the tolerance, and
+    remove the vertices which are not used by any facet.
+    Vertices are merged transitively, a chain of close vertices
+    becomes a single one. The merged vertex keeps the coordinates
+    of the first vertex of the chain. Facets which lose a corner
+    in the process are removed.
+
+    Args:
+        vertices (np.ndarray) : (N,3) vertex array
+        faces (np.ndarray)    : (M,3) vertex indices of the facets
+
+    Keyword Args:
+        tolerance (float)     : maximum distance of vertices which
+                                are merged, 0 only merges identical ones
 
+    Returns:
+        tuple (np.ndarray, np.ndarray, dict) : the new vertices and faces, and
+                                               the number of 'merged' and 'unreferenced'
+                                               vertices and 'degenerate' facets
+    """
+    faces = np.asarray(faces, dtype=np.int64).reshape(-1, 3)
+    nvertices = len(vertices)
+    pairs = cKDTree(vertices).query_pairs(tolerance, output_type='ndarray')
+    graph = coo_matrix((np.ones(len(pairs)), (pairs[:, 0], pairs[:, 1])),\
+                       shape=(nvertices, nvertices))
+    ncomponents, labels = connected_components(graph, directed=False)
+    # the first vertex of each group represents it
+    first = np.full(ncomponents, nvertices)
+    np.minimum.at(first, labels, np.arange(nvertices))
+    faces = first[labels][faces]
+    degenerate = (faces[:, 0] == faces[:, 1]) |\
+                 (faces[:, 1] == faces[:, 2]) |\
+                 (faces[:, 0] == faces[:, 2])
+    faces = faces[~degenerate]
+    used, faces = np.unique(faces, return_inverse=True)
+    stats = {'merged'       : nvertices - ncomponents,\
+             'unreferenced' : ncomponents - len(used),\
+             'degenerate'   : int(degenerate.sum())}
+    return vertices[used], faces.reshape(-1, 3), stats
+
+###########################################################
+
+def _read_only(value):
+    """
+    A read-only view of an array (or a tuple of arrays), so
+    that it can be shared without the owner losing write access.
+    Anything else is returned as it is.
+    """
+    if isinstance(value, tuple):
+        return tuple(_read_only(k) for k in value)
+    if isinstance(value, np.ndarray):
+        value = value.view()
+        value.flags.writeable = False
+    return value
+
+###########################################################
 
 class GDMLAbstractSolid(object):
     """
@@ -31,6 +164,23 @@ class GDMLAbstractSolid(object):
     def define_tags(self):
         raise NotImplementedError(f'Not implemented for {type(self)}')
 
+    def define_chunks(self, profile=FULL_PROFILE):
+        """
+        The tags for the define section, preferably as
+        preformatted gdml_tags.TagChunk
+        """
+        return list(self.define_tags())
+
+    def solid_chunk(self, use_name=None, profile=FULL_PROFILE):
+        """
+        The tag for the solids section, preferably as
+        preformatted gdml_tags.TagChunk
+        """
+        tag = self.solid_tag()
+        if use_name is not None:
+            tag.attrs['name'] = use_name
+        return tag
+
 ###########################################################
 # BOX
 ##########################################################
@@ -79,21 +229,43 @@ class GdmlTessellatedSolid(GDMLAbstractSolid):
     def __init__(self, identifier=0):
         self.has_define_section = True
         self.name = "NONE"
-        self.named_vertices = {}
-        self.vertices = []
-        self.vertex_pts = []
-        self.triangles = []
-        self.faces = []
-        self.areas = []
-        self.indizes = {}  # position name ->index
-        self.faces = []
-        self.vertex_names = []
+        # the geometry is kept as a (N,3) array of vertices
+        # and a (M,3) array of vertex indices for the facets.
+        # The names of the vertices are only generated when
+        # the solid gets serialized
+        self._vertices = np.empty((0, 3), dtype=np.float64)
+        self._faces = np.empty((0, 3), dtype=np.int32)
+        # while a file is parsed, vertices and facets
+        # are collected here first
+        self._vertex_buffer = []
+        self._face_buffer = []
+        # translations and scalings are only stored as 4x4 matrix
+        # (None is the identity), and applied to the vertices
+        # when they are needed, see transform
+        self._transform = None
+        self._transformed = None
+        # every change of the geometry increases the version,
+        # the derived properties (mesh, center of mass, ...)
+        # are only valid for the version they have been computed for
+        self._version = 0
+        self._derived = dict()
+        self._derived_version = 0
+        self.areas = np.empty(0, dtype=np.float64)
+        self.indizes = {}  # position name ->index, only needed while parsing
         self.unit = None
         self.triangular_attrs = {}
         self.tessell_attrs = {}
         self.tolerance = 0
         self.ntriangles = 0
         self.ninvalidtri = 0
+        # vertices removed by weld
+        self.nmerged = 0
+        self.nunreferenced = 0
+        # facet counts and deviation of the last decimation
+        self.decimation_report = None
+        # profile -> the lines of the define and solid chunks,
+        # with PREFIX_PLACEHOLDER for the vertex name prefix
+        self.rendered_lines = dict()
         self._identifier = identifier
         # the center of gravity
         self.center_mass = None
@@ -137,82 +309,531 @@ class GdmlTessellatedSolid(GDMLAbstractSolid):
         """
         self.tolerance = 1e-11 * worldextent
 
+    def _flush_buffers(self):
+        """
+        Move everything which has been collected by the
+        parsers into the vertex and face arrays
+        """
+        if self._vertex_buffer:
+            self._vertices = np.concatenate((self._vertices,\
+                                             np.array(self._vertex_buffer, dtype=np.float64)))
+            self._vertex_buffer = []
+            self._transformed = None
+            self._touch()
+        if self._face_buffer:
+            self._faces = np.concatenate((self._faces,\
+                                          np.array(self._face_buffer, dtype=np.int32)))
+            self._face_buffer = []
+            self._touch()
+
+    def _touch(self, translation=None):
+        """
+        Note that the geometry has changed, which invalidates
+        the derived properties. For a translation the ones which
+        do not depend on the position are kept, and the bounds
+        are moved along. The volume and the center of mass are
+        only kept (or moved) if the mesh is a closed volume.
+
+        Keyword Args:
+            translation (np.ndarray) : the geometry has only been moved
+        """
+        derived = self._valid_derived()
+        self._version += 1
+        self._derived = dict()
+        self._derived_version = self._version
+        if translation is None:
+            return
+        if ('mesh' in derived) and ('is_volume' not in derived):
+            derived['is_volume'] = bool(derived['mesh'].is_volume)
+        invariant, covariant = TRANSLATION_INVARIANT, TRANSLATION_COVARIANT
+        if derived.get('is_volume', False):
+            invariant += VOLUME_INVARIANT
+            covariant += VOLUME_COVARIANT
+        for k in invariant:
+            if k in derived:
+                self._derived[k] = derived[k]
+        for k in covariant:
+            if k in derived:
+                # new arrays, the old ones might be in use as position
+                self._derived[k] = derived[k] + translation
+
+    def _valid_derived(self):
+        """
+        The derived properties computed for the current version
+        """
+        if self._derived_version != self._version:
+            self._derived = dict()
+            self._derived_version = self._version
+        return self._derived
+
+    def _cached(self, key, compute):
+        """
+        Compute a derived property only once per version
+
+        Args:
+            key (str)          : name of the property
+            compute (callable) : computes the property, without arguments
+        """
+        if self._vertex_buffer or self._face_buffer:
+            self._flush_buffers()
+        derived = self._valid_derived()
+        if key not in derived:
+            derived[key] = compute()
+        return derived[key]
+
+    @property
+    def version(self):
+        """
+        Increases with every change of the geometry, can be used
+        to key anything which is derived from it
+        """
+        return self._version
+
+    def derived_state(self):
+        """
+        The derived properties which have been computed already and
+        which are cheap to pickle, see PORTABLE_DERIVED. Nothing
+        is computed here.
+
+        Returns:
+            dict : property name -> value
+        """
+        derived = self._valid_derived()
+        return {k: derived[k] for k in PORTABLE_DERIVED if k in derived}
+
+    def set_derived_state(self, values):
+        """
+        Restore derived properties, e.g. computed by another
+        process. The geometry has to be set already.
+
+        Args:
+            values (dict) : property name -> value, see derived_state
+        """
+        derived = self._valid_derived()
+        for k in PORTABLE_DERIVED:
+            if values.get(k) is not None:
+                derived[k] = values[k]
+
+    @property
+    def vertices(self):
+        """
+        The vertices as (N,3) float64 array, with the transform
+        applied. The transformed vertices are computed once, and
+        kept until the transform changes.
+        """
+        if self._vertex_buffer:
+            self._flush_buffers()
+        if self._transform is None:
+            return self._vertices
+        if self._transformed is None:
+            linear = self._transform[:3, :3]
+            vertices = self._vertices
+            if not np.array_equal(linear, np.eye(3)):
+                vertices = vertices @ linear.T
+            self._transformed = vertices + self._transform[:3, 3]
+        return self._transformed
+
+    @vertices.setter
+    def vertices(self, vertices):
+        # the new vertices have everything applied already
+        self._transform = None
+        self.set_local_vertices(vertices)
+
+    def set_local_vertices(self, vertices):
+        """
+        Replace the vertices without the transform, which stays
+        pending and is applied to the new vertices as well
+
+        Args:
+            vertices (np.ndarray) : (N,3) vertices in the frame of the solid
+        """
+        self.rendered_lines = dict()
+        self._vertex_buffer = []
+        self._vertices = np.ascontiguousarray(vertices, dtype=np.float64).reshape(-1, 3)
+        self._transformed = None
+        self._touch()
+
+    @property
+    def local_vertices(self):
+        """
+        The vertices without the transform
+        """
+        if self._vertex_buffer:
+            self._flush_buffers()
+        return self._vertices
+
+    @property
+    def transform(self):
+        """
+        The 4x4 matrix of all translations and scalings which have
+        not been applied to the vertices yet, see apply_transform
+        """
+        if self._transform is None:
+            return np.eye(4)
+        return self._transform.copy()
+
+    def apply_transform(self, matrix):
+        """
+        Add a transformation on top of the current transform.
+        This is O(1), the vertices are only transformed when
+        they are needed, e.g. when the solid gets written.
+
+        Args:
+            matrix (np.ndarray) : 4x4 affine transformation
+        """
+        matrix = np.asarray(matrix, dtype=np.float64)
+        translation = None
+        if np.array_equal(matrix[:3, :3], np.eye(3)):
+            translation = matrix[:3, 3].copy()
+        if self._transform is not None:
+            matrix = matrix @ self._transform
+        self._transform = matrix
+        self._transformed = None
+        self.rendered_lines = dict()
+        self._touch(translation=translation)
+
+    def bake_transform(self):
+        """
+        Apply the transform to the vertices, and forget it
+        """
+        if self._transform is not None:
+            # the geometry stays the same
+            derived = self._valid_derived()
+            self.vertices = self.vertices
+            self._derived = derived
+            self._derived_version = self._version
+
+    def detach_transform(self):
+        """
+        Take the transform off the solid, so that it can be written
+        as <position> and <scale> of a physvol instead of changing
+        the coordinates of every vertex. Only works if the transform
+        is a scaling followed by a translation.
+
+        Returns:
+            tuple : (translation, scalefactors), both None if
+                    the transform can not be detached. The
+                    scalefactors of the solid are reset.
+        """
+        matrix = self.transform
+        linear = matrix[:3, :3]
+        if not np.array_equal(linear, np.diag(np.diag(linear))):
+            return None, None
+        self._transform = None
+        self._transformed = None
+        self.rendered_lines = dict()
+        self._touch()
+        # the vertices are not scaled anymore, a later
+        # scale must not undo the detached factors
+        self.scalefactors = None
+        return tuple(matrix[:3, 3].tolist()), tuple(np.diag(linear).tolist())
+
+    @property
+    def faces(self):
+        """
+        The facets as (M,3) int32 array of indices into the vertices
+        """
+        if self._face_buffer:
+            self._flush_buffers()
+        return self._faces
+
+    @faces.setter
+    def faces(self, faces):
+        self.rendered_lines = dict()
+        self._face_buffer = []
+        self._faces = np.ascontiguousarray(faces, dtype=np.int32).reshape(-1, 3)
+        self._touch()
+
     @property
     def nvertices(self):
         return len(self.vertices)
 
+    @property
+    def nfaces(self):
+        return len(self.faces)
+
     def __repr__(self):
         return f'<GdmlTessellatedSolid with {self.nvertices} vertices>'
 
+    def add_vertex(self, name, x, y, z, unit=None):
+        """
+        Add a vertex as it is read from a <position> tag
+        in the define section. This is used by the parsers.
+
+        Args:
+            name (str) : name of the position in the define section
+            x (float)  : x-coordinate
+            y (float)  : y-coordinate
+            z (float)  : z-coordinate
+
+        Keyword Args:
+            unit (str) : the length unit of the position
+        """
+        if unit is not None:
+            self.unit = unit
+        self.indizes[name] = len(self._vertices) + len(self._vertex_buffer)
+        self._vertex_buffer.append((x, y, z))
+
+    def add_triangular(self, v1, v2, v3, attrs=None):
+        """
+        Add a facet as it is read from a <triangular> tag
+        in the solids section. This is used by the parsers.
+
+        Args:
+            v1 (str) : name of the first vertex, has to be added already
+            v2 (str) : name of the second vertex
+            v3 (str) : name of the third vertex
+
+        Keyword Args:
+            attrs (dict) : the attributes of the <triangular> tag. They are
+                           the same for all facets, so it is enough to
+                           give them once.
+        """
+        if attrs is not None:
+            self.triangular_attrs = attrs
+        self._face_buffer.append((self.indizes[v1], self.indizes[v2], self.indizes[v3]))
+
+    def vertex_name(self, index):
+        """
+        The name of a vertex in the define section
+
+        Args:
+            index (int) : index of the vertex
+        """
+        # keep the name valid, but short to reduce gdml file size
+        return f'v{self.identifier}_{index}'
+
+    def vertex_prefix(self, profile=FULL_PROFILE):
+        """
+        The vertex names without the index, as used by the
+        chunks. Short names have the identifier in hex as well
+        """
+        if profile.short_names:
+            return f'v{self.identifier:x}_'
+        return self.vertex_name('')
+
+    @property
+    def named_vertices(self):
+        """
+        Vertex name -> vertex, the names are generated
+        """
+        return {self.vertex_name(k): v for k, v in enumerate(self.vertices)}
+
+    @property
+    def vertex_names(self):
+        """
+        The facets as triples of vertex names, the names are generated
+        """
+        return [(self.vertex_name(k[0]),\
+                 self.vertex_name(k[1]),\
+                 self.vertex_name(k[2])) for k in self.faces.tolist()]
+
+    @property
+    def triangles(self):
+        """
+        The corner points of all facets as (M,3,3) array
+        """
+        return self.vertices[self.faces]
+
+    ###########################################################
+    # derived properties, computed once per version
+
+    @property
+    def mesh(self):
+        """
+        The solid as trimesh.Trimesh (processed, so duplicate
+        vertices are merged). Do not change it, it is shared.
+        """
+        return self._cached('mesh', lambda: trimesh.Trimesh(vertices=self.vertices,\
+                                                            faces=self.faces))
+
+    @property
+    def is_volume(self):
+        """
+        If the mesh is closed, consistently wound and has
+        a positive volume, see trimesh.Trimesh.is_volume
+        """
+        return self._cached('is_volume', lambda: bool(self.mesh.is_volume))
+
+    @property
+    def center_mass(self):
+        """
+        The center of gravity, assuming a uniform density
+        """
+        return self._cached('center_mass', lambda: self.mesh.center_mass)
+
+    @center_mass.setter
+    def center_mass(self, center_mass):
+        # e.g. known from an earlier run, None forgets it
+        derived = self._valid_derived()
+        derived.pop('center_mass', None)
+        if center_mass is not None:
+            derived['center_mass'] = center_mass
+
+    @property
+    def volume(self):
+        return self._cached('volume', lambda: self.mesh.volume)
+
+    @property
+    def surface_area(self):
+        return self._cached('surface_area', lambda: self.mesh.area)
+
+    @property
+    def bounds(self):
+        """
+        The axis aligned bounding box as (2,3) array of
+        the minimum and maximum corner, None without vertices
+        """
+        def compute():
+            if not self.nvertices:
+                return None
+            return np.array((self.vertices.min(axis=0), self.vertices.max(axis=0)))
+        return self._cached('bounds', compute)
+
+    def _facet_geometry(self):
+        """
+        The areas and the normals of the facets,
+        they need the same cross products
+        """
+        def compute():
+            tri = self.triangles
+            cross = np.cross(tri[:, 1] - tri[:, 0], tri[:, 2] - tri[:, 0])
+            norm = np.linalg.norm(cross, axis=1)
+            # degenerate facets get a zero normal
+            with np.errstate(divide='ignore', invalid='ignore'):
+                normals = np.nan_to_num(cross / norm[:, None])
+            return 0.5 * norm, normals
+        return self._cached('facet_geometry', compute)
+
+    @property
+    def facet_areas(self):
+        """
+        The area of every facet, in the order of faces
+        """
+        return self._facet_geometry()[0]
+
+    @property
+    def face_normals(self):
+        """
+        The unit normal of every facet as (M,3) array,
+        in the order of faces (unlike the ones of the mesh,
+        which might have dropped facets)
+        """
+        return self._facet_geometry()[1]
+
+    @property
+    def shape_identifier(self):
+        """
+        A pose invariant descriptor of the shape,
+        see gdml_similarity.shape_identifier
+        """
+        return self._cached('shape_identifier', lambda: mesh_identifier(self.mesh))
+
+    ###########################################################
+
     def get_auxiliary_info(self):
         """
-        Create the corresponding mesh with trimesh,
-        calculate the center of gravity and write it
+        Calculate the center of gravity and write it
         to the axiliary file.
         """
-        mesh = trimesh.Trimesh(vertices=self.vertices, faces=self.faces)
         self.trafo_to_write = 'NONE'
         try:
-            center_mass = mesh.center_mass
+            center_mass = self.center_mass
         except Exception as e:
-            print(f'Calculating center_mass of {self.name} caused exception {e}')
+            LOG.warning(f'Calculating center_mass of {self.name} caused exception {e}')
             return self.trafo_to_write
         self.trafo_to_write = (f'{self.name} -- {center_mass}\n')
-        self.center_mass = center_mass
         return self.trafo_to_write
 
-    def scale(self, x, y, z):
+    def scale(self, x, y, z, clean=True):
         """
+        Scale the vertices. The scale factors are not applied on
+        top of an earlier scaling, they replace it.
+
+        Args:
+            x (float) : scale factor in x
+            y (float) : scale factor in y
+            z (float) : scale factor in z
+
+        Keyword Args:
+            clean (bool) : remove facets which became invalid. This needs
+                           the scaled vertices, without it the scaling is
+                           only applied when the vertices are needed.
         """
+        factors = np.array((x, y, z), dtype=np.float64)
         # make sure the scale is not applied multiple time
         # this means, whenever we scale something
         # rescale it to 1 first
         if self.scalefactors is not None:
-            print (self.scalefactors)
-            raise
-            x_0, y_0, z_0 = self.scalefactors
-            self.vertices = [((k[0] * 1/x_0),
-                             (k[1] * 1/y_0),
-                             (k[2] * 1/z_0)) for k in self.vertices]
-
-        shifted_vertices = [(k[0] * x,\
-                             k[1] * y,\
-                             k[2] * z) for k in self.vertices]
-        self.vertices = shifted_vertices
+            factors = factors / np.array(self.scalefactors, dtype=np.float64)
+        self.apply_transform(np.diag(np.append(factors, 1.)))
         self.scalefactors = (x, y, z)
-        # fixes the self.named_vertices and
         # makes sure nothing got messed up
         # during the scaling
-        self.remove_invalid_triangles()
+        if clean:
+            self.remove_invalid_triangles()
 
     def translate(self, x, y, z):
         """
-        Translate to arbitrary position
+        Translate to arbitrary position, the vertices
+        are only moved when they are needed
         """
-        shifted_vertices = [(k[0] + x,\
-                             k[1] + y,\
-                             k[2] + z) for k in self.vertices]
-        self.vertices = shifted_vertices
-        self._update_vertices()
+        matrix = np.eye(4)
+        matrix[:3, 3] = (x, y, z)
+        self.apply_transform(matrix)
         self.position = (x, y, z)
 
     def translate_to_center_mass(self):
         """
         Translate the whole solid to its center of mass
         """
-        if self.center_mass is None:
+        if self.trafo_to_write is None:
             self.get_auxiliary_info()
-        conv = 1e-5
-        conv = 0.05
-        conv = 1
-        shifted_vertices = [(k[0] - self.center_mass[0] * conv,\
-                             k[1] - self.center_mass[1] * conv,\
-                             k[2] - self.center_mass[2] * conv) for k in self.vertices]
+        center_mass = self.center_mass
+        self.translate(*(-np.asarray(center_mass, dtype=np.float64)))
+        self.position = center_mass
 
-        self.vertices = shifted_vertices
-        self._update_vertices()
-        self.position = self.center_mass #* 0.1
+    def instance(self, identifier, position=None, rotation=None):
+        """
+        A lightweight copy of this solid, e.g. to place the same
+        part several times. The copy gets read-only views of the
+        vertex and facet arrays. Every transformation assigns new
+        arrays, so the geometry is only copied once an instance is
+        changed (copy on write). This solid stays writeable, but
+        changing its arrays in place changes the instances as well.
 
+        Args:
+            identifier (int) : the identifier of the copy
+
+        Keyword Args:
+            position (tuple) : the position of the copy, if not given
+                               the one of this solid
+            rotation (dict)  : the rotation of the copy, if not given
+                               the one of this solid
+        """
+        self._flush_buffers()
+        other = copy(self)
+        other._vertices = _read_only(self._vertices)
+        other._faces = _read_only(self._faces)
+        other._transformed = _read_only(self._transformed)
+        other._identifier = identifier
+        other.tessell_attrs = dict(self.tessell_attrs)
+        other.triangular_attrs = dict(self.triangular_attrs)
+        other.rendered_lines = dict(self.rendered_lines)
+        # the derived properties are valid for the copy as well,
+        # except the mesh, which can be changed in place
+        other._derived = {k: _read_only(v) for k, v in self._valid_derived().items()\
+                          if k != 'mesh'}
+        other.indizes = dict()
+        # the buffers are empty after the flush, but
+        # must not be shared with this solid either
+        other._vertex_buffer = []
+        other._face_buffer = []
+        if position is not None:
+            other.position = tuple(position)
+        # e.g. a dict of euler angles, which can be changed in place
+        other.rotation = copy(self.rotation if rotation is None else rotation)
+        return other
 
     def calculate_triangle_areas(self):
         """
@@ -220,38 +841,50 @@ class GdmlTessellatedSolid(GDMLAbstractSolid):
         Returns:
             None
         """
-        def area(x,y,z):
-            """
-            args are 3 vectormath.Vector3 vectors
-            """
-            a = y - x
-            b = z - x
-            return 0.5 * a.cross(b).length
+        self.areas = self.facet_areas
 
-        self.areas = [area(*k) for k in self.triangles]
+    def check_triangles_g4valid(self, faces=None):
+        """
+        Check all facets at once, the same way as
+        check_triangle_g4valid does it for a single one.
+
+        Keyword Args:
+            faces (np.ndarray) : (M,3) vertex indices, if not given
+                                 the faces of this solid are checked
+
+        Returns:
+            tuple (np.ndarray, dict) : boolean mask, True for valid facets,
+                                       and the number of invalid facets
+                                       per failed check
+        """
+        if faces is None:
+            faces = self.faces
+        valid, reasons = g4_facet_validity(self.vertices, faces, self.tolerance)
+        self.ntriangles += len(valid)
+        self.ninvalidtri += sum(reasons.values())
+        return valid, reasons
 
     def check_triangle_g4valid(self, face):
         """
         A face has 3 vertices. This code is ported from
         geant4's G4TriangularFacet
+        This is the reference implementation for a single
+        facet, use check_triangles_g4valid to check many.
         """
         self.ntriangles += 1
         delta = self.tolerance
-        v0, v1, v2 = face
-        v0 = vm.Vector3(self.named_vertices[f'v{self.identifier}_{v0}'])
-        v1 = vm.Vector3(self.named_vertices[f'v{self.identifier}_{v1}'])
-        v2 = vm.Vector3(self.named_vertices[f'v{self.identifier}_{v2}'])
+        v0, v1, v2 = self.vertices[face]
         # FIXME - it seems all the vertices are always absolut
         # however, as it is with always, nothing is ever "always"
         # so FIXME - watch out
         e1 = v1 - v0
         e2 = v2 - v0
-        e1xe2 = e1.cross(e2)
-        area = 0.5 * e1xe2.length
+        e1xe2 = np.cross(e1, e2)
+        area = 0.5 * np.linalg.norm(e1xe2)
         # checks
-        leng1 = e1.length
-        leng2 = (e2 - e1).length
-        leng3 = e1.length
+        leng1 = np.linalg.norm(e1)
+        leng2 = np.linalg.norm(e2 - e1)
+        leng3 = np.linalg.norm(e2)
         # print (f'{leng1, leng2, leng3, 2*area/max(max(leng1, leng2, leng3)), delta}')
         if (leng1 <= delta or leng2 <= delta or leng3 <= delta):
             # print (f'Invalid triangle {leng1, leng2, leng3} , delta {delta}')
@@ -268,71 +901,121 @@ class GdmlTessellatedSolid(GDMLAbstractSolid):
         Check if this solid seams to be similar to
         another one.
         If the value is really small, it it pretty likely they are similar.
+        To compare many solids with each other, use
+        gdml_similarity.SimilarityIndex instead.
         """
-        other_name = other.name
-        mesh = trimesh.Trimesh(self.vertices, self.faces)
-        other = trimesh.Trimesh(other.vertices, other.faces)
         try:
-            a = trimesh.comparison.identifier_simple(mesh)
-            b = trimesh.comparison.identifier_simple(other)
+            a = self.shape_identifier
+            b = shape_identifier(other)
         except Exception as e:
-            print(f'Can not compare {self.name} and {other_name}')
+            LOG.debug(f'Can not compare {self.name} and {other.name}')
             return np.inf
         return compare_mesh(a, b)
 
-    def _update_vertices(self):
+    def remove_invalid_triangles(self):
         """
+        Create a trimesh.Trimesh. During the processing of the
+        Trimesh, invalid triangles will be automatically removed,
+        so the only thing is we have to convert it back and forth.
+        The vertex names are generated from the indices when
+        the solid is written, so nothing else needs to be kept
+        in sync.
+        The mesh is processed in the frame of the solid, so a pending
+        transform (see apply_transform) is kept. The facets are checked
+        for Geant4 with the transform applied.
+        """
+        mesh = trimesh.Trimesh(vertices=self.local_vertices, faces=self.faces, validate=True)
+        self.set_local_vertices(mesh.vertices)
+        # check tthat the triangles are valid first, before keeping them
+        valid, reasons = self.check_triangles_g4valid(mesh.faces)
+        LOG.debug(f'{self.name} : removing invalid facets {reasons}')
+        count('facets_dropped', self.nfaces - int(valid.sum()))
+        self.faces = mesh.faces[valid]
+        # the vertices of the removed facets might not be used anymore
+        self.compact()
 
-        Args:
-            mesh:
+    def weld(self, tolerance=None):
+        """
+        Merge vertices which are closer than the tolerance and remove
+        vertices which are not used by any facet, see weld_vertices.
+
+        Keyword Args:
+            tolerance (float) : maximum distance of merged vertices.
+                                If not given, the Geant4 tolerance
+                                of the solid is used.
 
         Returns:
+            dict : number of merged and unreferenced vertices and
+                   degenerate facets which have been removed
+        """
+        if tolerance is None:
+            tolerance = self.tolerance
+        vertices, faces, stats = weld_vertices(self.vertices, self.faces, tolerance)
+        self.vertices = vertices
+        self.faces = faces
+        self.nmerged += stats['merged']
+        self.nunreferenced += stats['unreferenced']
+        count('vertices_merged', stats['merged'])
+        count('facets_dropped', stats['degenerate'])
+        LOG.debug(f'{self.name} : welded vertices {stats}')
+        return stats
 
+    def decimate(self, face_count=None, max_deviation=None):
         """
+        Reduce the number of facets. The mesh stays watertight
+        (if it was before) and Geant4 valid, see gdml_decimate.decimate
 
-        for k, v in enumerate(self.vertices):
-            # keep the name valid, but short to reduce gdml file size
-            self.named_vertices[f'v{self.identifier}_{k}'] = v
+        Keyword Args:
+            face_count (int)      : target number of facets
+            max_deviation (float) : maximum deviation from the original
+                                    surface in mm
 
+        Returns:
+            dict : facets before and after, and the deviation in mm
+        """
+        scale = LENGTH_UNITS[self.unit or 'mm']
+        if max_deviation is not None:
+            max_deviation = max_deviation / scale
+        nfaces = self.nfaces
+        with span('decimate', solid=self.name):
+            vertices, faces, deviation = decimate(self.vertices, self.faces,\
+                                                  face_count=face_count,\
+                                                  max_deviation=max_deviation,\
+                                                  delta=self.tolerance)
+        self.vertices = vertices
+        self.faces = faces
+        self.compact()
+        self.decimation_report = {'before'    : nfaces,\
+                                  'after'     : self.nfaces,\
+                                  'deviation' : deviation * scale}
+        count('facets_decimated', nfaces - self.nfaces)
+        LOG.debug(f'{self.name} : decimated {self.decimation_report}')
+        return self.decimation_report
 
-    def remove_invalid_triangles(self):
+    def compact(self):
         """
-        Create a trimesh.Trimesh. During the processing of the
-        Trimesh, invalid triangles will be automatically removed,
-        so the only thing is we have to convert it back and forth.
-        Obviously, our inital naming conventions will be lost, but
-        we can take care of that by just setting up a new one, as
-        long as we keep everything in sync.
-        """
-        mesh = trimesh.Trimesh(vertices=self.vertices, faces=self.faces, validate=True)
-        # clear out the old values
-        self.vertex_names.clear()
-        self.named_vertices.clear()
-        for k, v in enumerate(mesh.vertices):
-            # keep the name valid, but short to reduce gdml file size
-            self.named_vertices[f'v{self.identifier}_{k}'] = v
-        # check tthat the triangles are valid first, before appending them
-        # if there are "stale" vertices, we have to remove them at the very end
-        # TODO
-        for k in mesh.faces:
-            if not self.check_triangle_g4valid(k):
-                continue  # don't use that triangle then
-
-            self.vertex_names.append((f'v{self.identifier}_{k[0]}', \
-                                      f'v{self.identifier}_{k[1]}', \
-                                      f'v{self.identifier}_{k[2]}'))
+        Remove the vertices which are not used by any facet
+
+        Returns:
+            int : number of removed vertices
+        """
+        used = np.zeros(self.nvertices, dtype=bool)
+        used[self.faces.ravel()] = True
+        if used.all():
+            return 0
+        remap = np.cumsum(used) - 1
+        self.faces = remap[self.faces]
+        self.set_local_vertices(self.local_vertices[used])
+        nremoved = len(used) - int(used.sum())
+        self.nunreferenced += nremoved
+        return nremoved
 
     @property
     def vpoints(self):
-        if self.vertex_pts:
-            return self.vertex_pts
-        else:
-            self.vertex_pts = [np.array([[k[0].x, k[0].y, k[0].z], \
-                                         [k[1].x, k[1].y, k[1].z], \
-                                         [k[2].x, k[2].y, k[2].z]]) \
-                               for k in self.triangles]
-            self.vertex_pts.flatten()
-            return self.vertex_pts
+        """
+        The corner points of all facets as (M,3,3) array
+        """
+        return self.triangles
 
     def create_define_tag(self):
         deftag = bs4.element.Tag(name='define', is_xml=True)
@@ -351,11 +1034,141 @@ class GdmlTessellatedSolid(GDMLAbstractSolid):
         return deftag
 
     def define_tags(self):
-        for k in self.named_vertices:
-            dtag = PositionTag.create(self.named_vertices[k],\
-                                      name=k, unit=self.unit)
+        for k, vertex in enumerate(self.vertices.tolist()):
+            dtag = PositionTag.create(vertex,\
+                                      name=self.vertex_name(k), unit=self.unit)
             yield dtag
 
+    def rounding_is_safe(self, digits):
+        """
+        Check that no facet changes its Geant4 validity if the
+        vertices are written with the given significant digits
+
+        Args:
+            digits (int) : number of significant digits
+        """
+        if not self.nfaces:
+            return True
+        valid, _ = g4_facet_validity(self.vertices, self.faces, self.tolerance)
+        rounded, _ = g4_facet_validity(round_significant(self.vertices, digits),\
+                                       self.faces, self.tolerance)
+        return bool((valid == rounded).all())
+
+    def define_chunks(self, profile=FULL_PROFILE, prefix=None):
+        """
+        The <position> tags of all vertices as a single
+        gdml_tags.TagChunk, no bs4 objects are created
+
+        Keyword Args:
+            profile (OutputProfile) : precision and naming of the output.
+                                      If the rounding would change the validity
+                                      of a facet, the full precision is written.
+            prefix (str)            : the vertex name prefix, if not given
+                                      see vertex_prefix
+        """
+        if prefix is None:
+            prefix = self.vertex_prefix(profile)
+        count('tags_emitted', self.nvertices)
+        rendered = self._rendered(profile)
+        if rendered is not None:
+            return [self._spliced_chunk(rendered['define'], prefix)]
+        if (profile.digits is not None) and (not self.rounding_is_safe(profile.digits)):
+            LOG.warning(f'{self.name} : rounding to {profile.digits} digits changes facets, keeping full precision')
+            profile = dataclasses.replace(profile, digits=None)
+        return [PositionTag.create_chunk(self.vertices,\
+                                         prefix,\
+                                         unit=self.unit,\
+                                         profile=profile)]
+
+    def solid_chunk(self, use_name=None, profile=FULL_PROFILE, prefix=None):
+        """
+        The <tessellated> tag as gdml_tags.TagChunk, no bs4
+        objects are created. Same naming as solid_tag.
+
+        Keyword Args:
+            profile (OutputProfile) : naming of the vertices
+            prefix (str)            : the vertex name prefix, if not given
+                                      see vertex_prefix
+        """
+        if prefix is None:
+            prefix = self.vertex_prefix(profile)
+        attrs = dict(self.tessell_attrs)
+        # follow new convetion - everything in the solid
+        # section ends with _s
+        attrs['name'] = attrs['name'] + '_s'
+        if use_name is not None:
+            attrs['name'] = use_name
+        count('tags_emitted', self.nfaces + 1)
+        chunk = TessellatedTag.create_chunk(attrs,\
+                                            self.triangular_attrs,\
+                                            self.faces,\
+                                            prefix,\
+                                            profile=profile)
+        rendered = self._rendered(profile)
+        if rendered is not None:
+            spliced = self._spliced_chunk(rendered['solid'], prefix)
+            chunk.template, chunk.rows = spliced.template, spliced.rows
+        return chunk
+
+    def render_lines(self, profile=FULL_PROFILE):
+        """
+        Format the lines of the define and solid chunks once and
+        keep them, so that they can be written again (e.g. by an
+        incremental build) without formatting every number. The
+        vertex name prefix is left open, so the lines do not depend
+        on the identifier. Changing the vertices or facets throws
+        the lines away, and they are not used anymore once the unit,
+        the transform or the attributes of the tags have changed
+        (see _render_key).
+
+        Keyword Args:
+            profile (OutputProfile) : the output profile
+
+        Returns:
+            dict : 'define' and 'solid' -> list of str,
+                   'attrs' -> the _render_key they were made for
+        """
+        rendered = self._rendered(profile)
+        if rendered is None:
+            self.rendered_lines.pop(profile, None)
+            rendered = {'define' : self.define_chunks(profile=profile, prefix=PREFIX_PLACEHOLDER)[0].lines(),\
+                        'solid'  : self.solid_chunk(profile=profile, prefix=PREFIX_PLACEHOLDER).lines(),\
+                        'attrs'  : self._render_key()}
+            self.rendered_lines[profile] = rendered
+        return rendered
+
+    def _render_key(self):
+        """
+        Everything besides the vertices and facets the rendered lines
+        depend on, as a string, so that it survives the incremental
+        cache (json)
+        """
+        transform = None if self._transform is None else self._transform.tolist()
+        return repr((self.unit,\
+                     transform,\
+                     sorted(self.tessell_attrs.items()),\
+                     sorted(self.triangular_attrs.items())))
+
+    def _rendered(self, profile):
+        """
+        The rendered lines for a profile, None if there are
+        none or they have been made for other attributes
+        """
+        rendered = self.rendered_lines.get(profile)
+        if (rendered is None) or (rendered.get('attrs') != self._render_key()):
+            return None
+        return rendered
+
+    @staticmethod
+    def _spliced_chunk(lines, prefix):
+        """
+        A TagChunk made of rendered lines, see render_lines
+        """
+        def rows():
+            for line in lines:
+                yield (line.replace(PREFIX_PLACEHOLDER, prefix),)
+        return TagChunk('%s', rows)
+
     def volume_tag(self, material, fix_solid_reference=True):
         name = self.name
         if fix_solid_reference:
@@ -2,11 +2,179 @@
 Read/Emit gdml tags from the actual quantities.
 """
 import bs4
+import dataclasses
+import numpy as np
+from bs4.dammit import EntitySubstitution
 
 from copy import copy
 
 ###########################################3
 
+# attribute values which are the default in the gdml schema,
+# and can be left out of the file
+GDML_DEFAULTS = {'position'    : {'unit'  : 'mm'},\
+                 'tessellated' : {'lunit' : 'mm'},\
+                 'triangular'  : {'type'  : 'ABSOLUTE'}}
+
+def drop_defaults(tagname, attrs):
+    """
+    Remove the attributes which have the default value of the
+    gdml schema
+
+    Args:
+        tagname (str) : the name of the tag, e.g. 'position'
+        attrs (dict)  : attribute name -> value
+    """
+    defaults = GDML_DEFAULTS.get(tagname, {})
+    return {k: attrs[k] for k in attrs if defaults.get(k, None) != attrs[k]}
+
+def with_defaults(tagname, attrs):
+    """
+    The opposite of drop_defaults, add the attributes which
+    have been left out with the default value of the gdml schema.
+    This has to be done by every reader, so that files written
+    with drop_defaults can be read again.
+
+    Args:
+        tagname (str) : the name of the tag, e.g. 'tessellated'
+        attrs (dict)  : attribute name -> value
+    """
+    attrs = dict(attrs)
+    for k, v in GDML_DEFAULTS.get(tagname, {}).items():
+        attrs.setdefault(k, v)
+    return attrs
+
+###########################################3
+
+def round_significant(values, digits):
+    """
+    Round to a number of significant digits, exactly the
+    way the values are written with an OutputProfile
+
+    Args:
+        values (np.ndarray) : float array
+        digits (int)        : significant digits
+    """
+    values = np.asarray(values, dtype=np.float64)
+    fmt = f'%.{digits}g'
+    rounded = map(float, map(fmt.__mod__, values.ravel().tolist()))
+    return np.fromiter(rounded, dtype=np.float64, count=values.size).reshape(values.shape)
+
+###########################################3
+
+@dataclasses.dataclass(frozen=True)
+class OutputProfile:
+    """
+    Controls how the vertices and facets of the tessellated
+    solids are written. The default writes the full precision.
+    """
+    # significant digits for the vertex coordinates,
+    # None writes the exact value (repr)
+    digits        : int  = None
+    # count the vertices in hex, which gives shorter names
+    short_names   : bool = False
+    # leave out attributes which have the default value, see GDML_DEFAULTS
+    drop_defaults : bool = False
+    # indent the file like BeautifulSoup.prettify
+    indent        : bool = True
+
+    @property
+    def float_format(self):
+        if self.digits is None:
+            return '%r'
+        return f'%.{self.digits}g'
+
+    @property
+    def index_format(self):
+        if self.short_names:
+            return '%x'
+        return '%d'
+
+FULL_PROFILE    = OutputProfile()
+COMPACT_PROFILE = OutputProfile(digits=10,\
+                                short_names=True,\
+                                drop_defaults=True,\
+                                indent=False)
+PROFILES        = {'full'    : FULL_PROFILE,\
+                   'compact' : COMPACT_PROFILE}
+
+###########################################3
+
+def format_attrs(attrs, raw=()):
+    """
+    Format tag attributes the same way as bs4 does it,
+    sorted by name and quoted/escaped.
+
+    Args:
+        attrs (dict) : attribute name -> value
+
+    Keyword Args:
+        raw (tuple)  : names of attributes which are inserted
+                       as they are, e.g. format placeholders
+    """
+    text = ''
+    for key in sorted(attrs):
+        value = attrs[key]
+        if key in raw:
+            text += f' {key}="{value}"'
+            continue
+        if value is None:
+            value = ''
+        value = EntitySubstitution.substitute_xml(str(value), make_quoted_attribute=True)
+        text += f' {key}={value}'
+    return text
+
+###########################################3
+
+class TagChunk(object):
+    """
+    Preformatted text for either a single tag with children
+    (e.g. <tessellated>) or for a sequence of sibling tags
+    (e.g. the <position> tags of a solid). For GdmlFileMinimal,
+    it can be used in place of a bs4.element.Tag, but the text
+    is only generated from the templates when it gets written.
+    """
+
+    def __init__(self, template, rows, open_tag=None, close_tag=None, attrs=None):
+        """
+        Args:
+            template (str) : %-format template for a single line
+            rows (callable): returns the tuples to fill in the template
+
+        Keyword Args:
+            open_tag (str)  : opening tag, in case the lines are children
+            close_tag (str) : closing tag, in case the lines are children
+            attrs (dict)    : attributes of the tag
+        """
+        self.template = template
+        self.rows = rows
+        self.open_tag = open_tag
+        self.close_tag = close_tag
+        self.attrs = attrs if attrs is not None else dict()
+
+    def lines(self):
+        template = self.template
+        return [template % row for row in self.rows()]
+
+    def prettify(self):
+        """
+        The text indented as bs4.element.Tag.prettify does it
+        """
+        if self.open_tag is None:
+            return ''.join([k + '\n' for k in self.lines()])
+        body = ''.join([' ' + k + '\n' for k in self.lines()])
+        return self.open_tag + '\n' + body + self.close_tag + '\n'
+
+    def decode(self):
+        """
+        The text without indentation
+        """
+        if self.open_tag is None:
+            return '\n'.join(self.lines())
+        return self.open_tag + ''.join(self.lines()) + self.close_tag
+
+###########################################3
+
 class PositionTag(object):
 
     @staticmethod
@@ -29,6 +197,37 @@ class PositionTag(object):
                               attrs=attrs)
         return tag
 
+    @staticmethod
+    def create_chunk(vertices, name_prefix, unit='mm', profile=FULL_PROFILE):
+        """
+        Emit the <position> tags for all vertices at once. The
+        vertex with index k gets the name name_prefix + k
+
+        Args:
+            vertices (np.ndarray)  : (N,3) vertex array
+            name_prefix (str)      : prefix for the vertex names
+
+        Keyword Args:
+            unit (str)             : the length unit
+            profile (OutputProfile): precision and naming of the output
+        """
+        fmt = profile.float_format
+        attrs = {'name' : name_prefix.replace('%', '%%') + profile.index_format,\
+                 'x'    : fmt,\
+                 'y'    : fmt,\
+                 'z'    : fmt}
+        if unit is not None:
+            attrs['unit'] = unit.replace('%', '%%')
+        if profile.drop_defaults:
+            attrs = drop_defaults('position', attrs)
+        template = '<position' + format_attrs(attrs, raw=('name', 'x', 'y', 'z')) + '/>'
+
+        def rows():
+            for k, vertex in enumerate(vertices.tolist()):
+                yield (k, vertex[0], vertex[1], vertex[2])
+
+        return TagChunk(template, rows)
+
 ##########################################################
 
 class ScaleTag(object):
@@ -113,17 +312,59 @@ class TessellatedTag(object):
             tesselltag.append(copy(ttag))
         return tesselltag
 
+    @staticmethod
+    def create_chunk(tessell_attrs, triangular_attrs, faces, name_prefix, profile=FULL_PROFILE):
+        """
+        Emit the <tessellated> tag with all its facets at once.
+
+        Args:
+            tessell_attrs (dict)    : attributes of the <tessellated> tag
+            triangular_attrs (dict) : attributes of the <triangular> tags
+            faces (np.ndarray)      : (M,3) vertex indices of the facets
+            name_prefix (str)       : prefix of the vertex names, the vertex
+                                      with index k is name_prefix + k
+
+        Keyword Args:
+            profile (OutputProfile) : naming of the vertices, has to be
+                                      the same as for the <position> tags
+        """
+        if profile.drop_defaults:
+            tessell_attrs = drop_defaults('tessellated', tessell_attrs)
+            triangular_attrs = drop_defaults('triangular', triangular_attrs)
+        attrs = {k: str(triangular_attrs[k]).replace('%', '%%') for k in triangular_attrs}
+        vname = name_prefix.replace('%', '%%') + profile.index_format
+        attrs['vertex1'] = vname
+        attrs['vertex2'] = vname
+        attrs['vertex3'] = vname
+        template = '<triangular' + format_attrs(attrs, raw=('vertex1', 'vertex2', 'vertex3')) + '/>'
+        open_tag = '<tessellated' + format_attrs(tessell_attrs) + '>'
+
+        def rows():
+            return map(tuple, faces.tolist())
+
+        return TagChunk(template, rows,\
+                        open_tag=open_tag,\
+                        close_tag='</tessellated>',\
+                        attrs=dict(tessell_attrs))
+
 ###########################################3
 
 class RotationTag(object):
     @staticmethod
-    def create(name, axis='x',value=90):
+    def create(name, axis='x',value=90, angles=None):
+        """
+        Keyword Args:
+            angles (dict) : angles for several axes, e.g. {'x' : 90, 'z' : 45},
+                            replaces axis and value
+        """
         rtag = bs4.element.Tag(name='rotation',\
                                is_xml=True,\
                                can_be_empty_element=True)
-        attrs = {'name' : name,\
-                 axis   : value,\
-                 'unit' : "deg"}
+        if angles is None:
+            angles = {axis : value}
+        attrs = {'name' : name}
+        attrs.update(angles)
+        attrs['unit'] = "deg"
         rtag.attrs = attrs
         return rtag
 #class DefineTag(object):
@@ -1,3 +1,25 @@
+"""
+Normalize the names in gdml files, the CAD exporter writes
+names with characters which Geant4 does not like.
+"""
+
+from collections import defaultdict
+
+from lxml import etree
+
+import logging
+LOG = logging
+try:
+    import hepbasestack as hep
+    from . import __package_loglevel__
+    LOG = hep.logger.get_logger(__package_loglevel__)
+    del logging
+except ImportError:
+    pass
+
+from .gdml_io import open_file
+
+#############################################################3
 
 def remove_invalid(name):
     """
@@ -43,3 +65,171 @@ def normalize_name(name):
         parts = ''.join(parts[:-1])
     parts = remove_invalid(parts)
     return parts + f'__uid{id_number}'
+
+#############################################################3
+
+# tag -> kind of the name it defines, for the tags which get
+# a normalized name. Names of the same kind have to be unique.
+# Physvol names are not referenced, they don't need to be unique.
+DEFINITIONS = {'position'    : 'define',\
+               'tessellated' : 'solid',\
+               'volume'      : 'volume',\
+               'physvol'     : None}
+
+# tag -> (kind of the referenced name, attributes) for the
+# tags which refer to names, the references are renamed
+# the same way as the names they refer to
+REFERENCES = {'positionref'  : ('define', ('ref',)),\
+              'solidref'     : ('solid',  ('ref',)),\
+              'volumeref'    : ('volume', ('ref',)),\
+              'triangular'   : ('define', ('vertex1', 'vertex2', 'vertex3')),\
+              'quadrangular' : ('define', ('vertex1', 'vertex2', 'vertex3', 'vertex4'))}
+
+class NameNormalizer(object):
+    """
+    Normalize all names in a gdml file (see normalize_name) in a
+    single pass, together with the references to them. Every name
+    is normalized once, references are looked up in the names which
+    have been seen so far, so a reference to something which is not
+    renamed (e.g. a box) stays intact. Names which become the same
+    after the normalization (remove_invalid strips characters) get
+    a counter appended, and are reported as collisions.
+    """
+
+    def __init__(self, normalize=normalize_name):
+        """
+        Keyword Args:
+            normalize (callable) : the function to normalize a single name
+        """
+        self.normalize = normalize
+        # kind -> original name -> new name
+        self.renamed = defaultdict(dict)
+        # kind -> new name -> original name
+        self.taken = defaultdict(dict)
+        # (kind, original name, normalized name, new name)
+        self.collisions = []
+        # (kind, name) of references to unknown names
+        self.unresolved = set()
+
+    def define(self, kind, name):
+        """
+        The new name for a definition
+
+        Args:
+            kind (str) : see DEFINITIONS
+            name (str) : the original name
+        """
+        renamed = self.renamed[kind]
+        if name in renamed:
+            return renamed[name]
+        new_name = self.normalize(name)
+        if kind is not None:
+            taken = self.taken[kind]
+            if new_name in taken:
+                normalized = new_name
+                counter = 1
+                while f'{normalized}_{counter}' in taken:
+                    counter += 1
+                new_name = f'{normalized}_{counter}'
+                self.collisions.append((kind, name, normalized, new_name))
+                LOG.warning(f'{name} and {taken[normalized]} are both normalized to {normalized}, using {new_name}')
+            taken[new_name] = name
+        renamed[name] = new_name
+        return new_name
+
+    def resolve(self, kind, name):
+        """
+        The new name for a reference
+
+        Args:
+            kind (str) : see REFERENCES
+            name (str) : the original name it refers to
+        """
+        try:
+            return self.renamed[kind][name]
+        except KeyError:
+            self.unresolved.add((kind, name))
+            return name
+
+    def rename(self, tagname, attrs):
+        """
+        Rename the attributes of a single tag in place
+
+        Args:
+            tagname (str) : the name of the tag
+            attrs (dict)  : its attributes, e.g. bs4's Tag.attrs
+                            or lxml's Element.attrib
+        """
+        if tagname in DEFINITIONS:
+            name = attrs.get('name')
+            if name is not None:
+                attrs['name'] = self.define(DEFINITIONS[tagname], name)
+        elif tagname in REFERENCES:
+            kind, keys = REFERENCES[tagname]
+            for key in keys:
+                name = attrs.get(key)
+                if name is not None:
+                    attrs[key] = self.resolve(kind, name)
+
+    def normalize_tree(self, gdml):
+        """
+        Rename all tags of a BeautifulSoup tree in place,
+        in document order
+
+        Args:
+            gdml (BeautifulSoup) : the gdml tree
+        """
+        for tag in gdml.find_all(list(DEFINITIONS) + list(REFERENCES)):
+            self.rename(tag.name, tag.attrs)
+        return gdml
+
+    def normalize_file(self, infile, outfile, pretty_print=True, level=None):
+        """
+        Rename all tags while streaming a file from infile
+        to outfile, no tree is built
+
+        Args:
+            infile (str)        : the gdml file to read, can be compressed
+            outfile (str)       : the file to write, can be compressed
+
+        Keyword Args:
+            pretty_print (bool) : indent the output
+            level (int)         : compression level for outfile
+        """
+        # gdml_parsers imports this module via gdml_solid
+        from .gdml_parsers import _iterparse
+
+        with open_file(outfile, 'wb', level=level) as handle,\
+             etree.xmlfile(handle, encoding='utf-8') as xf:
+            xf.write_declaration()
+            depth = 0
+            root = None
+            for event, element in _iterparse(infile, events=('start', 'end'), remove_comments=True):
+                if event == 'start':
+                    depth += 1
+                    if depth == 1:
+                        root = xf.element(element.tag, dict(element.attrib), nsmap=element.nsmap)
+                        root.__enter__()
+                        xf.write('\n')
+                        continue
+                    self.rename(etree.QName(element).localname, element.attrib)
+                    continue
+                depth -= 1
+                if depth == 1:
+                    xf.write(element, pretty_print=pretty_print)
+                    element.clear()
+                    while element.getprevious() is not None:
+                        del element.getparent()[0]
+            if root is not None:
+                root.__exit__(None, None, None)
+
+    def report(self):
+        """
+        A summary of the renaming, e.g. to show to the user
+
+        Returns:
+            dict : number of renamed names, collisions and unresolved references
+        """
+        return {'renamed'    : sum([len(k) for k in self.renamed.values()]),\
+                'collisions' : len(self.collisions),\
+                'unresolved' : len(self.unresolved)}
@@ -0,0 +1,315 @@
+#! /usr/bin/env python
+
+"""
+Measure the throughput of reading, cleaning, registering and
+writing tessellated solids with synthetic gdml files of different
+sizes. The results are written to a json file, so that they can
+be compared between releases.
+"""
+
+import os
+import os.path
+import json
+import platform
+import resource
+import shutil
+import tempfile
+import time
+import tracemalloc
+
+import numpy as np
+
+import pygdml
+from pygdml.gdml_parsers import extract_tessellated_solids_from_file, PARSERS
+from pygdml.gdml_file import GdmlFileMinimal
+from pygdml.gdml_physvol import GdmlPhysVol
+from pygdml.gdml_rotation import euler_to_matrix
+from pygdml.gdml_instrument import set_quiet
+
+# the stages which are timed, in the order they run
+STAGES = ('extract_tessellated_solids',\
+          'remove_invalid_triangles',\
+          'register_myself',\
+          'write_to_file')
+
+# (number of solids, facets per solid) for each size
+SIZES = {'small'  : (10, 500),\
+         'medium' : (100, 2000),\
+         'large'  : (400, 5000)}
+
+##############################################################
+
+def torus(nfacets, radius=50., tube=10.):
+    """
+    A closed triangle mesh with (about) the given number of facets
+
+    Args:
+        nfacets (int) : number of facets, rounded to a multiple of 2
+
+    Keyword Args:
+        radius (float) : the major radius
+        tube (float)   : the minor radius
+
+    Returns:
+        tuple (np.ndarray, np.ndarray) : vertices and faces
+    """
+    m = max(3, int(np.sqrt(nfacets / 2.)))
+    n = max(3, nfacets // (2 * m))
+    u, v = np.meshgrid(np.linspace(0, 2*np.pi, n, endpoint=False),\
+                       np.linspace(0, 2*np.pi, m, endpoint=False),\
+                       indexing='ij')
+    vertices = np.stack(((radius + tube*np.cos(v))*np.cos(u),\
+                         (radius + tube*np.cos(v))*np.sin(u),\
+                         tube*np.sin(v)), axis=-1).reshape(-1, 3)
+    i, j = np.meshgrid(np.arange(n), np.arange(m), indexing='ij')
+    a = i*m + j
+    b = ((i + 1) % n)*m + j
+    c = ((i + 1) % n)*m + (j + 1) % m
+    d = i*m + (j + 1) % m
+    faces = np.concatenate((np.stack((a, b, c), axis=-1).reshape(-1, 3),\
+                            np.stack((a, c, d), axis=-1).reshape(-1, 3)))
+    return vertices, faces
+
+##############################################################
+
+def generate(filename,\
+             nsolids=10,\
+             nfacets=1000,\
+             duplicates=0.,\
+             extra_defines=0,\
+             invalid=0.,\
+             seed=42):
+    """
+    Write a synthetic gdml file in the layout of the CAD exporter:
+    one define section with the vertices, followed by one solids
+    section with the tessellated solid, for every part.
+
+    Args:
+        filename (str)        : the file to write
+
+    Keyword Args:
+        nsolids (int)         : number of tessellated solids
+        nfacets (int)         : number of facets per solid
+        duplicates (float)    : fraction of the solids which are rotated
+                                and translated copies of another one
+        extra_defines (int)   : number of additional define sections with
+                                a single position, between the parts
+        invalid (float)       : fraction of facets which are degenerate,
+                                so that they are removed by the cleaning
+        seed (int)            : seed for the random placements
+
+    Returns:
+        int : number of facets in the file
+    """
+    rng = np.random.default_rng(seed)
+    originals = []
+    total = 0
+    extra = set(rng.choice(nsolids, size=min(extra_defines, nsolids), replace=False).tolist())
+    with open(filename, 'w') as f:
+        f.write('<?xml version="1.0" encoding="UTF-8" standalone="no" ?>\n')
+        f.write('<gdml xmlns:xsi="http://www.w3.org/2001/XMLSchema-instance" '
+                'xsi:noNamespaceSchemaLocation="http://service-spi.web.cern.ch/service-spi/app/releases/GDML/schema/gdml.xsd">\n')
+        f.write('<materials>\n'
+                '<element Z="13" formula="Al" name="Al"><atom value="26.98"/></element>\n'
+                '<material name="ALUMINUM" state="solid"><D unit="g/cm3" value="2.7"/>'
+                '<fraction n="1" ref="Al"/></material>\n'
+                '</materials>\n')
+        for k in range(nsolids):
+            if originals and (rng.random() < duplicates):
+                vertices, faces = originals[rng.integers(len(originals))]
+            else:
+                vertices, faces = torus(nfacets, radius=20. + 60.*rng.random())
+                originals.append((vertices, faces))
+            angles = dict(zip('xyz', (360.*rng.random(3)).tolist()))
+            vertices = vertices @ euler_to_matrix(angles).T + 1000.*rng.random(3)
+            faces = faces.copy()
+            ninvalid = int(invalid*len(faces))
+            if ninvalid:
+                # collapse facets onto one of their vertices
+                bad = rng.choice(len(faces), size=ninvalid, replace=False)
+                faces[bad, 1] = faces[bad, 0]
+            total += len(faces)
+
+            if k in extra:
+                f.write(f'<define>\n<position name="origin{k}" unit="mm" x="0" y="0" z="0"/>\n</define>\n')
+            f.write('<define>\n')
+            for i, v in enumerate(vertices):
+                f.write(f'<position name="part{k}-v{i}" unit="mm" x="{v[0]!r}" y="{v[1]!r}" z="{v[2]!r}"/>\n')
+            f.write('</define>\n<solids>\n')
+            f.write(f'<tessellated aunit="deg" lunit="mm" name="part{k}">\n')
+            for a, b, c in faces:
+                f.write(f'<triangular type="ABSOLUTE" vertex1="part{k}-v{a}" vertex2="part{k}-v{b}" vertex3="part{k}-v{c}"/>\n')
+            f.write('</tessellated>\n</solids>\n')
+        f.write('<structure/>\n<setup name="Default" version="1.0"><world ref="World"/></setup>\n</gdml>\n')
+    return total
+
+##############################################################
+
+def run_stages(infile, outfile, parser='lxml'):
+    """
+    Run the stages once and record the time of each one
+
+    Args:
+        infile (str)  : the gdml file to read
+        outfile (str) : the gdml file to write
+
+    Keyword Args:
+        parser (str)  : see gdml_parsers.PARSERS
+
+    Returns:
+        dict : stage -> (time in s, peak of the traced memory in bytes).
+               The memory is only available if tracemalloc is running,
+               and does not include the memory allocated by lxml.
+    """
+    result = dict()
+    tracing = tracemalloc.is_tracing()
+
+    def record(stage, start):
+        peak = None
+        if tracing:
+            peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.reset_peak()
+        result[stage] = (time.perf_counter() - start, peak)
+
+    start = time.perf_counter()
+    solids = extract_tessellated_solids_from_file(infile, parser=parser)
+    record('extract_tessellated_solids', start)
+
+    start = time.perf_counter()
+    for s in solids:
+        s.remove_invalid_triangles()
+    record('remove_invalid_triangles', start)
+
+    # an existing file would be opened and locked
+    if os.path.exists(outfile):
+        os.remove(outfile)
+    start = time.perf_counter()
+    gdml_file = GdmlFileMinimal(outfile)
+    gdml_file.copy_materials_from_file(infile)
+    gdml_file.add_antarctic_air_material()
+    gdml_file.register_physvols([GdmlPhysVol(s.name, (0, 0, 0), solid=s, material='ALUMINUM', counter=k)\
+                                 for k, s in enumerate(solids)])
+    gdml_file.add_world([10000, 10000, 10000])
+    record('register_myself', start)
+
+    start = time.perf_counter()
+    gdml_file.write_to_file()
+    record('write_to_file', start)
+    return result
+
+##############################################################
+
+def benchmark(nsolids, nfacets, repeat=3, parser='lxml', **kwargs):
+    """
+    Generate a file and time all stages. The time is the best of
+    all runs, the memory is measured in an extra run with tracemalloc,
+    which would slow down the timed runs.
+
+    Args:
+        nsolids (int) : number of solids in the file
+        nfacets (int) : facets per solid
+
+    Keyword Args:
+        repeat (int)  : number of timed runs
+        parser (str)  : see gdml_parsers.PARSERS
+        **kwargs      : passed on to generate
+
+    Returns:
+        dict : the parameters, the size of the file and the results per stage
+    """
+    tmpdir = tempfile.mkdtemp()
+    infile = os.path.join(tmpdir, 'synthetic.gdml')
+    outfile = os.path.join(tmpdir, 'synthetic-out.gdml')
+    try:
+        facets = generate(infile, nsolids=nsolids, nfacets=nfacets, **kwargs)
+        times = {k: [] for k in STAGES}
+        for _ in range(repeat):
+            for stage, (duration, _) in run_stages(infile, outfile, parser=parser).items():
+                times[stage].append(duration)
+        tracemalloc.start()
+        try:
+            memory = run_stages(infile, outfile, parser=parser)
+        finally:
+            tracemalloc.stop()
+        stages = dict()
+        for stage in STAGES:
+            best = min(times[stage])
+            stages[stage] = {'time'          : best,\
+                             'facets_per_s'  : facets/best if best > 0 else None,\
+                             'peak_memory'   : memory[stage][1]}
+        return {'nsolids'     : nsolids,\
+                'nfacets'     : nfacets,\
+                'facets'      : facets,\
+                'parser'      : parser,\
+                'parameters'  : kwargs,\
+                'input_size'  : os.path.getsize(infile),\
+                'output_size' : os.path.getsize(outfile),\
+                'stages'      : stages}
+    finally:
+        shutil.rmtree(tmpdir)
+
+##############################################################
+
+if __name__ == '__main__':
+
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Benchmark pygdml with synthetic gdml files.')
+    parser.add_argument('--sizes', dest='sizes', nargs='+',
+                        default=['small', 'medium'], choices=list(SIZES),
+                        help='The sizes to run, see SIZES')
+    parser.add_argument('--duplicates', dest='duplicates',
+                        type=float, default=0.,
+                        help='Fraction of the solids which are copies of another one')
+    parser.add_argument('--extra-defines', dest='extra_defines',
+                        type=int, default=0,
+                        help='Number of additional define sections between the parts')
+    parser.add_argument('--invalid', dest='invalid',
+                        type=float, default=0.,
+                        help='Fraction of degenerate facets')
+    parser.add_argument('--parser', dest='parser',
+                        default='lxml', choices=PARSERS,
+                        help='The parser backend')
+    parser.add_argument('--repeat', dest='repeat',
+                        type=int, default=3,
+                        help='Take the best time of this many runs')
+    parser.add_argument('--generate', dest='generate',
+                        type=str, default=None,
+                        help='Only write a synthetic file of the first size to this filename')
+    parser.add_argument('-o', '--output', dest='output',
+                        type=str, default='benchmark.json',
+                        help='Write the results to this json file')
+    args = parser.parse_args()
+    # the progress bars would end up in the timings
+    set_quiet(True)
+
+    options = {'duplicates'    : args.duplicates,\
+               'extra_defines' : args.extra_defines,\
+               'invalid'       : args.invalid}
+    if args.generate is not None:
+        nsolids, nfacets = SIZES[args.sizes[0]]
+        facets = generate(args.generate, nsolids=nsolids, nfacets=nfacets, **options)
+        print (f'Wrote {nsolids} solids with {facets} facets to {args.generate}')
+        raise SystemExit
+
+    results = []
+    for size in args.sizes:
+        nsolids, nfacets = SIZES[size]
+        result = benchmark(nsolids, nfacets, repeat=args.repeat, parser=args.parser, **options)
+        result['size'] = size
+        results.append(result)
+        print (f'{size} ({nsolids} solids, {result["facets"]} facets)')
+        for stage in STAGES:
+            res = result['stages'][stage]
+            print (f'  {stage:>28} {res["time"]:>8.3f} s {res["peak_memory"]/1e6:>10.1f} MB')
+
+    report = {'pygdml'   : pygdml.__version__,\
+              'python'   : platform.python_version(),\
+              'platform' : platform.platform(),\
+              'date'     : time.strftime('%Y-%m-%dT%H:%M:%S'),\
+              # the high water mark of the whole process in kB
+              'max_rss'  : resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,\
+              'results'  : results}
+    with open(args.output, 'w') as f:
+        json.dump(report, f, indent=2)
+    print (f'Results written to {args.output}')
@@ -0,0 +1,77 @@
+#! /usr/bin/env python
+
+"""
+Compare reading and writing of a gdml file as plain text
+and compressed with each of the available codecs.
+"""
+
+import os
+import os.path
+import shutil
+import tempfile
+import time
+
+from pygdml.gdml_io import CODECS, open_file, zstandard
+from pygdml.gdml_parsers import extract_tessellated_solids_lxml
+
+def benchmark(infile, extension, level=None, repeat=1):
+    """
+    Write the file with a codec, then read it back with the
+    streaming parser.
+
+    Args:
+        infile (str)    : a plain gdml file
+        extension (str) : '' for plain text or one of gdml_io.CODECS
+
+    Keyword Args:
+        level (int)     : compression level
+        repeat (int)    : take the best of this many runs
+
+    Returns:
+        dict : size of the file and times for writing and reading
+    """
+    tmpdir = tempfile.mkdtemp()
+    outfile = os.path.join(tmpdir, 'benchmark.gdml' + extension)
+    write_time, read_time = [], []
+    try:
+        for _ in range(repeat):
+            start = time.perf_counter()
+            with open(infile, 'rb') as src, open_file(outfile, 'wb', level=level) as dst:
+                shutil.copyfileobj(src, dst, 2**22)
+            write_time.append(time.perf_counter() - start)
+
+            start = time.perf_counter()
+            solids = extract_tessellated_solids_lxml(outfile)
+            read_time.append(time.perf_counter() - start)
+        return {'size'   : os.path.getsize(outfile),\
+                'write'  : min(write_time),\
+                'read'   : min(read_time),\
+                'solids' : len(solids)}
+    finally:
+        shutil.rmtree(tmpdir)
+
+if __name__ == '__main__':
+
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Benchmark reading and writing compressed gdml files against plain text.')
+    parser.add_argument('infile', metavar='infile', type=str,
+                        help='Input .gdml file (plain text)')
+    parser.add_argument('--level', dest='level',
+                        type=int, default=None,
+                        help='Compression level, if not given the default of each codec is used')
+    parser.add_argument('--repeat', dest='repeat',
+                        type=int, default=1,
+                        help='Take the best time of this many runs')
+    args = parser.parse_args()
+
+    raw_size = os.path.getsize(args.infile)
+    extensions = [''] + [k for k in CODECS if (CODECS[k] != 'zstd') or (zstandard is not None)]
+    print (f'{"codec":>6} {"size [MB]":>10} {"ratio":>6} {"write [MB/s]":>13} {"parse [MB/s]":>13} {"parse [s]":>10}')
+    for ext in extensions:
+        result = benchmark(args.infile, ext, level=args.level, repeat=args.repeat)
+        codec = CODECS.get(ext, 'plain')
+        # throughput in terms of uncompressed xml
+        print (f'{codec:>6} {result["size"]/1e6:>10.2f} {raw_size/result["size"]:>6.1f}'
+               f' {raw_size/1e6/result["write"]:>13.1f} {raw_size/1e6/result["read"]:>13.1f}'
+               f' {result["read"]:>10.2f}')
@@ -3,15 +3,20 @@
 import bs4
 import os
 import os.path
-import tqdm
 import sys
-import time
-from copy import copy, deepcopy
-
-from pygdml.gdml_parsers import extract_tessellated_solids
-from pygdml.renormalize_names import normalize_name
-from pygdml.gdml_file import GdmlFileMinimal
-from pygdml.gdml_physvol import GdmlPhysVol
+from functools import partial
+
+from pygdml.gdml_parsers import extract_tessellated_solids, extract_tessellated_solids_lxml,\
+                               read_root_tag, PARSERS
+from pygdml.renormalize_names import NameNormalizer
+from pygdml.gdml_file import GdmlFileMinimal, open_gdml
+from pygdml.gdml_io import open_file, strip_codec
+from pygdml.gdml_tags import PROFILES
+from pygdml.gdml_physvol import GdmlPhysVol, absorb_solid_transforms
+from pygdml.gdml_pipeline import run_stage, clean_facets, center_and_clean, weld, decimate
+from pygdml.gdml_dedup import instance_physvols
+from pygdml.gdml_incremental import Manifest
+import pygdml.gdml_instrument as instrument
 
 import logging
 LOG = logging
@@ -50,23 +55,6 @@ except ImportError:
 ##################################
 
 
-def reformat(name, extra_count, extra2):
-    """
-    Reformat vertex names. Add additional counters for identification
-
-    Args:
-        name:
-        extra_count:
-        extra2:
-
-    Returns:
-        str : new (reformatted) name
-    """
-    rname = 'v' + name + '_' + str(extra_count) + '_' + str(extra2)
-    return rname
-
-##################################
-
 def g4_validator(infile):
     """
     Use the Geant4 GDML parser to validate the gdml file.
@@ -95,115 +83,49 @@ def g4_validator(infile):
     
 def fix_names(gdml):
     """
-    In the case that the vertex names are just simple integers,
-    fix them.
+    Remove invalid characters from the names of the tessellated
+    solids, volumes, physvols and positions, and from all the
+    references to them, see renormalize_names.NameNormalizer
 
     Args:
-        gdml (BeautifulSoup) : input gdml 
+        gdml (BeautifulSoup) : input gdml
     """
-    # first, we remove all invalid characters
-
-    print (f'===> Removing invalid characters from xml-tree!')
- 
-    tess       = gdml.find_all("tessellated") #, limit=10) 
-    sref       = gdml.find_all("solidref") #, limit=10) 
-    vref       = gdml.find_all("volumeref")
-    lvols      = gdml.find_all("volume")
-    physvol    = gdml.find_all("physvol")
-    poss       = gdml.find_all("position")
-    possref    = gdml.find_all("positionref")   
-    tris       = gdml.find_all("triangular")
- 
-    for k in tqdm.tqdm(vref, desc='cleaning volumerefs'):
-        k.attrs['ref']  = normalize_name(k.attrs['ref'])
-    for k in tqdm.tqdm(physvol, desc='cleaning physvols'):
-        k.attrs['name'] = normalize_name(k.attrs['name'])
-    for k in tqdm.tqdm(tess, desc='cleaning tesselated solids'):
-        k.attrs['name'] = normalize_name(k.attrs['name'])
-    for k in tqdm.tqdm(lvols, desc='cleaning volumes'):
-        k.attrs['name'] = normalize_name(k.attrs['name'])
-    for k in tqdm.tqdm(sref, desc='cleaning tessellateds'):
-        k.attrs['ref']  = normalize_name(k.attrs['ref'])
-    for k in tqdm.tqdm(poss, desc='cleaning posiitions'):
-        k.attrs['name']  = normalize_name(k.attrs['name'])
-    for k in tqdm.tqdm(possref, desc='cleaning positionref'):
-        k.attrs['ref']  = normalize_name(k.attrs['ref'])
-    for k in tqdm.tqdm(tris, desc='cleaning triangulars'):
-        k.attrs['vertex1']  = normalize_name(k.attrs['vertex1'])
-        k.attrs['vertex2']  = normalize_name(k.attrs['vertex2'])
-        k.attrs['vertex3']  = normalize_name(k.attrs['vertex3'])
-
-    print (f'===> DONE!')
-    time.sleep(2)
-
-
-    n_define = 0
-    namestore = {}
-    cc = 0 #continuous_counter
-    defines = gdml.find_all('define')
-    solids  = gdml.find_all('solids')
-    if (len(defines) != len(solids)):
-        raise ValueError(f'We have {len(solids)} solids for {len(defines)}')
-
-
-    ndefines = len(defines)
-    seed = gdml.gdml.find_next()
-    while seed is not None:
-        LOG.debug(f'Found seed with name {seed.name}')
-        if seed.name == 'define':
-            LOG.debug('found define')
-            nkid = 0
-            for kid in seed.findChildren():
-                try:
-                    int(kid.attrs['name'])
-                except:
-                    LOG.debug (f"Won't fix namestore {kid}")
-                    continue
-                #kid.name = clean(kid.name)
-                old_name = kid.attrs['name']
-                newname = reformat(old_name, nkid,cc)
-                namestore[old_name] = newname
-                kid.attrs['name'] = newname
-                nkid += 1
-                cc += 1
-            n_define += 1
-            seed = seed.findNextSibling()
-            continue
-
-        if seed.name == 'solids':
-            kid_count = 0
-            print ('found solids')
-            print (len(namestore.keys()))
-            for kid in seed.findChildren():
-                #kid.name = clean(kid.name)
-                if kid.name == 'triangular':
-                    for v in 1,2,3:
-                        oldname = kid.attrs[f'vertex{v}']
-                        try:
-                            kid.attrs[f'vertex{v}'] = namestore[oldname]
-                        except KeyError:
-                            print (kid, oldname)
-                            #raise
-                    #kid.ref  = namestore[kid.name]
-            # reset the namestore for the next section
-                    kid_count += 1 
-            print (kid_count)
-            seed = seed.findNextSibling()
-            continue
-        else:
-            print ('reseting')
-            # we are done with this section
-            seed = seed.findNextSibling()
-    # now we clean every name
-    #seed = gdml.gdml.materials
-    #while seed is not None:
-    #    seed.name = clean(seed.name)
-    #    for kid in seed.findChildren():
-    #        kid.name = clean(kid.name)
-    print ('part 1 done')
+    normalizer = NameNormalizer()
+    with instrument.span('fix_names'):
+        normalizer.normalize_tree(gdml)
+    report_names(normalizer)
     return gdml
 
+##################################
+
+def report_names(normalizer):
+    """
+    Print a summary of the renaming
+    """
+    report = normalizer.report()
+    print (f'===> Renamed {report["renamed"]} names, {report["collisions"]} collisions, {report["unresolved"]} references to names which have not been renamed')
+    for kind, name, normalized, new_name in normalizer.collisions:
+        print (f'{kind} {name} -> {new_name} (instead of {normalized})')
+
+
+
+##################################
 
+def print_decimation_report(solids):
+    """
+    Show the number of facets of each solid before
+    and after the decimation
+    """
+    before, after = 0, 0
+    print (f'{"solid":>40} {"before":>8} {"after":>8} {"deviation [mm]":>15}')
+    for ts in solids:
+        report = ts.decimation_report
+        if report is None:
+            continue
+        before += report['before']
+        after += report['after']
+        print (f'{ts.name:>40} {report["before"]:>8} {report["after"]:>8} {report["deviation"]:>15.4g}')
+    print (f'{"total":>40} {before:>8} {after:>8}')
 
 if __name__ == '__main__':
     
@@ -219,33 +141,83 @@ if __name__ == '__main__':
     parser.add_argument('--fix-names',  dest='fix_names',
                         action='store_true',
                         help='Fix names with invalid symbols')
+    parser.add_argument('--parser', dest='parser',
+                        choices=PARSERS, default='bs4',
+                        help='Parser backend to read the tessellated solids. "lxml" streams through the file and keeps the memory footprint flat, which is much faster for large files.')
+    parser.add_argument('--jobs', dest='jobs',
+                        type=int, default=1,
+                        help='Number of processes to work on the solids in parallel. The result is the same as with a single process.')
+    parser.add_argument('--weld', dest='weld',
+                        type=float, default=None,
+                        help='Merge vertices of a solid which are closer than this distance (in the length unit of the file) and remove unused vertices.')
+    parser.add_argument('--profile', dest='profile',
+                        choices=PROFILES, default='full',
+                        help='Output profile for the .cmprX.gdml file. "compact" rounds the vertices to 10 significant digits (unless this changes the validity of a facet), uses short vertex names, leaves out default attributes and does not indent.')
+    parser.add_argument('--compress-level', dest='compress_level',
+                        type=int, default=None,
+                        help='Compression level for the output files, in case the input file is compressed (.gdml.gz, .gdml.xz, .gdml.zst). The output is compressed with the same codec.')
+    parser.add_argument('--decimate-faces', dest='decimate_faces',
+                        type=int, default=None,
+                        help='Simplify every solid to (at least) this number of facets. The solids stay watertight and valid for Geant4.')
+    parser.add_argument('--max-deviation', dest='max_deviation',
+                        type=float, default=None,
+                        help='Simplify every solid as long as the surface does not move more than this distance (in mm). The distance is measured at the vertices, edge midpoints, facet centers and random points of the surfaces, so it is a close estimate, not a strict bound. Can be combined with --decimate-faces.')
+    parser.add_argument('--dedup', dest='dedup',
+                        action='store_true',
+                        help='Write solids which are copies of each other (up to rotation and translation) only once, and place the copies with their own physvols.')
+    parser.add_argument('--incremental', dest='incremental',
+                        nargs='?', const='', default=None,
+                        help='Keep the processed solids in a manifest directory (default: next to the output, .cmprX.gdml.manifest) and only process the solids which have changed since the last run.')
+    parser.add_argument('--quiet', dest='quiet',
+                        action='store_true',
+                        help='No progress bars and no printout of the individual tags.')
+    parser.add_argument('--trace', dest='trace',
+                        type=str, default=None,
+                        help='Record the time, memory and amount of work of each stage and write it to this file.')
+    parser.add_argument('--trace-format', dest='trace_format',
+                        choices=('json', 'chrome'), default='json',
+                        help='Format of the --trace file. "chrome" can be opened with chrome://tracing or ui.perfetto.dev')
 
     args = parser.parse_args()
+    instrument.set_quiet(args.quiet)
+    instrument.enable(args.trace is not None)
 
     if args.validation_check:
         g4_validator(args.infile)    
         sys.exit(0)
 
-    if args.infile.endswith('.cmpr.gdml'):
+    if strip_codec(args.infile).endswith('.cmpr.gdml'):
         raise ValueError('File has been compressed already, nothing to do!')
 
     if args.fix_names: 
-        bs = bs4.BeautifulSoup(open(args.infile),features="lxml-xml")
-        fix_names(bs)
         print (f'Will work on {args.infile}')
-        fixed_file = open(args.infile.replace('.gdml', '.fix.gdml'),'w')
-        fixed_file.write(bs.prettify())
+        fixed_name = args.infile.replace('.gdml', '.fix.gdml')
+        if args.parser == 'lxml':
+            # stream through the file, no tree is built
+            normalizer = NameNormalizer()
+            with instrument.span('fix_names'):
+                normalizer.normalize_file(args.infile, fixed_name, level=args.compress_level)
+            report_names(normalizer)
+        else:
+            bs = open_gdml(args.infile)
+            fix_names(bs)
+            with open_file(fixed_name, 'wt', level=args.compress_level) as fixed_file:
+                fixed_file.write(bs.prettify())
         print ('names fixed. Exiting!')
         sys.exit(0)
+    elif args.parser == 'bs4':
+        bs = open_gdml(args.infile)
     else:
-        bs = bs4.BeautifulSoup(open(args.infile),features="lxml-xml")
+        # the tree is only used to collect the output
+        bs = bs4.BeautifulSoup('<?xml version="1.0" encoding="UTF-8" standalone="no" ?>', features='lxml-xml')
+        bs.append(read_root_tag(args.infile))
 
 
     outfileX = args.infile.replace('.gdml','.cmprX.gdml')
     if os.path.exists(outfileX):
         os.remove(outfileX)
     outfile = args.infile.replace('.gdml','.cmpr.gdml')
-    compressed_file = GdmlFileMinimal(outfileX)
+    compressed_file = GdmlFileMinimal(outfileX, profile=args.profile)
     try:
         compressed_file.copy_materials_from_file(args.infile)
     except IndexError as e:
@@ -259,14 +231,6 @@ if __name__ == '__main__':
     # gdml
     
     nkids = 0
-    cursor = bs.gdml.materials
-    # there might be no materials, in 
-    # taat case we move on to the first
-    # define 
-    has_materials = True
-    if cursor is None:
-        cursor = bs.gdml.define
-        has_materials = False
     ntess = 0 # how many tessellated solids
               # per section
     
@@ -274,15 +238,29 @@ if __name__ == '__main__':
     tags_to_write = []
     solid_tags_to_write = []
     
-    cleaned_file = open(outfile, 'w')
-    nkids = len(cursor.findAll())
+    cleaned_file = open_file(outfile, 'wt', level=args.compress_level)
     
     vertex_template     = None
     triangular_template = None
 
-    all_tessell_solids = extract_tessellated_solids(cursor,\
-                                                    solid_tags_to_write,\
-                                                    tags_to_write)
+    if args.parser == 'lxml':
+        all_tessell_solids = extract_tessellated_solids_lxml(args.infile,\
+                                                             solid_tags_to_write,\
+                                                             tags_to_write)
+        has_materials = bool(tags_to_write) and (tags_to_write[0].name == 'materials')
+    else:
+        cursor = bs.gdml.materials
+        # there might be no materials, in 
+        # taat case we move on to the first
+        # define 
+        has_materials = True
+        if cursor is None:
+            cursor = bs.gdml.define
+            has_materials = False
+        nkids = len(cursor.findAll())
+        all_tessell_solids = extract_tessellated_solids(cursor,\
+                                                        solid_tags_to_write,\
+                                                        tags_to_write)
     bs.gdml.clear()
 
 
@@ -293,19 +271,39 @@ if __name__ == '__main__':
 
     #for k in solid_tags_to_write:
     empties = 0
-    for ts in tqdm.tqdm(all_tessell_solids, desc='Processing triangles...'):
+    # the solids which need to be processed, in an incremental
+    # build the unchanged ones are restored from the manifest
+    todo = all_tessell_solids
+    manifest = None
+    if args.incremental is not None:
+        manifest_dir = args.incremental or (outfileX + '.manifest')
+        manifest = Manifest(manifest_dir,\
+                            settings={'weld'           : args.weld,\
+                                      'decimate_faces' : args.decimate_faces,\
+                                      'max_deviation'  : args.max_deviation})
+        todo = manifest.restore(all_tessell_solids, 'cleaned')
+        print (f'{len(all_tessell_solids) - len(todo)} solids are unchanged, processing {len(todo)} solids')
+    if args.weld is not None:
+        run_stage(todo, partial(weld, tolerance=args.weld),\
+                  jobs=args.jobs, desc='Welding vertices...')
+        nmerged = sum([ts.nmerged for ts in all_tessell_solids])
+        nunreferenced = sum([ts.nunreferenced for ts in all_tessell_solids])
+        print (f'Merged {nmerged} vertices and removed {nunreferenced} unused vertices')
+    run_stage(todo, clean_facets,\
+              jobs=args.jobs, desc='Processing triangles...')
+    if (args.decimate_faces is not None) or (args.max_deviation is not None):
+        run_stage(todo, partial(decimate,\
+                                face_count=args.decimate_faces,\
+                                max_deviation=args.max_deviation),\
+                  jobs=args.jobs, desc='Decimating...')
+        print_decimation_report(all_tessell_solids)
+    if manifest is not None:
+        manifest.keep(todo, 'cleaned')
+    for ts in all_tessell_solids:
         if not ts.nvertices:
             empties += 1
             continue
 
-        # in some cases, it can be that the world solid
-        # appears in the list of tessell solids as well.
-        # in that case it has a single vertice
-        if ts.nvertices == 1:
-            print (f'Not fixing triangles for single vertex solid {ts, ts.name}')
-        else:
-            ts.remove_invalid_triangles()
-    
         bs.gdml.append(ts.create_define_tag())
         try:
             bs.gdml.append(ts.create_solid_tag(no_name_change=True))
@@ -316,30 +314,55 @@ if __name__ == '__main__':
     
     # this is typically the worldbox
     for tag in solid_tags_to_write:
-        print (f'Writing additional solid tags {tag}..')
+        if not args.quiet:
+            print (f'Writing additional solid tags {tag}..')
         bs.gdml.append(tag)
     
     # these are setup and so on
     for tag in tags_to_write:
-        print (f'Writing additional tags {tag}..')
+        if not args.quiet:
+            print (f'Writing additional tags {tag}..')
         # FIXME - we fix volumeref, solidref and volume
         # name, for the tessellated solids
         bs.gdml.append(tag)
     
-    cleaned_file.write(bs.prettify())
-    cleaned_file.close()
+    with instrument.span('write_cmpr', filename=outfile):
+        cleaned_file.write(bs.prettify())
+        cleaned_file.close()
 
     # now we write the file following the new scheme
-    for ctr, tess in enumerate(all_tessell_solids):
-        tess.translate_to_center_mass()
-        tess.remove_invalid_triangles()
-        #tess.position = (0,0,0)
-        physvol = GdmlPhysVol(tess.name, tess.position, solid=tess,\
-                              material="ALUMINUM", counter=ctr)
-        physvol.register_myself(compressed_file)
+    todo = all_tessell_solids
+    if manifest is not None:
+        todo = manifest.restore(all_tessell_solids, 'centered')
+    run_stage(todo, center_and_clean,\
+              jobs=args.jobs, desc='Centering solids...')
+    if manifest is not None:
+        manifest.keep(todo, 'centered')
+    if args.dedup:
+        physvols = instance_physvols(all_tessell_solids, material="ALUMINUM")
+    else:
+        physvols = [GdmlPhysVol(tess.name, tess.position, solid=tess,\
+                                material="ALUMINUM", counter=ctr)\
+                    for ctr, tess in enumerate(all_tessell_solids)]
+    # the centering is written as the position of the physvols,
+    # the vertices of the solids are not moved
+    absorb_solid_transforms(physvols)
+    if manifest is not None:
+        # the formatted tags are kept as well
+        placed = list({id(physvol.solid) : physvol.solid for physvol in physvols}.values())
+        manifest.lines(placed, compressed_file.profile)
+        manifest.save()
+    compressed_file.register_physvols(physvols)
     compressed_file.add_world([10000, 10000, 10000])
-    compressed_file.write_to_file()
+    compressed_file.write_to_file(level=args.compress_level)
 
-    print (all_tessell_solids)
+    if not args.quiet:
+        print (all_tessell_solids)
+    if args.trace is not None:
+        if args.trace_format == 'chrome':
+            instrument.INSTRUMENTATION.to_chrome_trace(args.trace)
+        else:
+            instrument.INSTRUMENTATION.to_json(args.trace)
+        print (f'Trace written to {args.trace}')
 
     
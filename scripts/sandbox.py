@@ -9,7 +9,8 @@ pygdml.set_package_loglevel(30)
 from pygdml.gdml_solid import GdmlBox
 from pygdml.gdml_physvol import GdmlPhysVol
 from pygdml.gdml_file import GdmlFileMinimal
-from pygdml.gdml_assembly import get_tsolids_from_subassembly
+from pygdml.gdml_assembly import Subassembly
+from pygdml.gdml_cache import SolidCache
 
 import logging
 LOG = logging
@@ -85,84 +86,52 @@ parts_counter = 0
 ########################################
 GLOBAL_PARTS_COUNTER = 0
 
-tof_03pp               = 'tof-panels/tof-03pp.fix.cmprX.gdml'
-tof_03pp_solids        = get_tsolids_from_subassembly(tof_03pp,\
-                                                      first_identifier=GLOBAL_PARTS_COUNTER)
-# we need to do this 3 more times:
-ltof_03pp_solids = len(tof_03pp_solids)
-GLOBAL_PARTS_COUNTER += ltof_03pp_solids
-for k in range(3):
-    tof_03pp_solids += get_tsolids_from_subassembly(tof_03pp,\
-                                                    first_identifier=GLOBAL_PARTS_COUNTER)
-    GLOBAL_PARTS_COUNTER += ltof_03pp_solids
+# the same files are read multiple times, so only
+# parse them once
+SOLID_CACHE = SolidCache()
+
+tof_03pp               = Subassembly('tof-panels/tof-03pp.fix.cmprX.gdml',\
+                                     cache=SOLID_CACHE,\
+                                     center=True)
+# we have 4 times the 03pp panel, the file
+# is only read once for all of them
+tof_03pp_solids        = tof_03pp.instances([(0,0,0), (0,0,1000), (0,0,2000), (0,0,3000)],\
+                                            first_identifier=GLOBAL_PARTS_COUNTER)
+GLOBAL_PARTS_COUNTER  += len(tof_03pp_solids)
 
 tof_03pp_meta          = hjson.load(open('tof-03pp.meta.json'))
 tof_03pp_meta          = tof_03pp_meta['functional_parts']
 
-# we have 4 times the 03pp panel
-tof_03pp_translations = []
-tof_03pp_translations.extend([(0,0,0)]*ltof_03pp_solids)
-tof_03pp_translations.extend([(0,0,1000)]*ltof_03pp_solids)
-tof_03pp_translations.extend([(0,0,2000)]*ltof_03pp_solids)
-tof_03pp_translations.extend([(0,0,3000)]*ltof_03pp_solids)
-#tof_03pp_solids = tof_03pp_solids*4
-#tof_03pp_solids = multiplex_solids(tof_03pp_solids, n=4)
-
-#GLOBAL_PARTS_COUNTER += len(tof_03pp_solids)
-
 #######################################
 # TOF-CUBE
 ########################################
-npanels_cube_12pp       = 2
-
-tof_12pp                = 'tof-panels/tof-12pp.fix.cmprX.gdml'
-tof_12pp_solids         = get_tsolids_from_subassembly(tof_12pp,
-                                                       first_identifier=GLOBAL_PARTS_COUNTER)
-ltof_12pp_solids = len(tof_12pp_solids)
-GLOBAL_PARTS_COUNTER += ltof_12pp_solids
-for k in range(1):
-    tof_12pp_solids = get_tsolids_from_subassembly(tof_12pp,
-                                                   first_identifier=GLOBAL_PARTS_COUNTER)
-    GLOBAL_PARTS_COUNTER += ltof_12pp_solids
+tof_12pp                = Subassembly('tof-panels/tof-12pp.fix.cmprX.gdml',\
+                                      cache=SOLID_CACHE,\
+                                      center=True)
+tof_12pp_solids         = tof_12pp.instances([(0,y,0) for y in (-2000,2000)],\
+                                             first_identifier=GLOBAL_PARTS_COUNTER)
+GLOBAL_PARTS_COUNTER   += len(tof_12pp_solids)
 tof_12pp_meta           = hjson.load(open('tof-12pp.meta.json'))
 tof_12pp_meta           = tof_12pp_meta['functional_parts']
 
-tof_12pp_translations   = []
-for y in (-2000,2000):
-    tof_12pp_translations.extend([(0,y,0)]*ltof_12pp_solids)
-
-tof_12pp_rotations = []
-tof_12pp_rotations.extend(['identity']*ltof_12pp_solids)
-tof_12pp_rotations.extend(['identity']*ltof_12pp_solids)
-#tof_12pp_solids         = tof_12pp_solids*npanels_cube_12pp
-#tof_12pp_solids = multiplex_solids(tof_12pp_solids, n=2)
-#GLOBAL_PARTS_COUNTER += len(tof_12pp_solids)
-
-inner_cube              = 'cube-frame-600.fix.cmpr.gdml'
-inner_cube_solids       = get_tsolids_from_subassembly(inner_cube,\
-                                                       first_identifier=GLOBAL_PARTS_COUNTER)
-GLOBAL_PARTS_COUNTER += len(inner_cube_solids)
+inner_cube              = Subassembly('cube-frame-600.fix.cmpr.gdml',\
+                                      cache=SOLID_CACHE,\
+                                      center=True)
+inner_cube_solids       = inner_cube.instance(first_identifier=GLOBAL_PARTS_COUNTER)
+GLOBAL_PARTS_COUNTER   += len(inner_cube_solids)
 
 inner_cube_meta         = hjson.load(open('cube-frame-600.meta.json'))
 inner_cube_meta         = inner_cube_meta['functional-parts']
 
-inner_cube_translations = []
-inner_cube_translations.extend([(0,0,0)]*len(inner_cube_solids))
-
 ################################################3
 # GAPS - ASSEMBLE!
 #################################################
 
 tof_solids = []
-tof_translations = []
 tof_solids.extend(tof_03pp_solids)
 #tof_solids.extend(tof_12pp_solids)
 #tof_solids.extend(inner_cube_solids)
 
-tof_translations.extend(tof_03pp_translations)
-#tof_translations.extend(tof_12pp_translations)
-#tof_translations.extend(inner_cube_translations)
-
 tof_meta = {}
 tof_meta.update(tof_03pp_meta)
 #tof_meta.update(tof_12pp_meta)
@@ -175,8 +144,8 @@ material_counter = dict()
 scale_counter    = dict()
 no_meta_info     = []
 
-for t, s in zip(tof_translations, tof_solids):
-    print (t,s)
+for s in tof_solids:
+    print (s)
     print (s.name)
 
     if '__uid' in s.name:
@@ -184,8 +153,9 @@ for t, s in zip(tof_translations, tof_solids):
     #continue
     # set the default material to aluminum for now
     material = 'aluminum'
-    s.translate_to_center_mass()
-    #s.position = (0,0,0)
+    # the subassemblies have been moved to the
+    # center of mass already, and the instances
+    # are placed there
 
     global_part_name = None
     #print(s.name)
@@ -222,6 +192,11 @@ for t, s in zip(tof_translations, tof_solids):
 
             s.scale(*tolerance)
 
+        # simplify the part, e.g. {'face_count' : 2000} or
+        # {'max_deviation' : 0.1} (in mm) or both
+        if 'decimate' in metadata:
+            s.decimate(**metadata['decimate'])
+
         if 'scale' in metadata:
             if isinstance(metadata['scale'], list):
                 tolerance = []
@@ -250,12 +225,6 @@ for t, s in zip(tof_translations, tof_solids):
 
     if rotation == 'identity':
         rotation = None
-    #s.position = (0,0,0)
-    # general translation of the whole assembly
-    s.position = (s.position[0] + t[0],\
-                  s.position[1] + t[1],\
-                  s.position[2] + t[2])
-
     if rotation is not None:
         s.rotation = rotation
     #print(f'Adding physvol {s.name} at position {s.position}, with metadata {metadata} and rotation {s.rotation} and material {material}')
@@ -264,13 +233,10 @@ for t, s in zip(tof_translations, tof_solids):
                      s.position,\
                      solid=s,\
                      material=material,\
+                     rotation=s.rotation,\
                      scale=s.scalefactors,\
                      metadata=metadata,
                      counter=parts_counter)
-    if not rotation is None:
-        for k in rotation:
-            pass
-            #pv.add_rotation(k,rotation[k])
     parts_counter += 1
 
     #pv = GdmlPhysVol(s.name, ORIGIN, solid=s, material=material)
@@ -285,12 +251,24 @@ geofile.add_world([10000,10000,10000])
 geofile.write_to_file()
 #print(geofile.bs.prettify())
 
+print ("Decimated parts (facets before/after):")
+for s in tof_solids:
+    if s.decimation_report is not None:
+        print(f'{s.name} : {s.decimation_report["before"]} -> {s.decimation_report["after"]}')
+
 print ("There is no meta info for the following parts:")
 for k in no_meta_info:
     print(k)
 
-overlap_check = False
+overlap_check = True
 if overlap_check:
+    from pygdml.gdml_overlaps import check_overlaps
+    overlaps = check_overlaps(geofile, resolution=1000, tolerance=0., jobs=os.cpu_count())
+    print (f'Found {len(overlaps)} overlaps')
+
+# the same check with geant4, if the python bindings are available
+g4_overlap_check = False
+if g4_overlap_check:
     import Geant4.G4gdml as gd
 
     parse = gd.G4GDMLParser()
@@ -0,0 +1,115 @@
+#! /usr/bin/env python
+
+"""
+Check that the vectorized facet checks (gdml_solid.g4_facet_validity)
+agree with the scalar reference ported from geant4's G4TriangularFacet
+(GdmlTessellatedSolid.check_triangle_g4valid), facet by facet. The
+meshes are random, with degenerate facets forced in: collapsed edges,
+vertices closer than the tolerance and (nearly) collinear corners.
+"""
+
+import numpy as np
+
+from pygdml.gdml_solid import GdmlTessellatedSolid, g4_facet_validity
+
+##############################################################
+
+def random_mesh(rng, nvertices, nfaces, delta, degenerate=0.2):
+    """
+    Random vertices and facets. A fraction of the facets is made
+    invalid, the distortions are well below or above the tolerance,
+    so that rounding can not decide the result.
+
+    Args:
+        rng (np.random.Generator) : the random generator
+        nvertices (int)           : number of vertices
+        nfaces (int)              : number of facets
+        delta (float)             : the tolerance
+
+    Keyword Args:
+        degenerate (float)        : fraction of the facets which are distorted
+
+    Returns:
+        tuple (np.ndarray, np.ndarray) : vertices and facets
+    """
+    vertices = 100. * rng.random((nvertices, 3))
+    faces = rng.integers(nvertices, size=(nfaces, 3))
+    vertices = [vertices]
+    nbad = int(degenerate * nfaces)
+    for index in rng.choice(nfaces, size=nbad, replace=False):
+        kind = rng.integers(4)
+        v0, v1, v2 = vertices[0][faces[index]]
+        if kind == 0:
+            # two corners are the same vertex
+            faces[index, 1] = faces[index, 0]
+            continue
+        if kind == 1:
+            # a corner very close to another one
+            v1 = v0 + 0.1 * delta * rng.standard_normal(3)
+        elif kind == 2:
+            # the third corner on the line through the others
+            v2 = v0 + rng.random() * (v1 - v0)
+        else:
+            # a corner just off the line, but by more than the tolerance
+            normal = np.cross(v1 - v0, rng.standard_normal(3))
+            v2 = v0 + rng.random() * (v1 - v0) + 10. * delta * normal / np.linalg.norm(normal)
+        start = sum(len(k) for k in vertices)
+        vertices.append(np.array((v0, v1, v2)))
+        faces[index] = (start, start + 1, start + 2)
+    return np.concatenate(vertices), faces
+
+##############################################################
+
+def compare(vertices, faces, tolerance):
+    """
+    Run both checks on all facets
+
+    Returns:
+        tuple (np.ndarray, int) : indices of the facets where the
+                                  checks disagree, and the number
+                                  of invalid facets
+    """
+    solid = GdmlTessellatedSolid()
+    solid.vertices = vertices
+    solid.faces = faces
+    solid.tolerance = tolerance
+    valid, reasons = g4_facet_validity(solid.vertices, solid.faces, tolerance)
+    reference = np.array([solid.check_triangle_g4valid(k) for k in solid.faces])
+    assert sum(reasons.values()) == int((~valid).sum())
+    assert solid.ninvalidtri == int((~reference).sum())
+    return np.flatnonzero(valid != reference), int((~reference).sum())
+
+##############################################################
+
+if __name__ == '__main__':
+
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Compare the vectorized and the scalar facet checks on random meshes.')
+    parser.add_argument('--meshes', dest='meshes', type=int,
+                        default=20,
+                        help='Number of random meshes')
+    parser.add_argument('--facets', dest='facets', type=int,
+                        default=2000,
+                        help='Facets per mesh')
+    parser.add_argument('--seed', dest='seed', type=int,
+                        default=0,
+                        help='Seed of the random generator')
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(args.seed)
+    failed = 0
+    for k in range(args.meshes):
+        # the tolerance as set by GdmlTessellatedSolid.set_tolerance,
+        # for world extents from mm to km
+        tolerance = 1e-11 * 10. ** rng.uniform(0, 6)
+        vertices, faces = random_mesh(rng, args.facets // 2, args.facets, tolerance)
+        mismatch, ninvalid = compare(vertices, faces, tolerance)
+        print (f'-- mesh {k} : {len(faces)} facets, {ninvalid} invalid, {len(mismatch)} mismatches')
+        if len(mismatch):
+            failed += 1
+            for index in mismatch[:5]:
+                print (f'-- -- facet {index} : {vertices[faces[index]].tolist()}')
+    if failed:
+        raise SystemExit(f'The checks disagree for {failed} of {args.meshes} meshes!')
+    print ('The vectorized and the scalar checks agree')
@@ -0,0 +1,77 @@
+#! /usr/bin/env python
+
+"""
+Check that the counters of the instrumentation (facets dropped,
+vertices merged, ...) are the same if the pipeline stages run
+in the main process or in worker processes (--jobs).
+"""
+
+from functools import partial
+
+import numpy as np
+
+from pygdml.gdml_solid import GdmlTessellatedSolid
+from pygdml.gdml_pipeline import run_stage, clean_facets, weld
+from pygdml import gdml_instrument as instrument
+
+from benchmark import torus
+
+##############################################################
+
+def make_solids(nsolids, nfacets, seed=0):
+    """
+    Tori with some of their facets collapsed, so that
+    the stages have something to remove
+    """
+    rng = np.random.default_rng(seed)
+    solids = []
+    for k in range(nsolids):
+        vertices, faces = torus(nfacets, radius=20. + 60.*rng.random())
+        faces = faces.copy()
+        bad = rng.choice(len(faces), size=len(faces) // 20, replace=False)
+        faces[bad, 1] = faces[bad, 0]
+        solid = GdmlTessellatedSolid(identifier=k)
+        solid.name = f'part{k}'
+        solid.unit = 'mm'
+        solid.vertices = vertices
+        solid.faces = faces
+        solid.set_tolerance(1000.)
+        solids.append(solid)
+    return solids
+
+def run(jobs, nsolids, nfacets):
+    """
+    Clean and weld the solids, and return the counters
+    """
+    instrument.INSTRUMENTATION.reset()
+    solids = make_solids(nsolids, nfacets)
+    run_stage(solids, clean_facets, jobs=jobs)
+    run_stage(solids, partial(weld, tolerance=1e-3), jobs=jobs)
+    return instrument.counters()
+
+##############################################################
+
+if __name__ == '__main__':
+
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Compare the counters of serial and parallel pipeline stages.')
+    parser.add_argument('--solids', dest='solids', type=int,
+                        default=8,
+                        help='Number of solids')
+    parser.add_argument('--facets', dest='facets', type=int,
+                        default=2000,
+                        help='Facets per solid')
+    args = parser.parse_args()
+
+    instrument.enable()
+    instrument.set_quiet()
+    serial = run(1, args.solids, args.facets)
+    parallel = run(2, args.solids, args.facets)
+    print (f'-- jobs=1 : {serial}')
+    print (f'-- jobs=2 : {parallel}')
+    if not serial:
+        raise SystemExit('No counters have been recorded!')
+    if serial != parallel:
+        raise SystemExit('The counters of the serial and the parallel run differ!')
+    print ('The counters agree')
@@ -0,0 +1,81 @@
+#! /usr/bin/env python
+
+"""
+Check that the instances of a tessellated solid (see
+GdmlTessellatedSolid.instance) are isolated from the solid they
+have been made from: adding vertices and facets, changing the
+rotation or transforming an instance must not change the source.
+"""
+
+import numpy as np
+
+from pygdml.gdml_solid import GdmlTessellatedSolid
+
+##############################################################
+
+def tetrahedron():
+    """
+    A small solid, read in the same way as the parsers do it
+    """
+    solid = GdmlTessellatedSolid()
+    solid.name = 'tetra'
+    for k, vertex in enumerate(((0, 0, 0), (1, 0, 0), (0, 1, 0), (0, 0, 1))):
+        solid.add_vertex(f'p{k}', *vertex, unit='mm')
+    for face in (('p0', 'p2', 'p1'), ('p0', 'p1', 'p3'), ('p0', 'p3', 'p2'), ('p1', 'p2', 'p3')):
+        solid.add_triangular(*face, attrs={'type' : 'ABSOLUTE'})
+    solid.rotation = {'x' : 0., 'y' : 0., 'z' : 0.}
+    return solid
+
+##############################################################
+
+def check_parsing():
+    """
+    Vertices and facets added to an instance stay with the instance
+    """
+    source = tetrahedron()
+    copy = source.instance(5)
+    assert copy._vertex_buffer is not source._vertex_buffer
+    assert copy._face_buffer is not source._face_buffer
+    copy.add_vertex('q0', 1., 1., 1., unit='mm')
+    copy.add_vertex('q1', 2., 1., 1., unit='mm')
+    copy.add_vertex('q2', 1., 2., 1., unit='mm')
+    copy.add_triangular('q0', 'q1', 'q2')
+    assert (copy.nvertices, copy.nfaces) == (7, 5)
+    assert (source.nvertices, source.nfaces) == (4, 4)
+
+def check_rotation():
+    """
+    Changing the rotation of an instance in place
+    """
+    source = tetrahedron()
+    copy = source.instance(5)
+    copy.rotation['x'] = 90.
+    assert source.rotation['x'] == 0.
+
+def check_geometry():
+    """
+    The shared arrays can not be written through the instance,
+    and transformations only change the instance
+    """
+    source = tetrahedron()
+    reference = source.vertices.copy()
+    copy = source.instance(5)
+    try:
+        copy.vertices[0] += 1000.
+    except ValueError:
+        pass
+    else:
+        raise AssertionError('the vertices of an instance are writeable')
+    copy.translate(1., 2., 3.)
+    copy.scale(2., 2., 2.)
+    assert np.array_equal(source.vertices, reference)
+    # the source stays writeable
+    source.vertices[0] += 1.
+
+##############################################################
+
+if __name__ == '__main__':
+
+    for check in (check_parsing, check_rotation, check_geometry):
+        check()
+        print (f'-- {check.__name__} : ok')
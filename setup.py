@@ -64,6 +64,8 @@ setup(name='pygdml',
       author_email="achim.stoessl@gmail.com",
       url='https://github.com/achim1/pyGDML',
       install_requires=install_requires, 
+      extras_require={'zstd'     : ['zstandard>=0.15.0'],
+                      'decimate' : ['fast-simplification>=0.1.7']},
       setup_requires=setup_requires,
       license="GPL",
       platforms=["Ubuntu 20.04", "Ubuntu 22.04"],